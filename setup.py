@@ -2,14 +2,19 @@ import json
 import os
 import yaml
 import argparse
+import itertools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from src.setup_utils import (
     process_gtr_data,
+    ingest_source,
+    iter_json_lines,
+    write_json_array,
+    transform_pipeline,
+    projection_steps,
     load_json,
     save_json,
     add_const_field_json,
-    remove_fields,
-    map_names_json,
-    convert_entries_to_str
 )
 
 if __name__ == "__main__":
@@ -21,6 +26,18 @@ if __name__ == "__main__":
         action = "store_true",
         help="Process Cordis data only"
     )
+    parser.add_argument(
+        "--stream",
+        default=False,
+        action="store_true",
+        help="Parse, filter and write records one at a time to keep memory flat"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Process each source file in its own worker process (up to this many at once)"
+    )
     args = parser.parse_args()
     if args.cordis_only:
         print("Processing Cordis data only")
@@ -49,83 +66,132 @@ if __name__ == "__main__":
     # gtr_file = "gtr/scraped/2024_07/organisations.json"
     gtr_file = "gtr/organisations.json"
 
-    # Combine and filter Cordis data
-    uk_data = []
-
-    # Iterate over the file paths, read, filter and append data to uk_data
-    for file_path in cordis_files:
-        full_path = os.path.join(input_path, file_path)
-        data = load_json(full_path)
-        # Filter the data where country is "UK". Unlike GtR, Cordis has non-UK entries
-        uk_entries = [entry for entry in data if entry.get("country") == "UK"]
-        uk_data.extend(uk_entries)
+    # Any fields not named in fields to keep will be excluded from final uk_data.json
+    gtr_fields_to_keep = [
+        "dataset",
+        "name",
+        "id",
+        "address.postCode",
+    ]
+    cordis_fields_to_keep = [
+        "dataset",
+        "name",
+        "shortName",
+        "organisationID",
+        "postCode",
+    ]
+    # Remap names as postcode and unique id have different names in gtr and cordis
+    map_names_gtr = {
+        "id": "unique_id",
+        "address.postCode": "postcode"
+    }
+    map_names_cordis = {
+        "organisationID": "unique_id",
+        "postCode": "postcode"
+    }
+    # some unique ids and postcodes need to be converted from int
+    str_fields = ["postcode", "unique_id"]
 
     # Specify the output file path
     output_file_path = os.path.join(script_directory, "data", "raw", "uk_data.json")
 
-    # Write the filtered UK data to the output file
-    if args.cordis_only:
-        with open(output_file_path, 'w', encoding='utf-8') as output_file:
-            json.dump(uk_data, output_file, indent=4)
-        print(f"Filtered Cordis data has been written to {output_file_path}")
+    if args.stream or args.workers > 1:
+        # Each source is parsed, filtered and projected independently (in its own worker
+        # process when --workers > 1) into a JSON-lines part file. Parts are merged in
+        # source order, so the output does not depend on which worker finishes first.
+        # Intermediate cordis/gtr dumps are not written in this mode.
+        sources = [
+            {
+                "path": os.path.join(input_path, file_path),
+                "kind": "cordis",
+                "uk_only": True,
+                "project": not args.cordis_only,
+                "dataset": "cordis",
+                "fields_to_keep": cordis_fields_to_keep,
+                "map_names": map_names_cordis,
+                "str_fields": str_fields,
+            }
+            for file_path in cordis_files
+        ]
+        if not args.cordis_only:
+            sources.append({
+                "path": os.path.join(input_path, gtr_file),
+                "kind": "gtr",
+                "uk_only": False,
+                "project": True,
+                "dataset": "gtr",
+                "fields_to_keep": gtr_fields_to_keep,
+                "map_names": map_names_gtr,
+                "str_fields": str_fields,
+            })
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file_path)) as parts_dir:
+            part_paths = [os.path.join(parts_dir, f"part_{i}.jsonl") for i in range(len(sources))]
+            if args.workers > 1:
+                with ProcessPoolExecutor(max_workers=min(args.workers, len(sources))) as executor:
+                    futures = [
+                        executor.submit(ingest_source, source, part_path, args.stream)
+                        for source, part_path in zip(sources, part_paths)
+                    ]
+                    counts = [future.result() for future in futures]
+            else:
+                counts = [
+                    ingest_source(source, part_path, args.stream)
+                    for source, part_path in zip(sources, part_paths)
+                ]
+            for source, count in zip(sources, counts):
+                print(f"Ingested {count} records from {source['path']}")
+            num_written = write_json_array(iter_json_lines(part_paths), output_file_path)
+        print(f"Wrote {num_written} records to {output_file_path}")
 
     else:
-        # Save initial Cordis data with added dataset field
-        cordis_data = add_const_field_json(uk_data, "dataset", "cordis")
-        save_json(
-            cordis_data, 
-            'cordis_data.json', 
-            save_dir=os.path.join(script_directory, 'data/raw/')
-        )
-        # load and apply processing function for gtr data to transform to flat structure
-        gtr_file = os.path.join(input_path, gtr_file)
-        raw_gtr_data = load_json(gtr_file)
-        processed_gtr = process_gtr_data(raw_gtr_data)
-        save_json(
-            processed_gtr, 
-            'gtr_data.json', 
-            save_dir=os.path.join(script_directory, 'data/raw/')
-        )
-        # Any fields not named in fields to keep will be excluded from final uk_data.json
-        gtr_fields_to_keep = [
-            "dataset",
-            "name",
-            "id",
-            "address.postCode",
-        ]
-        cordis_fields_to_keep = [
-            "dataset",
-            "name",
-            "shortName",
-            "organisationID",
-            "postCode",
-        ]
-        # Remap names as postcode and unique id have different names in gtr and cordis
-        map_names_gtr = {
-            "id": "unique_id",
-            "address.postCode": "postcode"
-        }
-        map_names_cordis = {
-            "organisationID": "unique_id",
-            "postCode": "postcode"
-        }
-
-        # Add dataset field to processed GTR data
-        gtr_data = add_const_field_json(processed_gtr, "dataset", "gtr")
-        # Apply transformations to both datasets
-        gtr_data = remove_fields(gtr_data, gtr_fields_to_keep)
-        gtr_data = map_names_json(gtr_data, map_names_gtr)
-        cordis_data = remove_fields(cordis_data, cordis_fields_to_keep)
-        cordis_data = map_names_json(cordis_data, map_names_cordis)
-        # Combine and save final dataset
-        uk_data = cordis_data + gtr_data
-        # some unique ids and postcodes need to be converted from int
-        convert_entries_to_str(uk_data, ["postcode", "unique_id"])
-        output_file_path = os.path.join(script_directory, "data", "raw", "uk_data.json")
-        with open (output_file_path, 'w', encoding='utf-8') as output_file:
-            json.dump(uk_data, output_file, indent=4)
-        print(f"Combined Cordis and GtR data has been written to {output_file_path}")
-        
+        # Combine and filter Cordis data
+        uk_data = []
+
+        # Iterate over the file paths, read, filter and append data to uk_data
+        for file_path in cordis_files:
+            full_path = os.path.join(input_path, file_path)
+            data = load_json(full_path)
+            # Filter the data where country is "UK". Unlike GtR, Cordis has non-UK entries
+            uk_entries = [entry for entry in data if entry.get("country") == "UK"]
+            uk_data.extend(uk_entries)
+
+        # Write the filtered UK data to the output file
+        if args.cordis_only:
+            with open(output_file_path, 'w', encoding='utf-8') as output_file:
+                json.dump(uk_data, output_file, indent=4)
+            print(f"Filtered Cordis data has been written to {output_file_path}")
+
+        else:
+            # Save initial Cordis data with added dataset field
+            cordis_data = add_const_field_json(uk_data, "dataset", "cordis")
+            save_json(
+                cordis_data, 
+                'cordis_data.json', 
+                save_dir=os.path.join(script_directory, 'data/raw/')
+            )
+            # load and apply processing function for gtr data to transform to flat structure
+            gtr_file = os.path.join(input_path, gtr_file)
+            raw_gtr_data = load_json(gtr_file)
+            processed_gtr = process_gtr_data(raw_gtr_data)
+            save_json(
+                processed_gtr, 
+                'gtr_data.json', 
+                save_dir=os.path.join(script_directory, 'data/raw/')
+            )
+
+            # Tag, project, rename and stringify both datasets in a single lazy pass
+            project_cordis = transform_pipeline(
+                *projection_steps("cordis", cordis_fields_to_keep, map_names_cordis, str_fields)
+            )
+            project_gtr = transform_pipeline(
+                *projection_steps("gtr", gtr_fields_to_keep, map_names_gtr, str_fields)
+            )
+            # Combine and save final dataset
+            uk_data = itertools.chain(project_cordis(cordis_data), project_gtr(processed_gtr))
+            write_json_array(uk_data, output_file_path)
+            print(f"Combined Cordis and GtR data has been written to {output_file_path}")
+
     # Path to the config file
     config_file_path = os.path.join(script_directory, "cfg/config.yaml")
 
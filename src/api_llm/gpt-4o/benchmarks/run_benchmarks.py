@@ -0,0 +1,258 @@
+"""
+Benchmark the non-LLM stages (0-4 and 7) on synthetic data.
+
+Each stage runs in a fresh process so its wall time and peak RSS are measured in
+isolation. Stages exchange data through the same artifacts main.py uses.
+
+Stage 5 can be benchmarked offline too, against the fixture search backend (see
+stages/search_backends.py); it is not run by default since its time is set by the
+search rate.
+
+Usage (from src/api_llm/gpt-4o):
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 1000000
+    python -m benchmarks.run_benchmarks --sizes 10000 --baseline bench.json --tolerance 0.25
+    python -m benchmarks.run_benchmarks --sizes 2000 --stages stage0 stage1 stage2 stage3 stage4 stage5 \
+        --options '{"stage5": {"backend_options": {"latency": 0.2, "error_rate": 0.05}}}'
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.synthetic_data import write_benchmark_inputs
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["stage0", "stage1", "stage2", "stage3", "stage4", "stage7"]
+OPTIONAL_STAGES = ["stage5"]
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _run_stage(stage, work_dir, options):
+    """Load the stage's inputs from `work_dir`, run it, save its outputs and return the metrics."""
+    from stages.artifacts import save_records, load_records, save_sparse_matrix, load_sparse_matrix
+
+    def path(name):
+        return os.path.join(work_dir, name)
+
+    if stage == "stage0":
+        from stages.stage0 import stage0_check_new_data, load_merged_data
+        start = time.perf_counter()
+        stage0_check_new_data(
+            path("uk_data.json"), path("old_uk_data.json"), path("merged_uk_data.json"),
+            path("new_entries.json"), index_path=path("old_uk_data_hashes.txt"), **options,
+        )
+        elapsed = time.perf_counter() - start
+        # Reading the merged data back is stage 1's input, not part of the diff
+        result = load_merged_data(path("merged_uk_data.json"), path("old_uk_data_hashes.txt"))
+        save_records(result, path("stage0_merged_data"))
+        size = len(result)
+
+    elif stage == "stage1":
+        from stages.stage1 import stage1_load_and_preprocess_data
+        from stages.canonical import load_canonicalisation_rules, add_canonical_keys
+        merged_data = load_records(path("stage0_merged_data"))
+        rules = load_canonicalisation_rules(options.pop("canonical_rules", None))
+        start = time.perf_counter()
+        result = add_canonical_keys(stage1_load_and_preprocess_data(merged_data, **options), rules)
+        elapsed = time.perf_counter() - start
+        save_records(result, path("preprocessed_data"))
+        size = len(result)
+
+    elif stage == "stage2":
+        from stages.stage2 import stage2_identify_identical_names
+        preprocessed_data = load_records(path("preprocessed_data"), columns=["combined_name", "canonical_key"])
+        start = time.perf_counter()
+        result = stage2_identify_identical_names(preprocessed_data, **options)
+        elapsed = time.perf_counter() - start
+        size = len(result)
+
+    elif stage == "stage3":
+        from stages.stage3 import stage3_vectorize_names
+        preprocessed_data = load_records(path("preprocessed_data"))
+        start = time.perf_counter()
+        vectorizer, name_vectors, unique_entries = stage3_vectorize_names(preprocessed_data, **options)
+        elapsed = time.perf_counter() - start
+        with open(path("vectorizer_stage3.pkl"), 'wb') as f:
+            pickle.dump(vectorizer, f)
+        save_sparse_matrix(name_vectors, path("name_vectors_stage3"))
+        save_records(unique_entries, path("unique_entries_stage3"))
+        size = name_vectors.shape[0]
+
+    elif stage == "stage4":
+        from stages.stage4 import stage4_group_similar_names
+        with open(path("vectorizer_stage3.pkl"), 'rb') as f:
+            vectorizer = pickle.load(f)
+        name_vectors = load_sparse_matrix(path("name_vectors_stage3"))
+        unique_entries = load_records(path("unique_entries_stage3"))
+        start = time.perf_counter()
+        result = stage4_group_similar_names(vectorizer, name_vectors, unique_entries, **options)
+        elapsed = time.perf_counter() - start
+        with open(path("grouped_names_stage4.json"), 'w') as f:
+            json.dump(result, f)
+        size = len(result)
+
+    elif stage == "stage5":
+        import shutil
+        from stages.stage5 import stage5_perform_web_search
+        with open(path("grouped_names_stage4.json"), 'r') as f:
+            grouped_names = json.load(f)
+        unique_entries = load_records(
+            path("unique_entries_stage3"), columns=["combined_name", "canonical_name", "postcode"]
+        )
+        # Start from an empty search DB so every query is searched
+        search_dir = path("stage5_search")
+        shutil.rmtree(search_dir, ignore_errors=True)
+        os.makedirs(search_dir)
+        options.setdefault("search_method", "fixture")
+        start = time.perf_counter()
+        result = stage5_perform_web_search(grouped_names, unique_entries, output_dir=search_dir, **options)
+        elapsed = time.perf_counter() - start
+        size = len(result[options["search_method"]])
+
+    elif stage == "stage7":
+        from stages.stage7 import stage7_combine_overlapping_groups
+        with open(path("grouped_names_stage4.json"), 'r') as f:
+            grouped_names = json.load(f)
+        # Stand-in for stage 6: accept every candidate group as proposed
+        refined_groups = {rep: [rep] + info["matched_names"] for rep, info in grouped_names.items()}
+        start = time.perf_counter()
+        result = stage7_combine_overlapping_groups(refined_groups, **options)
+        elapsed = time.perf_counter() - start
+        size = len(result)
+
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {"wall_time_s": round(elapsed, 3), "peak_rss_mb": round(_peak_rss_mb(), 1), "output_size": size}
+
+def _stage_worker(stage, work_dir, options, conn):
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        conn.send(("ok", _run_stage(stage, work_dir, options)))
+    except BaseException as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+def run_stage_isolated(stage, work_dir, options, timeout=None):
+    """Run one stage in a fresh process and return its metrics (or an error/timeout record)."""
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_worker, args=(stage, work_dir, dict(options), child_conn))
+    process.start()
+    child_conn.close()
+    if parent_conn.poll(timeout):
+        status, payload = parent_conn.recv()
+    else:
+        process.terminate()
+        status, payload = "error", f"timed out after {timeout}s"
+    process.join()
+    if status == "ok":
+        return payload
+    return {"error": payload}
+
+def run_benchmarks(sizes, stages, work_root, options, seed=0, timeout=None):
+    results = {}
+    for size in sizes:
+        work_dir = os.path.join(work_root, f"n{size}")
+        os.makedirs(work_dir, exist_ok=True)
+        # A hash index left by a previous run would not match the regenerated old database
+        stale_index = os.path.join(work_dir, "old_uk_data_hashes.txt")
+        if os.path.exists(stale_index):
+            os.remove(stale_index)
+        logger.info(f"Generating {size} synthetic records in {work_dir}")
+        write_benchmark_inputs(size, os.path.join(work_dir, "uk_data.json"), os.path.join(work_dir, "old_uk_data.json"), seed=seed)
+
+        results[str(size)] = {}
+        for stage in stages:
+            metrics = run_stage_isolated(stage, work_dir, options.get(stage, {}), timeout=timeout)
+            results[str(size)][stage] = metrics
+            if "error" in metrics:
+                logger.error(f"n={size} {stage}: {metrics['error']}; skipping later stages for this size.")
+                break
+            logger.info(
+                f"n={size} {stage}: {metrics['wall_time_s']:.2f}s, peak RSS {metrics['peak_rss_mb']:.0f} MB, "
+                f"output size {metrics['output_size']}"
+            )
+    return results
+
+def find_regressions(results, baseline, tolerance):
+    """Return a list of messages for every stage whose time or memory exceeds baseline * (1 + tolerance)."""
+    regressions = []
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if not base or "error" in base:
+                continue
+            if "error" in metrics:
+                regressions.append(f"n={size} {stage}: failed ({metrics['error']})")
+                continue
+            for key in ("wall_time_s", "peak_rss_mb"):
+                if metrics[key] > base[key] * (1 + tolerance):
+                    regressions.append(f"n={size} {stage}: {key} {metrics[key]} vs baseline {base[key]}")
+    return regressions
+
+def print_table(results):
+    print(f"{'size':>9}  {'stage':<7} {'time (s)':>10} {'peak RSS (MB)':>14} {'output':>9}")
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            if "error" in metrics:
+                print(f"{size:>9}  {stage:<7} {'error: ' + metrics['error']}")
+            else:
+                print(f"{size:>9}  {stage:<7} {metrics['wall_time_s']:>10.2f} {metrics['peak_rss_mb']:>14.1f} {metrics['output_size']:>9}")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the non-LLM stages on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='Numbers of synthetic records to benchmark')
+    parser.add_argument('--stages', nargs='+', choices=STAGES + OPTIONAL_STAGES, default=STAGES, help='Stages to run, in order')
+    parser.add_argument('--work-dir', type=str, default='benchmarks/work', help='Directory for generated data and artifacts')
+    parser.add_argument('--output', type=str, default=None, help='Where to write the results JSON')
+    parser.add_argument('--options', type=str, default='{}',
+                        help='JSON of per-stage keyword arguments, e.g. \'{"stage4": {"threshold": 0.4}}\'')
+    parser.add_argument('--baseline', type=str, default=None, help='Results JSON from a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative increase over the baseline before flagging a regression')
+    parser.add_argument('--timeout', type=float, default=None, help='Per-stage timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for data generation')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    options = json.loads(args.options)
+
+    results = run_benchmarks(args.sizes, args.stages, args.work_dir, options, seed=args.seed, timeout=args.timeout)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "options": options,
+        "results": results,
+    }
+    output_path = args.output or os.path.join(args.work_dir, f"benchmark_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_table(results)
+    logger.info(f"Results written to {output_path}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for message in regressions:
+            logger.error(f"Regression: {message}")
+        if regressions:
+            sys.exit(1)
+        logger.info("No regressions against baseline.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import json
+import random
+import string
+
+# Vocabulary for plausible UK research organisation names
+PLACES = [
+    "Bristol", "Oxford", "Cambridge", "Manchester", "Leeds", "Glasgow", "Edinburgh", "Cardiff",
+    "Belfast", "York", "Durham", "Exeter", "Sheffield", "Nottingham", "Southampton", "Aberdeen",
+    "Dundee", "Warwick", "Surrey", "Sussex", "Kent", "Bath", "Lancaster", "Leicester", "Newcastle",
+    "Liverpool", "Birmingham", "Swansea", "Reading", "Norwich", "Plymouth", "Brighton", "Hull",
+]
+ADJECTIVES = [
+    "Advanced", "Applied", "Northern", "Southern", "Western", "Eastern", "Quantum", "Digital",
+    "Green", "Blue", "Integrated", "Precision", "Smart", "Global", "National", "Royal", "Clean",
+    "Future", "Open", "Agile", "Bright", "Deep", "Rapid", "Secure", "Strategic", "Sustainable",
+]
+NOUNS = [
+    "Photonics", "Robotics", "Materials", "Analytics", "Energy", "Systems", "Networks", "Biotech",
+    "Therapeutics", "Diagnostics", "Software", "Engineering", "Composites", "Sensors", "Devices",
+    "Semiconductors", "Instruments", "Aerospace", "Marine", "Genomics", "Imaging", "Wireless",
+    "Automation", "Microsystems", "Optics", "Polymers", "Foods", "Agritech", "Water", "Mobility",
+]
+KINDS = ["Solutions", "Technologies", "Labs", "Group", "Innovations", "Research", "Consulting", ""]
+LEGAL_SUFFIXES = ["Ltd", "Limited", "LTD.", "Plc", "LLP", "Ltd.", ""]
+INSTITUTION_TEMPLATES = [
+    "University of {place}",
+    "{place} University",
+    "{place} City Council",
+    "{place} Teaching Hospitals NHS Trust",
+    "{place} College",
+    "{place} Institute of Technology",
+]
+INSTITUTION_VARIANTS = {
+    "University of": ["Univ. of", "Univ of", "The University of", "UNIVERSITY OF"],
+    "University": ["Univ.", "Uni"],
+    "Institute": ["Inst.", "Institute"],
+}
+INSTITUTION_WORDS = ("University", "Council", "NHS", "College", "Institute")
+POSTCODE_AREAS = [
+    "AB", "B", "BA", "BN", "BS", "CB", "CF", "DD", "DH", "EH", "EX", "G", "HU", "L", "LA", "LE",
+    "LS", "M", "NE", "NG", "NR", "OX", "PL", "RG", "S", "SA", "SO", "BT", "CT", "GU", "YO", "EC",
+]
+
+def random_postcode(rng):
+    area = rng.choice(POSTCODE_AREAS)
+    district = rng.randint(1, 29)
+    inward = f"{rng.randint(0, 9)}{rng.choice(string.ascii_uppercase)}{rng.choice(string.ascii_uppercase)}"
+    return f"{area}{district} {inward}"
+
+def acronym(name):
+    return ''.join(word[0] for word in name.split() if word[0].isupper())
+
+def make_base_organisations(num_orgs, rng):
+    """Create `num_orgs` distinct canonical organisations with a home postcode."""
+    orgs = []
+    seen = set()
+    while len(orgs) < num_orgs:
+        if rng.random() < 0.15:
+            name = rng.choice(INSTITUTION_TEMPLATES).format(place=rng.choice(PLACES))
+        else:
+            words = [rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(KINDS)]
+            if rng.random() < 0.4:
+                words.insert(0, rng.choice(PLACES))
+            name = ' '.join(w for w in words if w)
+        # Disambiguate repeats the way real registries do (numbered or regional entities)
+        if name in seen:
+            name = f"{name} {rng.choice(PLACES)}" if rng.random() < 0.5 else f"{name} {len(orgs)}"
+        if name in seen:
+            continue
+        seen.add(name)
+        orgs.append({"name": name, "postcode": random_postcode(rng)})
+    return orgs
+
+def name_variant(name, rng):
+    """Return a realistic alternative spelling of an organisation name."""
+    roll = rng.random()
+    if roll < 0.45:
+        if any(word in name for word in INSTITUTION_WORDS):
+            for full, shorts in INSTITUTION_VARIANTS.items():
+                if full in name and roll < 0.25:
+                    return name.replace(full, rng.choice(shorts), 1)
+            return name
+        # Only companies carry legal-form suffixes
+        return f"{name} {rng.choice(LEGAL_SUFFIXES)}".strip()
+    if roll < 0.55:
+        return name.upper()
+    if roll < 0.65:
+        return f"The {name}"
+    if roll < 0.75 and len(name) > 6:
+        # Single-character typo
+        i = rng.randrange(1, len(name) - 1)
+        return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+    if roll < 0.85:
+        return acronym(name) or name
+    return name
+
+def generate_records(num_records, seed=0):
+    """
+    Generate `num_records` synthetic uk_data.json records. Each underlying organisation
+    appears 1-6 times across Cordis and GtR with name variants, acronyms and postcodes.
+    """
+    rng = random.Random(seed)
+    base_orgs = make_base_organisations(max(1, num_records // 3), rng)
+    records = []
+    while len(records) < num_records:
+        org = rng.choice(base_orgs)
+        dataset = "cordis" if rng.random() < 0.45 else "gtr"
+        name = name_variant(org["name"], rng)
+        postcode = org["postcode"] if rng.random() < 0.85 else rng.choice([random_postcode(rng), "None", ""])
+        uid = len(records)
+        if dataset == "cordis":
+            record = {
+                "dataset": "cordis",
+                "name": name,
+                "shortName": acronym(org["name"]) if rng.random() < 0.5 else None,
+                "unique_id": str(900000000 + uid),
+                "postcode": postcode,
+            }
+        else:
+            record = {
+                "dataset": "gtr",
+                "name": name,
+                "unique_id": f"{uid:08X}-{rng.randrange(16 ** 4):04X}-4{rng.randrange(16 ** 3):03X}",
+                "postcode": postcode,
+            }
+        records.append(record)
+    return records
+
+def write_benchmark_inputs(num_records, new_data_path, old_data_path, seed=0, old_fraction=0.9, modified_fraction=0.01):
+    """
+    Write a synthetic new snapshot and an 'old' database that holds `old_fraction` of it,
+    with `modified_fraction` of the old records renamed, so stage 0 sees adds and changes.
+    """
+    records = generate_records(num_records, seed=seed)
+    rng = random.Random(seed + 1)
+    num_old = int(len(records) * old_fraction)
+    old_records = [dict(r) for r in records[:num_old]]
+    for record in rng.sample(old_records, int(num_old * modified_fraction)):
+        record["name"] = name_variant(record["name"], rng)
+    with open(new_data_path, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+    with open(old_data_path, 'w', encoding='utf-8') as f:
+        json.dump(old_records, f)
+    return len(records), len(old_records)
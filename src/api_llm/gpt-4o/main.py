@@ -8,24 +8,34 @@ from datetime import datetime
 import asyncio
 
 # Import stage functions
-from stages.stage0 import stage0_check_new_data
+from stages.stage0 import stage0_check_new_data, load_merged_data
 from stages.stage1 import stage1_load_and_preprocess_data
 from stages.stage2 import stage2_identify_identical_names
-from stages.stage3 import stage3_vectorize_names
-from stages.stage4 import stage4_group_similar_names
+from stages.stage3 import stage3_vectorize_names, name_table_names
+from stages.stage4 import stage4_group_similar_names, stage4_sweep_thresholds
 from stages.stage5 import stage5_perform_web_search
+from stages.search_backends import available_backends
 from stages.stage6 import stage6_process_groups_with_llm
 from stages.stage7 import stage7_combine_overlapping_groups
 from stages.stage8 import stage8_determine_organisation_type
 from stages.stage9 import stage9_finalize_groups
 from stages.stage10 import stage10_refine_groups_with_llm
 from stages.stage11 import stage11_capitalize_group_names
+from stages.snapshot_store import SnapshotStore, replace_with_link
+from stages.canonical import load_canonicalisation_rules, add_canonical_keys
+from stages.artifacts import save_records, load_records, save_sparse_matrix, load_sparse_matrix
+from stages.name_table import save_name_table, save_name_groups, load_name_groups, save_record_groups
+
+# Record fields read back by stages that only need a few of them
+STAGE2_COLUMNS = ["combined_name", "canonical_key"]
+STAGE5_COLUMNS = ["combined_name", "canonical_name", "postcode"]
+LOOKUP_COLUMNS = ["combined_name", "unique_id", "dataset", "postcode"]
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process organization names in stages.')
     parser.add_argument('--stage', type=int, default=0, help='Stage to start from (0-11)')
     parser.add_argument('--threshold', type=float, default=0.5, help='Threshold for grouping similar names')
-    parser.add_argument('--search-method', type=str, choices=['google', 'duckduckgo'], default='duckduckgo',
+    parser.add_argument('--search-method', type=str, choices=available_backends(), default='duckduckgo',
                         help='Method for web searching in Stage 5')
     parser.add_argument('--input', nargs='+', help='Input file(s) for the starting stage')
     parser.add_argument('--output-dir', type=str, default='outputs', help='Output directory to save results')
@@ -33,6 +43,78 @@ def parse_arguments():
                         help='Number of web search results to retrieve for each org name')
     parser.add_argument('--data-mode', type=str, choices=['all', 'new'], default='all',
                         help='Run pipeline over all data or only new data')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='Number of worker processes for CPU-bound stages')
+    parser.add_argument('--canonical-rules', type=str, default=None,
+                        help='YAML rules for name canonicalisation after Stage 1 '
+                             '(default: cfg/canonicalisation.yaml)')
+    parser.add_argument('--no-canonicalise', action='store_true',
+                        help='Skip name canonicalisation; Stage 2 then groups on exact names only')
+    parser.add_argument('--tfidf-model-dir', type=str, default=None,
+                        help='Where Stage 3 persists the fitted TF-IDF model (default: <output-dir>/tfidf_model)')
+    parser.add_argument('--tfidf-max-drift', type=float, default=0.1,
+                        help='In --data-mode new, refit TF-IDF once names added since the last fit exceed '
+                             'this fraction of the names it was fitted on')
+    parser.add_argument('--vectorizer', type=str, choices=['tfidf', 'hashing'], default='tfidf',
+                        help='Stage 3 engine: fitted TF-IDF vocabulary, or vocabulary-free feature hashing')
+    parser.add_argument('--hash-analyzer', type=str, choices=['word', 'char', 'char_wb'], default='word',
+                        help='Tokens hashed by the hashing vectorizer')
+    parser.add_argument('--hash-ngram-range', type=int, nargs=2, default=[1, 1], metavar=('MIN', 'MAX'),
+                        help='n-gram range for the hashing vectorizer')
+    parser.add_argument('--hash-features', type=int, default=2 ** 20,
+                        help='Number of hash buckets for the hashing vectorizer')
+    parser.add_argument('--knn-engine', type=str, choices=['brute', 'blockwise', 'lsh'], default='brute',
+                        help='Stage 4 nearest-neighbour engine')
+    parser.add_argument('--knn-block-size', type=int, default=1024,
+                        help='Rows per sparse product block for the blockwise kNN engine')
+    parser.add_argument('--n-neighbors', type=int, default=10,
+                        help='Number of nearest neighbours considered per name in stage 4')
+    parser.add_argument('--lsh-bands', type=int, default=32,
+                        help='Number of LSH bands for the lsh kNN engine')
+    parser.add_argument('--lsh-rows', type=int, default=3,
+                        help='MinHash values per LSH band for the lsh kNN engine')
+    parser.add_argument('--lsh-max-bucket', type=int, default=500,
+                        help='LSH buckets with more names than this are ignored')
+    parser.add_argument('--knn-recall-sample', type=int, default=1000,
+                        help='Names sampled to report lsh/blocking recall against exact search (0 to disable)')
+    parser.add_argument('--blocking', type=str, nargs='+', choices=['postcode', 'tokens', 'sorted'], default=None,
+                        help='Only compare names sharing a block in stage 4 (overrides --knn-engine)')
+    parser.add_argument('--block-max-size', type=int, default=1000,
+                        help='Blocks (or rare-token frequencies) larger than this are ignored')
+    parser.add_argument('--block-window', type=int, default=5,
+                        help='Window size for sorted-neighbourhood blocking')
+    parser.add_argument('--grouping', type=str, choices=['greedy', 'graph'], default='greedy',
+                        help='Stage 4 grouping: greedy in list order, or clustering of the neighbour graph')
+    parser.add_argument('--linkage', type=str, choices=['single', 'average', 'complete'], default='single',
+                        help='Linkage used by --grouping graph')
+    parser.add_argument('--max-group-size', type=int, default=50,
+                        help='Largest group --grouping graph may form; bigger ones are split at their weakest edges')
+    parser.add_argument('--sweep-thresholds', type=float, nargs='+', default=None, metavar='T',
+                        help='Summarise stage 4 groups for each threshold from one cached neighbour search, then exit')
+    parser.add_argument('--hash-no-idf', action='store_true',
+                        help='Skip IDF weighting in the hashing vectorizer, so a name always gets the same vector')
+    parser.add_argument('--search-rate', type=float, default=None,
+                        help='Web searches per minute in stage 5 (default depends on --search-method)')
+    parser.add_argument('--search-concurrency', type=int, default=None,
+                        help='Concurrent web searches in stage 5 (default depends on --search-method)')
+    parser.add_argument('--search-fixed-rate', action='store_true',
+                        help='Keep stage 5 at a fixed --search-rate instead of adapting it to throttling')
+    parser.add_argument('--search-ttl-days', type=float, default=30,
+                        help='Days before a cached web search is repeated (0 to never expire)')
+    parser.add_argument('--search-fixture', type=str, default=None, metavar='PATH',
+                        help='JSON of {query or name: results} served by --search-method fixture '
+                             '(default: made-up results for every query)')
+    parser.add_argument('--search-fixture-latency', type=float, default=0.0,
+                        help='Seconds each fixture search takes')
+    parser.add_argument('--search-fixture-error-rate', type=float, default=0.0,
+                        help='Fraction of fixture searches that fail')
+    parser.add_argument('--search-fixture-throttle-rate', type=float, default=0.0,
+                        help='Fraction of fixture searches that are rate limited')
+    parser.add_argument('--search-fixture-rate-limit', type=float, default=None,
+                        help='Searches per minute above which the fixture backend throttles')
+    parser.add_argument('--diff-mode', type=str, choices=['content', 'keyed'], default='content',
+                        help='Stage 0 change detection: additive content diff, or snapshot diff keyed on '
+                             '(dataset, unique_id) that also detects modified and deleted records')
     return parser.parse_args()
 
 def setup_logging(stage):
@@ -70,25 +152,25 @@ def main():
         old_data_path = os.path.join(repo_root, data_dir, "old_uk_data.json")
         merged_data_path = os.path.join(repo_root, data_dir, "merged_uk_data.json")
         new_entries_path = os.path.join(repo_root, data_dir, "new_entries.json")
-        data_history_path = os.path.join(repo_root, data_dir, timestamp)
-        merged_data = stage0_check_new_data(
+        hash_index_path = os.path.join(repo_root, data_dir, "old_uk_data_hashes.txt")
+        data_history_path = os.path.join(repo_root, data_dir, "history")
+        # Save data history as deduplicated snapshots, before stage 0 appends to the
+        # old data (which is usually the same file as the merged data)
+        history_store = SnapshotStore(data_history_path)
+        history_store.save_file(timestamp, "old_uk_data", old_data_path)
+        history_store.save_file(timestamp, "uk_data", new_data_path)
+        stage0_check_new_data(
             new_data_path,
             old_data_path,
             merged_data_path,
-            new_entries_path
+            new_entries_path,
+            index_path=hash_index_path,
+            diff_mode=args.diff_mode
         )
-        with open(os.path.join(output_dir, 'stage0_merged_data.pkl'), 'wb') as f:
-            pickle.dump(merged_data, f)
-        # Save data history
-        os.makedirs(data_history_path, exist_ok=True)
-        # Copy the old uk data to history log
-        old_data_history_path = os.path.join(data_history_path, f"old_uk_data.json")
-        os.system(f"cp {old_data_path} {old_data_history_path}")
-        # Copy the new uk data to history log
-        new_data_history_path = os.path.join(data_history_path, f"uk_data.json")
-        os.system(f"cp {new_data_path} {new_data_history_path}")
+        merged_data = load_merged_data(merged_data_path, hash_index_path)
+        save_records(merged_data, os.path.join(output_dir, 'stage0_merged_data'))
         # Merged data becomes new old data
-        os.system(f"cp {merged_data_path} {old_data_path}")
+        replace_with_link(merged_data_path, old_data_path)
         logging.info("Stage 0 complete.")
 
     # ---------------------------
@@ -96,53 +178,65 @@ def main():
     # ---------------------------
     if stage <= 1:
         if stage == 1 and input_files:
-            with open(input_files[0], 'rb') as f:
-                merged_data = pickle.load(f)
-        else:
-            with open(os.path.join(output_dir, 'stage0_merged_data.pkl'), 'rb') as f:
-                merged_data = pickle.load(f)
-
-        preprocessed_data = stage1_load_and_preprocess_data(merged_data)
-        with open(os.path.join(output_dir, 'preprocessed_data.pkl'), 'wb') as f:
-            pickle.dump(preprocessed_data, f)
+            merged_data = load_records(input_files[0])
+        elif stage == 1:
+            merged_data = load_records(os.path.join(output_dir, 'stage0_merged_data'))
+
+        preprocessed_data = stage1_load_and_preprocess_data(merged_data, n_jobs=args.n_jobs)
+        if not args.no_canonicalise:
+            rules_path = args.canonical_rules or os.path.abspath(
+                os.path.join(__file__, '../../../../cfg/canonicalisation.yaml')
+            )
+            preprocessed_data = add_canonical_keys(preprocessed_data, load_canonicalisation_rules(rules_path))
+        save_records(preprocessed_data, os.path.join(output_dir, 'preprocessed_data'))
         logging.info("Stage 1 complete.")
 
     # ---------------------------
     # Stage 2: Identify identical names
     # ---------------------------
     if stage <= 2:
-        if stage == 2 and input_files:
-            with open(input_files[0], 'rb') as f:
-                preprocessed_data = pickle.load(f)
+        if stage == 2:
+            # Only the name keys are needed here; stage 3 reads the full records
+            preprocessed_path = input_files[0] if input_files else os.path.join(output_dir, 'preprocessed_data')
+            name_keys = load_records(preprocessed_path, columns=STAGE2_COLUMNS)
         else:
-            with open(os.path.join(output_dir, 'preprocessed_data.pkl'), 'rb') as f:
-                preprocessed_data = pickle.load(f)
+            name_keys = preprocessed_data
 
-        identical_name_groups = stage2_identify_identical_names(preprocessed_data)
-        with open(os.path.join(output_dir, 'identical_name_groups_stage2.json'), 'w') as f:
-            json.dump(identical_name_groups, f, indent=2)
+        # Groups are stored as row IDs into the preprocessed_data record table
+        identical_name_groups = stage2_identify_identical_names(name_keys, as_record_ids=True)
+        save_record_groups(
+            identical_name_groups, os.path.join(output_dir, 'identical_name_groups_stage2.json'), 'preprocessed_data'
+        )
         logging.info("Stage 2 complete.")
 
     # ---------------------------
     # Stage 3: Vectorize names
     # ---------------------------
     if stage <= 3:
-        if stage == 3 and input_files:
-            with open(input_files[0], 'rb') as f:
-                preprocessed_data = pickle.load(f)
-        else:
-            with open(os.path.join(output_dir, 'preprocessed_data.pkl'), 'rb') as f:
-                preprocessed_data = pickle.load(f)
-
-        vectorizer, name_vectors, unique_entries = stage3_vectorize_names(preprocessed_data)
+        if stage in (2, 3) and input_files:
+            preprocessed_data = load_records(input_files[0])
+        elif stage in (2, 3):
+            preprocessed_data = load_records(os.path.join(output_dir, 'preprocessed_data'))
+
+        vectorizer, name_vectors, unique_entries = stage3_vectorize_names(
+            preprocessed_data,
+            model_dir=args.tfidf_model_dir or os.path.join(output_dir, 'tfidf_model'),
+            incremental=args.data_mode == "new",
+            max_drift=args.tfidf_max_drift,
+            engine=args.vectorizer,
+            hashing_options={
+                "analyzer": args.hash_analyzer,
+                "ngram_range": tuple(args.hash_ngram_range),
+                "n_features": args.hash_features,
+                "use_idf": not args.hash_no_idf,
+            },
+            n_jobs=args.n_jobs
+        )
         with open(os.path.join(output_dir, 'vectorizer_stage3.pkl'), 'wb') as f:
             pickle.dump(vectorizer, f)
-        with open(os.path.join(output_dir, 'name_vectors_stage3.pkl'), 'wb') as f:
-            pickle.dump(name_vectors, f)
-        with open(os.path.join(output_dir, 'unique_entries_stage3.pkl'), 'wb') as f:
-            pickle.dump(unique_entries, f)
-        with open(os.path.join(output_dir, 'unique_entries_stage3.json'), 'w') as f:
-            json.dump(unique_entries, f, indent=2)
+        save_sparse_matrix(name_vectors, os.path.join(output_dir, 'name_vectors_stage3'))
+        save_records(unique_entries, os.path.join(output_dir, 'unique_entries_stage3'))
+        save_name_table(name_table_names(unique_entries), os.path.join(output_dir, 'name_table_stage3.json'))
         logging.info("Stage 3 complete.")
 
     # ---------------------------
@@ -152,20 +246,54 @@ def main():
         if stage == 4 and input_files:
             with open(input_files[0], 'rb') as f:
                 vectorizer = pickle.load(f)
-            with open(input_files[1], 'rb') as f:
-                name_vectors = pickle.load(f)
-            with open(input_files[2], 'rb') as f:
-                unique_entries = pickle.load(f)
-        else:
+            name_vectors = load_sparse_matrix(input_files[1])
+            unique_entries = load_records(input_files[2])
+            # Group artifacts refer to names by ID in the name table of these inputs
+            save_name_table(name_table_names(unique_entries), os.path.join(output_dir, 'name_table_stage3.json'))
+        elif stage == 4:
             with open(os.path.join(output_dir, 'vectorizer_stage3.pkl'), 'rb') as f:
                 vectorizer = pickle.load(f)
-            with open(os.path.join(output_dir, 'name_vectors_stage3.pkl'), 'rb') as f:
-                name_vectors = pickle.load(f)
-            with open(os.path.join(output_dir, 'unique_entries_stage3.pkl'), 'rb') as f:
-                unique_entries = pickle.load(f)
+            name_vectors = load_sparse_matrix(os.path.join(output_dir, 'name_vectors_stage3'))
+            unique_entries = load_records(os.path.join(output_dir, 'unique_entries_stage3'))
+
+        search_options = {
+            "n_neighbors": args.n_neighbors,
+            "engine": args.knn_engine,
+            "block_size": args.knn_block_size,
+            "n_jobs": args.n_jobs,
+            "lsh_options": {
+                "bands": args.lsh_bands,
+                "rows": args.lsh_rows,
+                "max_bucket_size": args.lsh_max_bucket,
+            },
+            "recall_sample": args.knn_recall_sample,
+            "blocking": args.blocking,
+            "blocking_options": {
+                "max_block_size": args.block_max_size,
+                "window": args.block_window,
+            },
+        }
+
+        if args.sweep_thresholds:
+            summaries = stage4_sweep_thresholds(
+                name_vectors, unique_entries, args.sweep_thresholds,
+                cache_dir=os.path.join(output_dir, 'neighbor_cache_stage4'),
+                new_data_only=args.data_mode == "new",
+                grouping=args.grouping, linkage=args.linkage, max_group_size=args.max_group_size,
+                **search_options
+            )
+            sweep_path = os.path.join(output_dir, 'threshold_sweep_stage4.json')
+            with open(sweep_path, 'w') as f:
+                json.dump(summaries, f, indent=2)
+            logging.info(f"Threshold sweep written to {sweep_path}. Exiting pipeline.")
+            sys.exit(0)
 
         grouped_names = stage4_group_similar_names(
-            vectorizer, name_vectors, unique_entries, threshold=args.threshold
+            vectorizer, name_vectors, unique_entries, threshold=args.threshold,
+            grouping=args.grouping, linkage=args.linkage, max_group_size=args.max_group_size,
+            index_dir=os.path.join(output_dir, 'neighbor_index_stage4'),
+            incremental=args.data_mode == "new",
+            **search_options
         )
 
         # For new data, filter groups to only include those with new entries;
@@ -176,38 +304,52 @@ def main():
                 items = group_info["items"]
                 if any(item.get("is_new", False) for item in items):
                     new_data_groups[rep_name] = group_info
-            logging.info(f"Created {len(new_data_groups)} groups with new data.")
+            num_modified = sum(1 for entry in unique_entries if entry.get("change_type") == "modified")
+            logging.info(f"Created {len(new_data_groups)} groups with new data "
+                         f"({num_modified} modified entries in the data).")
             if len(new_data_groups) == 0:
                 logging.info("No groups contain new data. Exiting pipeline.")
                 sys.exit(0)
             grouped_names_stage4_path = os.path.join(output_dir, 'grouped_names_stage4_new_data_only.json')
-            with open(grouped_names_stage4_path, 'w') as f:
-                json.dump(new_data_groups, f, indent=2)
+            save_name_groups(new_data_groups, name_table_names(unique_entries), grouped_names_stage4_path)
         else:
             grouped_names_stage4_path = os.path.join(output_dir, 'grouped_names_stage4_all_data.json')
-            with open(grouped_names_stage4_path, 'w') as f:
-                json.dump(grouped_names, f, indent=2)
+            save_name_groups(grouped_names, name_table_names(unique_entries), grouped_names_stage4_path)
         logging.info("Stage 4 complete.")
 
     # ---------------------------
     # Stage 5: Perform web search
     # ---------------------------
     if stage <= 5:
+        name_table_path = os.path.join(output_dir, 'name_table_stage3.json')
         if stage == 5 and input_files:
-            with open(input_files[0], 'r') as f:
-                grouped_names = json.load(f)
+            grouped_names = load_name_groups(input_files[0], name_table_path)
         else:
-            with open(grouped_names_stage4_path, 'r') as f:
-                grouped_names = json.load(f)
-            with open(os.path.join(output_dir, 'unique_entries_stage3.json'), 'r') as f:
-                unique_entries = json.load(f)
+            grouped_names = load_name_groups(grouped_names_stage4_path, name_table_path)
+            unique_entries = load_records(os.path.join(output_dir, 'unique_entries_stage3'), columns=STAGE5_COLUMNS)
+
+        backend_options = {}
+        if args.search_method == 'fixture':
+            backend_options = {
+                "corpus_path": args.search_fixture,
+                "latency": args.search_fixture_latency,
+                "jitter": 0.5,
+                "error_rate": args.search_fixture_error_rate,
+                "throttle_rate": args.search_fixture_throttle_rate,
+                "rate_limit": args.search_fixture_rate_limit,
+            }
 
         all_web_results = stage5_perform_web_search(
             grouped_names,
             unique_entries,
             search_method=args.search_method,
             num_results=args.num_search_results,
-            output_dir=output_dir
+            output_dir=output_dir,
+            rate_per_minute=args.search_rate,
+            max_concurrency=args.search_concurrency,
+            ttl_days=args.search_ttl_days,
+            backend_options=backend_options,
+            adaptive=not args.search_fixed_rate
         )
 
         sub_db = all_web_results.get(args.search_method, {})
@@ -220,18 +362,20 @@ def main():
     # ---------------------------
     if stage <= 6:
         refined_groups_out = os.path.join(output_dir, 'refined_groups_stage6.json')
+        name_table_path = os.path.join(output_dir, 'name_table_stage3.json')
         if stage == 6 and input_files:
-            with open(input_files[0], 'r') as f:
-                grouped_names = json.load(f)
+            grouped_names = load_name_groups(input_files[0], name_table_path)
             with open(input_files[1], 'r') as f:
                 method_sub_db = json.load(f)
         else:
             if args.data_mode == "new":
-                with open(os.path.join(output_dir, 'grouped_names_stage4_new_data_only.json'), 'r') as f:
-                    grouped_names = json.load(f)
+                grouped_names = load_name_groups(
+                    os.path.join(output_dir, 'grouped_names_stage4_new_data_only.json'), name_table_path
+                )
             else:
-                with open(os.path.join(output_dir, 'grouped_names_stage4_all_data.json'), 'r') as f:
-                    grouped_names = json.load(f)
+                grouped_names = load_name_groups(
+                    os.path.join(output_dir, 'grouped_names_stage4_all_data.json'), name_table_path
+                )
             with open(os.path.join(output_dir, 'web_search_results_stage5.json'), 'r') as f:
                 method_sub_db = json.load(f)
 
@@ -278,10 +422,7 @@ def main():
             groups_with_types = json.load(f)
         with open(os.path.join(output_dir, 'web_search_results_stage5.json'), 'r') as f:
             method_sub_db = json.load(f)
-        with open(os.path.join(output_dir, 'identical_name_groups_stage2.json'), 'r') as f:
-            identical_name_groups = json.load(f)
-        with open(os.path.join(output_dir, 'unique_entries_stage3.json'), 'r') as f:
-            unique_entries = json.load(f)
+        unique_entries = load_records(os.path.join(output_dir, 'unique_entries_stage3'), columns=LOOKUP_COLUMNS)
 
         formatted_groups = stage9_finalize_groups(
             groups_with_types, method_sub_db, unique_entries
@@ -302,8 +443,7 @@ def main():
             formatted_groups = json.load(f)
         with open(os.path.join(output_dir, 'web_search_results_stage5.json'), 'r') as f:
             method_sub_db = json.load(f)
-        with open(os.path.join(output_dir, 'unique_entries_stage3.json'), 'r') as f:
-            unique_entries = json.load(f)
+        unique_entries = load_records(os.path.join(output_dir, 'unique_entries_stage3'), columns=LOOKUP_COLUMNS)
 
         refined_groups = stage10_refine_groups_with_llm(formatted_groups, method_sub_db, unique_entries)
         refined_groups_path = os.path.join(output_dir, 'refined_groups_stage10.json')
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+except ImportError:
+    pa = None
+    logger.warning("pyarrow not available; record tables will be stored as pickles.")
+
+RECORDS_EXT = ".arrow"
+PICKLE_EXT = ".pkl"
+
+def _resolve(path, extensions):
+    """Return `path` if it exists, else the first existing `path + ext`, else None."""
+    if os.path.exists(path):
+        return path
+    for ext in extensions:
+        if os.path.exists(path + ext):
+            return path + ext
+    return None
+
+def save_records(records, base_path):
+    """
+    Save a list of record dicts as a columnar Arrow IPC file at `base_path.arrow`.
+    There is a column for every field of any record; records without a field load with
+    None for it. Falls back to `base_path.pkl` if pyarrow is missing or the records
+    cannot be typed as columns (e.g. a field mixing ints and strings). Returns the path
+    written.
+    """
+    if pa is not None:
+        try:
+            table = _records_table(records)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logger.warning(f"Could not store {base_path} as a columnar table ({e}); using pickle.")
+        else:
+            path = base_path + RECORDS_EXT
+            with pa.OSFile(path, 'wb') as sink:
+                with pa_ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            _remove_stale(base_path, keep=path)
+            return path
+
+    path = base_path + PICKLE_EXT
+    with open(path, 'wb') as f:
+        pickle.dump(records, f)
+    _remove_stale(base_path, keep=path)
+    return path
+
+def _records_table(records):
+    # Table.from_pylist takes its columns from the first record only
+    columns = dict.fromkeys(name for record in records for name in record)
+    return pa.Table.from_pydict({name: [record.get(name) for record in records] for name in columns})
+
+def _remove_stale(base_path, keep):
+    # Avoid a restart picking up an out-of-date artifact in the other format
+    for ext in (RECORDS_EXT, PICKLE_EXT):
+        other = base_path + ext
+        if other != keep and os.path.exists(other):
+            os.remove(other)
+
+def load_record_table(path):
+    """Memory-map an Arrow IPC record table without deserialising it."""
+    source = pa.memory_map(path, 'r')
+    return pa_ipc.open_file(source).read_all()
+
+def load_records(path, columns=None):
+    """
+    Load a list of record dicts from `path`, which may be an Arrow file, a pickle or a
+    JSON file, or a base path saved with `save_records`.
+
+    With `columns`, the dicts hold only those fields (any the records lack are left
+    out). For an Arrow file only those columns are read from the memory map and
+    converted, which is much cheaper than materialising whole records; stages that
+    need a few fields should pass them.
+    """
+    resolved = _resolve(path, (RECORDS_EXT, PICKLE_EXT))
+    if resolved is None:
+        raise FileNotFoundError(f"No record artifact found at {path}")
+    if resolved.endswith(RECORDS_EXT):
+        table = load_record_table(resolved)
+        if columns is not None:
+            table = table.select([name for name in columns if name in table.column_names])
+        return table.to_pylist()
+    if resolved.endswith(".json"):
+        with open(resolved, 'r') as f:
+            records = json.load(f)
+    else:
+        with open(resolved, 'rb') as f:
+            records = pickle.load(f)
+    if columns is not None:
+        records = [{name: record[name] for name in columns if name in record} for record in records]
+    return records
+
+def save_sparse_matrix(matrix, dir_path):
+    """
+    Save a sparse matrix as CSR component arrays (`data.npy`, `indices.npy`, `indptr.npy`)
+    plus `shape.json` in `dir_path`, so it can be memory-mapped on load.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    os.makedirs(dir_path, exist_ok=True)
+    for name, array in (("data", matrix.data), ("indices", matrix.indices), ("indptr", matrix.indptr)):
+        save_array(array, os.path.join(dir_path, f"{name}.npy"))
+    with open(os.path.join(dir_path, "shape.json"), 'w') as f:
+        json.dump(list(matrix.shape), f)
+    return dir_path
+
+def save_array(array, path):
+    """
+    Save a numpy array to `path` via a temporary file, so existing memory maps of the
+    previous version stay valid while it is replaced.
+    """
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+    return path
+
+def load_sparse_matrix(path, mmap=True):
+    """
+    Load a CSR matrix saved with `save_sparse_matrix` (memory-mapped by default).
+    A pickled matrix (legacy `.pkl` artifact) is also accepted.
+    """
+    resolved = _resolve(path, (PICKLE_EXT,))
+    if resolved is None:
+        raise FileNotFoundError(f"No matrix artifact found at {path}")
+    if not os.path.isdir(resolved):
+        with open(resolved, 'rb') as f:
+            return pickle.load(f)
+
+    mmap_mode = 'r' if mmap else None
+    data = np.load(os.path.join(resolved, "data.npy"), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(resolved, "indices.npy"), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(resolved, "indptr.npy"), mmap_mode=mmap_mode)
+    with open(os.path.join(resolved, "shape.json"), 'r') as f:
+        shape = tuple(json.load(f))
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
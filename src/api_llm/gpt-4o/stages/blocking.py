@@ -0,0 +1,110 @@
+import logging
+import re
+from collections import defaultdict
+import numpy as np
+from stages.knn import bucket_pairs
+
+logger = logging.getLogger(__name__)
+
+BLOCKING_STRATEGIES = ("postcode", "tokens", "sorted")
+
+POSTCODE_RE = re.compile(r'^([A-Z]{1,2}[0-9][0-9A-Z]?)\s*([0-9][A-Z]{2})$')
+
+def outward_code(postcode):
+    """
+    Outward code of a UK postcode ("SW1A 1AA" -> "SW1A"), or None if `postcode`
+    does not look like one.
+    """
+    if not postcode:
+        return None
+    match = POSTCODE_RE.match(str(postcode).strip().upper())
+    return match.group(1) if match else None
+
+def postcode_blocks(all_names, name_to_items):
+    """
+    Blocks of name rows sharing an outward postcode code. A name with records in several
+    areas joins each of their blocks. Returns (blocks, rows without any valid postcode).
+    """
+    blocks = defaultdict(list)
+    no_postcode = []
+    for row, name in enumerate(all_names):
+        codes = {outward_code(item.get("postcode")) for item in name_to_items[name]} - {None}
+        if not codes:
+            no_postcode.append(row)
+        for code in codes:
+            blocks[code].append(row)
+    return list(blocks.values()), np.asarray(no_postcode, dtype=np.int64)
+
+def token_blocks(all_names, max_block_size=1000):
+    """
+    Blocks of name rows sharing a rare token, i.e. one used by at most `max_block_size`
+    names. Common tokens ("ltd", "university") would make blocks too large to be useful.
+    """
+    blocks = defaultdict(list)
+    for row, name in enumerate(all_names):
+        for token in set(name.split()):
+            blocks[token].append(row)
+    return [rows for rows in blocks.values() if len(rows) <= max_block_size]
+
+def sorted_neighbourhood_pairs(all_names, window=5):
+    """Pairs of names within `window` positions of each other in sorted order."""
+    order = np.argsort(np.asarray(all_names, dtype=object), kind='stable').astype(np.int64)
+    left, right = [], []
+    for offset in range(1, window):
+        left.append(order[:-offset])
+        right.append(order[offset:])
+    if not left:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    left, right = np.concatenate(left), np.concatenate(right)
+    return np.minimum(left, right), np.maximum(left, right)
+
+def blocking_candidate_pairs(all_names, name_to_items, strategies=("postcode",), max_block_size=1000, window=5):
+    """
+    Candidate pairs of name rows (indices into `all_names`) under the given blocking
+    strategies, unioned:
+      - "postcode": names sharing an outward postcode code. Names with no valid
+        postcode fall back to rare-token blocks (pairs involving them only).
+      - "tokens": names sharing a rare token.
+      - "sorted": sorted-neighbourhood windows of `window` names.
+    Returns two int64 arrays (i, j) with i < j and no duplicate pairs.
+    """
+    unknown = set(strategies) - set(BLOCKING_STRATEGIES)
+    if unknown:
+        raise ValueError(f"Unknown blocking strategies: {sorted(unknown)}")
+
+    n_rows = len(all_names)
+    lefts, rights = [], []
+    if "postcode" in strategies:
+        blocks, no_postcode = postcode_blocks(all_names, name_to_items)
+        left, right = bucket_pairs(blocks, n_rows, max_bucket_size=max_block_size, label="postcode blocks")
+        lefts.append(left)
+        rights.append(right)
+        logger.info(f"{len(no_postcode)} of {n_rows} names have no valid postcode; using token blocks for them.")
+        if len(no_postcode) and "tokens" not in strategies:
+            left, right = bucket_pairs(token_blocks(all_names, max_block_size), n_rows, label="token blocks")
+            fallback = np.zeros(n_rows, dtype=bool)
+            fallback[no_postcode] = True
+            keep = fallback[left] | fallback[right]
+            lefts.append(left[keep])
+            rights.append(right[keep])
+    if "tokens" in strategies:
+        left, right = bucket_pairs(token_blocks(all_names, max_block_size), n_rows, label="token blocks")
+        lefts.append(left)
+        rights.append(right)
+    if "sorted" in strategies:
+        left, right = sorted_neighbourhood_pairs(all_names, window)
+        lefts.append(left)
+        rights.append(right)
+
+    if not lefts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    keys = np.unique(np.concatenate(lefts) * n_rows + np.concatenate(rights))
+    left, right = keys // n_rows, keys % n_rows
+    all_pairs = n_rows * (n_rows - 1) // 2
+    logger.info(
+        f"Blocking ({', '.join(strategies)}) kept {len(left)} of {all_pairs} name pairs "
+        f"({100.0 * len(left) / max(all_pairs, 1):.2f}%)."
+    )
+    return left, right
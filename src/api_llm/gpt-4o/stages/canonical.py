@@ -0,0 +1,69 @@
+import logging
+import os
+import unicodedata
+import yaml
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {
+    "fold_unicode": True,
+    "strip_prefixes": ["the"],
+    "abbreviations": {},
+    "legal_suffixes": ["ltd", "limited", "plc", "llp", "inc"],
+}
+
+def load_canonicalisation_rules(rules_path=None):
+    """
+    Load canonicalisation rules from a YAML file, falling back to DEFAULT_RULES
+    for any missing keys (or entirely, if the file does not exist).
+    """
+    rules = dict(DEFAULT_RULES)
+    if rules_path and os.path.exists(rules_path):
+        with open(rules_path, 'r', encoding='utf-8') as f:
+            rules.update(yaml.safe_load(f) or {})
+        logger.info(f"Loaded canonicalisation rules from {rules_path}")
+    else:
+        logger.info("Using default canonicalisation rules.")
+    return rules
+
+def fold_unicode(text):
+    """Strip accents and fold compatibility characters to their plain equivalents."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+class Canonicaliser:
+    """Folds a preprocessed 'combined_name' into a canonical key according to the rules."""
+
+    def __init__(self, rules):
+        self.fold = rules.get("fold_unicode", True)
+        self.prefixes = set(rules.get("strip_prefixes") or [])
+        self.abbreviations = dict(rules.get("abbreviations") or {})
+        self.suffixes = set(rules.get("legal_suffixes") or [])
+        self._cache = {}
+
+    def __call__(self, name):
+        key = self._cache.get(name)
+        if key is None:
+            key = self._canonicalise(name)
+            self._cache[name] = key
+        return key
+
+    def _canonicalise(self, name):
+        text = fold_unicode(name) if self.fold else name
+        tokens = [self.abbreviations.get(tok, tok) for tok in text.split()]
+        # Always keep at least one token so a bare "the" or "limited" keeps a key
+        while len(tokens) > 1 and tokens[0] in self.prefixes:
+            tokens.pop(0)
+        while len(tokens) > 1 and tokens[-1] in self.suffixes:
+            tokens.pop()
+        return ' '.join(tokens)
+
+def add_canonical_keys(preprocessed_data, rules):
+    """Add a 'canonical_key' field to every preprocessed entry (in place) and return the data."""
+    canonicalise = Canonicaliser(rules)
+    for entry in preprocessed_data:
+        entry["canonical_key"] = canonicalise(entry["combined_name"])
+    num_names = len({entry["combined_name"] for entry in preprocessed_data})
+    num_keys = len({entry["canonical_key"] for entry in preprocessed_data})
+    logger.info(f"Canonicalised {num_names} distinct names into {num_keys} canonical keys.")
+    return preprocessed_data
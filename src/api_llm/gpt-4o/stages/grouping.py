@@ -0,0 +1,213 @@
+import logging
+import numpy as np
+from scipy import sparse
+from scipy.cluster import hierarchy
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import squareform
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger(__name__)
+
+LINKAGES = ("single", "average", "complete")
+
+# Default cap on the names in one group: every group becomes a single stage 6 prompt
+MAX_GROUP_SIZE = 50
+
+def similarity_graph(distances, indices, threshold):
+    """
+    Symmetric sparse graph of name rows joined by a kNN edge within `threshold`.
+    Edge weights are cosine similarities (floored at a tiny positive value so that
+    orthogonal-but-within-threshold pairs are not dropped as explicit zeros).
+    """
+    n_rows = indices.shape[0]
+    rows = np.repeat(np.arange(n_rows), indices.shape[1])
+    cols = indices.ravel()
+    dists = distances.ravel()
+    keep = (dists <= threshold) & (cols != rows)
+    weights = np.maximum(1.0 - dists[keep], 1e-12)
+    graph = sparse.csr_matrix((weights, (rows[keep], cols[keep])), shape=(n_rows, n_rows))
+    # kNN is not symmetric; an edge found from either side counts
+    return graph.maximum(graph.T).tocsr()
+
+def _split_component(members, name_vectors, names, threshold, linkage):
+    """
+    Cluster one connected component with hierarchical `linkage` on exact pairwise cosine
+    distances, cutting at `threshold`. Returns a cluster label per member.
+    """
+    # Order members by name so the result does not depend on input order
+    order = np.argsort(np.asarray([names[m] for m in members], dtype=object), kind='stable')
+    ordered = members[order]
+    vectors = normalize(name_vectors[ordered], norm='l2')
+    dist = np.clip(1.0 - (vectors @ vectors.T).toarray(), 0.0, None)
+    np.fill_diagonal(dist, 0.0)
+    tree = hierarchy.linkage(squareform(dist, checks=False), method=linkage)
+    clusters = hierarchy.fcluster(tree, t=threshold, criterion='distance')
+    labels = np.empty(len(members), dtype=np.int64)
+    labels[order] = clusters
+    return labels
+
+def _shrink_component(members, graph, max_size):
+    """
+    Split an oversized component by dropping its weakest edges, at increasing similarity
+    quantiles, until no piece exceeds `max_size` names (or the quantiles run out).
+    Returns a piece label per member.
+    """
+    sub = graph[members][:, members].tocsr()
+    labels = np.zeros(len(members), dtype=np.int64)
+    for level in np.quantile(sub.data, np.linspace(0.1, 0.9, 9)):
+        pruned = sub.copy()
+        pruned.data[pruned.data < level] = 0
+        pruned.eliminate_zeros()
+        _, labels = connected_components(pruned, directed=False)
+        if np.bincount(labels).max() <= max_size:
+            break
+    return labels
+
+def _capped_single_linkage(members, graph, name_rank, max_size):
+    """
+    Single linkage over the graph edges among `members` that never builds a cluster of
+    more than `max_size` names: edges are taken strongest first (ties in name order),
+    and an edge joining two clusters is skipped if the merged cluster would be too
+    large. Returns a cluster label per member.
+    """
+    sub = graph[members][:, members].tocoo()
+    upper = sub.row < sub.col
+    rows, cols, weights = sub.row[upper], sub.col[upper], sub.data[upper]
+    ranks = name_rank[members]
+    lo, hi = np.minimum(ranks[rows], ranks[cols]), np.maximum(ranks[rows], ranks[cols])
+    order = np.lexsort((hi, lo, -weights))
+
+    parent = np.arange(len(members))
+    size = np.ones(len(members), dtype=np.int64)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for edge in order:
+        a, b = find(rows[edge]), find(cols[edge])
+        if a != b and size[a] + size[b] <= max_size:
+            if size[a] < size[b]:
+                a, b = b, a
+            parent[b] = a
+            size[a] += size[b]
+    return np.array([find(i) for i in range(len(members))], dtype=np.int64)
+
+def _cap_group_sizes(labels, graph, names, max_group_size):
+    """Re-split every group larger than `max_group_size` with `_capped_single_linkage`."""
+    sizes = np.bincount(labels)
+    oversized = np.flatnonzero(sizes > max_group_size)
+    if len(oversized) == 0:
+        return labels
+    name_rank = np.empty(len(names), dtype=np.int64)
+    name_rank[np.argsort(np.asarray(names, dtype=object), kind='stable')] = np.arange(len(names))
+    labels = labels.copy()
+    next_label = labels.max() + 1
+    for label in oversized:
+        members = np.flatnonzero(labels == label)
+        clusters = _capped_single_linkage(members, graph, name_rank, max_group_size)
+        labels[members] = next_label + clusters
+        next_label += clusters.max() + 1
+    logger.info(
+        f"Split {len(oversized)} groups larger than {max_group_size} names (largest: {sizes.max()}) "
+        f"at their weakest edges."
+    )
+    return labels
+
+def graph_group_labels(distances, indices, threshold, names, linkage="single",
+                       name_vectors=None, max_component_size=5000, max_group_size=MAX_GROUP_SIZE):
+    """
+    Group label for every name row, from the thresholded kNN graph.
+
+    linkage:
+      - "single": connected components of the graph.
+      - "average" / "complete": each component is further split by hierarchical
+        clustering on exact cosine distances (requires `name_vectors`); "complete"
+        bounds the diameter of every group by `threshold`. To bound memory, components
+        larger than `max_component_size` are first cut at their weakest edges, and any
+        piece still too large is left to the size cap below.
+
+    Connected components can chain through near neighbours into one huge group, so with
+    any linkage a group of more than `max_group_size` names is split again by single
+    linkage that refuses merges past the cap (`_capped_single_linkage`); no group
+    exceeds `max_group_size`. Pass None to disable the cap.
+
+    Returns (labels, graph).
+    """
+    if linkage not in LINKAGES:
+        raise ValueError(f"Unknown linkage: {linkage}")
+    graph = similarity_graph(distances, indices, threshold)
+    n_components, labels = connected_components(graph, directed=False)
+    if linkage == "single":
+        if max_group_size:
+            labels = _cap_group_sizes(labels, graph, names, max_group_size)
+        return labels, graph
+    if name_vectors is None:
+        raise ValueError(f"{linkage} linkage needs the name vectors")
+
+    name_vectors = sparse.csr_matrix(name_vectors)
+    sizes = np.bincount(labels, minlength=n_components)
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    new_labels = labels.copy()
+    next_label = n_components
+    too_large = 0
+    for component in np.flatnonzero(sizes > 1):
+        component_members = order[starts[component]:starts[component + 1]]
+        if sizes[component] > max_component_size:
+            pieces = _shrink_component(component_members, graph, max_component_size)
+        else:
+            pieces = np.zeros(len(component_members), dtype=np.int64)
+        for piece in np.unique(pieces):
+            members = component_members[pieces == piece]
+            if len(members) > max_component_size:
+                too_large += 1
+                clusters = np.zeros(len(members), dtype=np.int64)
+            elif len(members) > 1:
+                clusters = _split_component(members, name_vectors, names, threshold, linkage)
+            else:
+                clusters = np.zeros(1, dtype=np.int64)
+            # Offset so labels stay unique across components
+            new_labels[members] = next_label + clusters
+            next_label += clusters.max() + 1
+    if too_large:
+        logger.warning(
+            f"{too_large} components still exceed {max_component_size} names after pruning weak edges; "
+            f"kept them as single-linkage groups."
+        )
+    if max_group_size:
+        new_labels = _cap_group_sizes(new_labels, graph, names, max_group_size)
+    return new_labels, graph
+
+def groups_from_labels(labels, graph, names, keep_singletons=None):
+    """
+    Turn per-row group labels into [(representative_row, member_rows)] for groups of
+    two or more names, and for single names whose row is set in the boolean array
+    `keep_singletons` (if given). The representative is the member with the most edges inside
+    its group, ties broken by the alphabetically first name. Members are sorted by
+    name and groups by representative name, so output is independent of input order.
+    """
+    n_rows = len(labels)
+    if n_rows == 0:
+        return []
+    # Degree counting only edges that stay inside the group
+    coo = graph.tocoo()
+    inside = labels[coo.row] == labels[coo.col]
+    degree = np.bincount(coo.row[inside], minlength=n_rows)
+    name_rank = np.empty(n_rows, dtype=np.int64)
+    name_rank[np.argsort(np.asarray(names, dtype=object), kind='stable')] = np.arange(n_rows)
+
+    # Within each label: highest degree first, then alphabetical
+    order = np.lexsort((name_rank, -degree, labels))
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    groups = []
+    for members in np.split(order, boundaries):
+        if len(members) < 2 and (keep_singletons is None or not keep_singletons[members[0]]):
+            continue
+        representative = members[0]
+        others = sorted(members[1:], key=lambda m: name_rank[m])
+        groups.append((representative, others))
+    groups.sort(key=lambda group: name_rank[group[0]])
+    return groups
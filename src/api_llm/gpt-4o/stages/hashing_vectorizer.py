@@ -0,0 +1,95 @@
+import logging
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger(__name__)
+
+def _hash_chunk(hasher, names):
+    return hasher.transform(names)
+
+class ChunkedHashingVectorizer:
+    """
+    Vocabulary-free alternative to TfidfVectorizer for stage 3.
+
+    Names are feature-hashed in fixed-size chunks (optionally across processes), so
+    memory does not depend on the vocabulary size. IDF weights, if enabled, are kept
+    sparsely: the document frequencies of the hashed columns that occur in the fitted
+    names (`df_columns_`, `df_counts_`) plus `n_samples_`, so the fitted (and pickled)
+    vectorizer grows with the distinct features seen rather than with `n_features`.
+    Output rows are L2-normalised like TfidfVectorizer's, so stage 4 treats both alike.
+    """
+
+    def __init__(self, analyzer='word', ngram_range=(1, 1), n_features=2 ** 20,
+                 use_idf=True, chunk_size=50_000, n_jobs=1):
+        self.analyzer = analyzer
+        self.ngram_range = tuple(ngram_range)
+        self.n_features = n_features
+        self.use_idf = use_idf
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.n_samples_ = None
+        self.df_columns_ = None
+        self.df_counts_ = None
+
+    def _hasher(self):
+        return HashingVectorizer(
+            analyzer=self.analyzer,
+            ngram_range=self.ngram_range,
+            n_features=self.n_features,
+            alternate_sign=False,
+            norm=None,
+        )
+
+    def _hash(self, names):
+        hasher = self._hasher()
+        chunks = [names[i:i + self.chunk_size] for i in range(0, len(names), self.chunk_size)]
+        if self.n_jobs > 1 and len(chunks) > 1:
+            counts = Parallel(n_jobs=self.n_jobs)(delayed(_hash_chunk)(hasher, chunk) for chunk in chunks)
+        else:
+            counts = [hasher.transform(chunk) for chunk in chunks]
+        return counts or [sparse.csr_matrix((0, self.n_features))]
+
+    def _idf(self, columns):
+        """Smoothed IDF of each of `columns`, as in TfidfVectorizer(smooth_idf=True)."""
+        position = np.searchsorted(self.df_columns_, columns)
+        position = np.minimum(position, max(len(self.df_columns_) - 1, 0))
+        document_frequency = np.zeros(len(columns), dtype=np.float64)
+        if len(self.df_columns_):
+            seen = self.df_columns_[position] == columns
+            document_frequency[seen] = self.df_counts_[position[seen]]
+        return np.log((1 + self.n_samples_) / (1 + document_frequency)) + 1
+
+    def _weight(self, counts):
+        matrix = sparse.vstack(counts, format='csr')
+        if self.use_idf:
+            matrix = matrix.astype(np.float64)
+            matrix.data *= self._idf(matrix.indices)
+        return normalize(matrix, norm='l2', copy=False)
+
+    def fit_transform(self, names):
+        counts = self._hash(names)
+        if self.use_idf:
+            # Each hashed row lists a column once, so column occurrences are document counts
+            columns, document_counts = np.unique(
+                np.concatenate([chunk.indices for chunk in counts]), return_counts=True
+            )
+            self.n_samples_ = len(names)
+            self.df_columns_ = columns.astype(np.int64)
+            self.df_counts_ = document_counts.astype(np.int64)
+        logger.info(
+            f"Hashed {len(names)} names into {self.n_features} features "
+            f"({self.analyzer}, ngram_range={self.ngram_range})."
+        )
+        return self._weight(counts)
+
+    def fit(self, names):
+        self.fit_transform(names)
+        return self
+
+    def transform(self, names):
+        if self.use_idf and self.n_samples_ is None:
+            raise ValueError("ChunkedHashingVectorizer must be fitted before transform when use_idf=True.")
+        return self._weight(self._hash(names))
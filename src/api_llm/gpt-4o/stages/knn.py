@@ -0,0 +1,269 @@
+import logging
+import time
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger(__name__)
+
+def _top_k_rows(sims, row_ids, n_neighbors):
+    """
+    Rank the stored similarities of each row of the CSR matrix `sims` and keep the top k,
+    ordered by (-similarity, column index) so equal scores always come out in the same
+    order. Rows with fewer than k entries are padded with their own id (`row_ids`) at
+    distance inf.
+    """
+    n_rows = sims.shape[0]
+    indices = np.repeat(np.asarray(row_ids)[:, None], n_neighbors, axis=1)
+    similarities = np.full((n_rows, n_neighbors), -np.inf)
+    for r in range(n_rows):
+        lo, hi = sims.indptr[r], sims.indptr[r + 1]
+        if lo == hi:
+            continue
+        cols = sims.indices[lo:hi]
+        vals = sims.data[lo:hi]
+        # Highest similarity first; ties broken by the lower index. sklearn's brute force
+        # does not promise an order for ties, so tied neighbours may differ in order from it
+        order = np.lexsort((cols, -vals))[:n_neighbors]
+        indices[r, :len(order)] = cols[order]
+        similarities[r, :len(order)] = vals[order]
+
+    distances = np.where(np.isinf(similarities), np.inf, np.clip(1.0 - similarities, 0.0, None))
+    return distances, indices
+
+def _prune(sims, min_similarity):
+    sims = sims.tocsr()
+    if min_similarity > 0:
+        sims.data[sims.data < min_similarity] = 0
+        sims.eliminate_zeros()
+    return sims
+
+def _min_similarity(threshold):
+    # Small tolerance so pairs exactly at the threshold survive floating point error
+    return 1.0 - threshold - 1e-9 if threshold is not None else 0.0
+
+def _normalize(X):
+    return normalize(sparse.csr_matrix(X, dtype=np.float64), norm='l2', copy=True)
+
+def _block_kneighbors(X, XT, start, stop, n_neighbors, min_similarity):
+    """
+    Top-k cosine neighbours of rows [start, stop) of X against all rows of X.
+    Similarities below `min_similarity` are pruned before ranking.
+    """
+    sims = _prune(X[start:stop] @ XT, min_similarity)
+    return _top_k_rows(sims, np.arange(start, stop), n_neighbors)
+
+def blockwise_kneighbors(X, n_neighbors=10, threshold=None, block_size=1024, n_jobs=1):
+    """
+    Cosine k-nearest neighbours of every row of the sparse matrix X, computed one block
+    of `block_size` rows at a time with a sparse matrix product, so memory is bounded by
+    the block rather than by the full n x n similarity matrix.
+
+    If `threshold` (a cosine distance) is given, neighbours further away are dropped
+    before ranking; their slots are padded with the row itself at distance inf.
+
+    Returns (distances, indices) of shape (n_rows, n_neighbors), sorted by increasing
+    distance, matching `NearestNeighbors.kneighbors`.
+    """
+    X = _normalize(X)
+    n_rows = X.shape[0]
+    n_neighbors = min(n_neighbors, n_rows)
+    XT = X.T.tocsr()
+    min_similarity = _min_similarity(threshold)
+
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+    if n_jobs == 1 or len(blocks) <= 1:
+        results = [
+            _block_kneighbors(X, XT, start, stop, n_neighbors, min_similarity)
+            for start, stop in blocks
+        ]
+    else:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_block_kneighbors)(X, XT, start, stop, n_neighbors, min_similarity)
+            for start, stop in blocks
+        )
+
+    if not results:
+        return np.empty((0, n_neighbors)), np.empty((0, n_neighbors), dtype=np.int64)
+    distances = np.vstack([d for d, _ in results])
+    indices = np.vstack([i for _, i in results])
+    logger.info(f"Computed {n_neighbors} nearest neighbours for {n_rows} rows in {len(blocks)} blocks.")
+    return distances, indices
+
+def query_kneighbors(X, query_rows, n_neighbors=10, threshold=None, block_size=1024):
+    """
+    Cosine k-nearest neighbours of the rows `query_rows` of X against all rows of X,
+    in blocks as in `blockwise_kneighbors`.
+
+    Returns (distances, indices, similarities): the first two for the query rows only,
+    and the threshold-pruned sparse similarities (len(query_rows) x n_rows) from which
+    they were ranked, so callers can also patch the neighbour lists of other rows.
+    """
+    X = _normalize(X)
+    n_neighbors = min(n_neighbors, X.shape[0])
+    XT = X.T.tocsr()
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+    min_similarity = _min_similarity(threshold)
+
+    distances, indices, similarities = [], [], []
+    for start in range(0, len(query_rows), block_size):
+        rows = query_rows[start:start + block_size]
+        sims = _prune(X[rows] @ XT, min_similarity)
+        d, i = _top_k_rows(sims, rows, n_neighbors)
+        distances.append(d)
+        indices.append(i)
+        similarities.append(sims)
+    if not distances:
+        empty = sparse.csr_matrix((0, X.shape[0]))
+        return np.empty((0, n_neighbors)), np.empty((0, n_neighbors), dtype=np.int64), empty
+    return np.vstack(distances), np.vstack(indices), sparse.vstack(similarities, format='csr')
+
+# Mersenne prime used by the universal hash family of the MinHash permutations
+MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_signatures(X, num_perm=96, seed=0):
+    """
+    MinHash signature of each row of the sparse matrix X, treating the row as the set
+    of its nonzero features (the word or character shingles vectorized in stage 3).
+    Returns an (n_rows, num_perm) int64 array; empty rows get MINHASH_PRIME everywhere.
+    """
+    X = sparse.csr_matrix(X)
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=num_perm).astype(np.int64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_perm).astype(np.int64)
+
+    n_rows = X.shape[0]
+    signatures = np.full((n_rows, num_perm), MINHASH_PRIME, dtype=np.int64)
+    row_lengths = np.diff(X.indptr)
+    non_empty = row_lengths > 0
+    if not non_empty.any():
+        return signatures
+    features = X.indices.astype(np.int64) % MINHASH_PRIME
+    starts = X.indptr[:-1][non_empty]
+    for p in range(num_perm):
+        hashed = (a[p] * features + b[p]) % MINHASH_PRIME
+        signatures[non_empty, p] = np.minimum.reduceat(hashed, starts)
+    return signatures
+
+def lsh_candidate_pairs(signatures, bands=32, rows=3, max_bucket_size=500):
+    """
+    Banded LSH over MinHash signatures: rows sharing all `rows` values of any band land
+    in the same bucket and become candidate pairs. Buckets larger than `max_bucket_size`
+    (typically very common shingles) are skipped to keep the pair count sub-quadratic.
+    Returns two int64 arrays (i, j) with i < j and no duplicate pairs.
+    """
+    n_rows, num_perm = signatures.shape
+    if bands * rows > num_perm:
+        raise ValueError(f"{bands} bands x {rows} rows needs {bands * rows} permutations, got {num_perm}")
+
+    def band_buckets():
+        for band in range(bands):
+            # Fold the band's values into one 64-bit bucket key (a rare collision only
+            # adds candidates, which are scored exactly anyway)
+            band_keys = np.zeros(n_rows, dtype=np.uint64)
+            with np.errstate(over='ignore'):
+                for value in signatures[:, band * rows:(band + 1) * rows].T:
+                    band_keys = band_keys * np.uint64(MINHASH_PRIME) + value.astype(np.uint64)
+            order = np.argsort(band_keys, kind='stable')
+            boundaries = np.flatnonzero(np.diff(band_keys[order])) + 1
+            yield from np.split(order, boundaries)
+
+    return bucket_pairs(band_buckets(), n_rows, max_bucket_size=max_bucket_size, label="LSH buckets")
+
+def bucket_pairs(buckets, n_rows, max_bucket_size=None, label="buckets"):
+    """
+    All within-bucket pairs of row ids, for an iterable of buckets (sequences of row ids).
+    Buckets larger than `max_bucket_size` are skipped.
+    Returns two int64 arrays (i, j) with i < j and no duplicate pairs.
+    """
+    pair_keys = []
+    pair_offsets = {}
+    skipped = 0
+    for members in buckets:
+        members = np.unique(np.asarray(members, dtype=np.int64))
+        size = len(members)
+        if size < 2:
+            continue
+        if max_bucket_size is not None and size > max_bucket_size:
+            skipped += 1
+            continue
+        if size not in pair_offsets:
+            pair_offsets[size] = np.triu_indices(size, k=1)
+        i, j = pair_offsets[size]
+        pair_keys.append(members[i] * n_rows + members[j])
+
+    if skipped:
+        logger.info(f"Skipped {skipped} {label} larger than {max_bucket_size} rows.")
+    if not pair_keys:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    keys = np.sort(np.concatenate(pair_keys))
+    keys = keys[np.concatenate([[True], np.diff(keys) != 0])]
+    return keys // n_rows, keys % n_rows
+
+def candidate_kneighbors(X, left, right, n_neighbors=10, threshold=None, chunk_size=100_000):
+    """
+    Exact cosine k-nearest neighbours of every row of X restricted to the candidate
+    pairs (left[p], right[p]), plus each row itself. Same contract as
+    `blockwise_kneighbors`.
+    """
+    X = _normalize(X)
+    n_rows = X.shape[0]
+    n_neighbors = min(n_neighbors, n_rows)
+
+    sims = np.empty(len(left))
+    for start in range(0, len(left), chunk_size):
+        stop = start + chunk_size
+        sims[start:stop] = np.asarray(
+            X[left[start:stop]].multiply(X[right[start:stop]]).sum(axis=1)
+        ).ravel()
+
+    # Each row is its own nearest neighbour, as in brute force
+    self_rows = np.flatnonzero(np.diff(X.indptr) > 0)
+    rows = np.concatenate([left, right, self_rows])
+    cols = np.concatenate([right, left, self_rows])
+    values = np.concatenate([sims, sims, np.ones(len(self_rows))])
+    pair_sims = _prune(sparse.csr_matrix((values, (rows, cols)), shape=(n_rows, n_rows)), _min_similarity(threshold))
+    return _top_k_rows(pair_sims, np.arange(n_rows), n_neighbors)
+
+def lsh_kneighbors(X, n_neighbors=10, threshold=None, bands=32, rows=3, max_bucket_size=500, seed=0):
+    """
+    Approximate cosine k-nearest neighbours: MinHash/LSH proposes candidate pairs in
+    sub-quadratic time and only those pairs are scored exactly. Neighbours that never
+    share a bucket are missed; use `knn_recall` to measure how many.
+    """
+    started = time.time()
+    signatures = minhash_signatures(X, num_perm=bands * rows, seed=seed)
+    left, right = lsh_candidate_pairs(signatures, bands=bands, rows=rows, max_bucket_size=max_bucket_size)
+    distances, indices = candidate_kneighbors(X, left, right, n_neighbors=n_neighbors, threshold=threshold)
+    logger.info(
+        f"LSH scored {len(left)} candidate pairs for {X.shape[0]} rows "
+        f"({bands} bands x {rows} rows) in {time.time() - started:.2f}s."
+    )
+    return distances, indices
+
+def knn_recall(X, distances, indices, threshold, sample_size=1000, seed=0):
+    """
+    Recall of approximate neighbours against exact brute-force search on a random
+    sample of rows: the fraction of exact neighbours within `threshold` (excluding the
+    row itself, among the exact top k) that also appear in (distances, indices).
+    Returns None if the sample has no exact neighbours to find.
+    """
+    X = _normalize(X)
+    n_rows, n_neighbors = indices.shape
+    rng = np.random.RandomState(seed)
+    sample = np.sort(rng.choice(n_rows, size=min(sample_size, n_rows), replace=False))
+
+    exact_sims = _prune(X[sample] @ X.T.tocsr(), _min_similarity(threshold))
+    exact_distances, exact_indices = _top_k_rows(exact_sims, sample, n_neighbors)
+
+    found = total = 0
+    for r, row in enumerate(sample):
+        exact = {j for j, d in zip(exact_indices[r], exact_distances[r]) if d <= threshold and j != row}
+        approx = {j for j, d in zip(indices[row], distances[row]) if d <= threshold and j != row}
+        total += len(exact)
+        found += len(exact & approx)
+    if total == 0:
+        return None
+    return found / total
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import numpy as np
+from scipy import sparse
+from stages.artifacts import save_array, save_sparse_matrix, load_sparse_matrix
+from stages.knn import query_kneighbors
+
+logger = logging.getLogger(__name__)
+
+def save_neighbor_index(index_dir, names, name_vectors, distances, indices, meta):
+    """
+    Persist the kNN graph of stage 4 to `index_dir`: the names (one per row), their
+    vectors, the (distances, indices) arrays as `.npy` files and `meta`, the search
+    settings the graph is valid for.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    save_sparse_matrix(name_vectors, os.path.join(index_dir, "vectors"))
+    save_array(np.asarray(distances, dtype=np.float64), os.path.join(index_dir, "distances.npy"))
+    save_array(np.asarray(indices, dtype=np.int64), os.path.join(index_dir, "indices.npy"))
+    with open(os.path.join(index_dir, "names.json"), 'w', encoding='utf-8') as f:
+        json.dump(names, f)
+    # Written last: an index without meta.json is incomplete and ignored
+    with open(os.path.join(index_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+    logger.info(f"Saved neighbour index for {len(names)} names to {index_dir}")
+
+def load_neighbor_index(index_dir):
+    """Load an index saved with `save_neighbor_index` (memory-mapped), or None if absent."""
+    meta_path = os.path.join(index_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    with open(os.path.join(index_dir, "names.json"), 'r', encoding='utf-8') as f:
+        names = json.load(f)
+    return {
+        "meta": meta,
+        "names": names,
+        "vectors": load_sparse_matrix(os.path.join(index_dir, "vectors")),
+        "distances": np.load(os.path.join(index_dir, "distances.npy"), mmap_mode='r'),
+        "indices": np.load(os.path.join(index_dir, "indices.npy"), mmap_mode='r'),
+    }
+
+def _merge_row(row, distances, indices, new_cols, new_sims, n_neighbors):
+    """
+    Top-k of the existing neighbour list of `row` merged with extra (column, similarity)
+    candidates, padded with the row itself at distance inf.
+    """
+    found = np.isfinite(distances)
+    sims = np.concatenate([1.0 - distances[found], new_sims])
+    cols = np.concatenate([indices[found], new_cols])
+    order = np.lexsort((cols, -sims))
+    # Keep the best similarity of any column listed twice
+    _, first = np.unique(cols[order], return_index=True)
+    order = order[np.sort(first)][:n_neighbors]
+
+    merged_distances = np.full(n_neighbors, np.inf)
+    merged_indices = np.full(n_neighbors, row, dtype=np.int64)
+    merged_distances[:len(order)] = np.clip(1.0 - sims[order], 0.0, None)
+    merged_indices[:len(order)] = cols[order]
+    return merged_distances, merged_indices
+
+def _vectors_unchanged(old_vectors, new_vectors, old_rows, new_rows):
+    if old_vectors.shape[1] != new_vectors.shape[1]:
+        return False
+    if len(old_rows) == 0:
+        return True
+    diff = sparse.csr_matrix(old_vectors)[old_rows] - sparse.csr_matrix(new_vectors)[new_rows]
+    return diff.nnz == 0 or np.abs(diff.data).max() < 1e-12
+
+def incremental_neighbors(index, names, name_vectors, n_neighbors, threshold, block_size=1024):
+    """
+    Update the kNN graph in `index` (from `load_neighbor_index`) for the current
+    `names` and `name_vectors`. Only names that are new, or that lost a neighbour
+    because its name disappeared, are queried against all vectors; the lists of the
+    other names are patched with any new names that come within their top k.
+
+    Returns (distances, indices) for all current names, or None if the index cannot
+    be reused (different settings, or vectors of existing names have changed, e.g.
+    after the TF-IDF model was refitted).
+    """
+    meta = index["meta"]
+    if meta.get("n_neighbors") != n_neighbors or meta.get("threshold") != threshold:
+        logger.info("Neighbour index was built with different settings; recomputing.")
+        return None
+
+    n_rows = len(names)
+    n_neighbors = min(n_neighbors, n_rows)
+    if index["indices"].shape[1] != n_neighbors:
+        logger.info("Neighbour index has a different number of neighbours per row; recomputing.")
+        return None
+    row_of = {name: row for row, name in enumerate(names)}
+    old_to_new = np.array([row_of.get(name, -1) for name in index["names"]], dtype=np.int64)
+    kept_old = np.flatnonzero(old_to_new >= 0)
+    if not _vectors_unchanged(index["vectors"], name_vectors, kept_old, old_to_new[kept_old]):
+        logger.info("Vectors of indexed names have changed; recomputing the neighbour index.")
+        return None
+
+    # Carry the kept rows over, remapping their neighbours to the new row numbers
+    distances = np.full((n_rows, n_neighbors), np.inf)
+    indices = np.repeat(np.arange(n_rows)[:, None], n_neighbors, axis=1)
+    old_distances = np.asarray(index["distances"])[kept_old]
+    old_indices = old_to_new[np.asarray(index["indices"])[kept_old]]
+    new_rows_of_kept = old_to_new[kept_old]
+    distances[new_rows_of_kept] = old_distances
+    indices[new_rows_of_kept] = np.where(old_indices >= 0, old_indices, new_rows_of_kept[:, None])
+
+    # Rows that lost a neighbour to a removed name are re-queried in full
+    lost_neighbor = new_rows_of_kept[((old_indices < 0) & np.isfinite(old_distances)).any(axis=1)]
+    is_new = np.ones(n_rows, dtype=bool)
+    is_new[new_rows_of_kept] = False
+    new_rows = np.flatnonzero(is_new)
+    query_rows = np.union1d(new_rows, lost_neighbor)
+
+    query_distances, query_indices, similarities = query_kneighbors(
+        name_vectors, query_rows, n_neighbors=n_neighbors, threshold=threshold, block_size=block_size
+    )
+    distances[query_rows] = query_distances
+    indices[query_rows] = query_indices
+
+    # Patch the other rows: a new name may enter their top k
+    queried = np.zeros(n_rows, dtype=bool)
+    queried[query_rows] = True
+    from_new = similarities[np.flatnonzero(is_new[query_rows])].T.tocsr()
+    new_row_ids = query_rows[is_new[query_rows]]
+    patched = 0
+    for row in np.flatnonzero(np.diff(from_new.indptr)):
+        if queried[row]:
+            continue
+        lo, hi = from_new.indptr[row], from_new.indptr[row + 1]
+        distances[row], indices[row] = _merge_row(
+            row, distances[row], indices[row], new_row_ids[from_new.indices[lo:hi]], from_new.data[lo:hi], n_neighbors
+        )
+        patched += 1
+
+    logger.info(
+        f"Neighbour index: {len(new_rows)} new names, {len(kept_old)} kept, "
+        f"{len(index['names']) - len(kept_old)} removed; queried {len(query_rows)} rows and patched {patched}."
+    )
+    return distances, indices
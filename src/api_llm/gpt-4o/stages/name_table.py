@@ -0,0 +1,80 @@
+import json
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Markers identifying the compact encodings, so loaders still accept the legacy
+# artifacts that embed full record dicts
+NAME_IDS_FORMAT = "name-ids"
+RECORD_IDS_FORMAT = "record-ids"
+
+def save_name_table(names, path):
+    """
+    Save the global name dictionary: name ID i is `names[i]`. Stage 3 writes it in the
+    order of `distinct_names`, so a name's ID is also its row in the name vectors.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(names, f, ensure_ascii=False)
+    return path
+
+def load_name_table(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _dump_compact(payload, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, separators=(',', ':'))
+
+def save_name_groups(grouped_names, names, path):
+    """
+    Save stage 4 groups as arrays of name IDs, representative first:
+        {"format": "name-ids", "groups": [[rep_id, matched_id, ...], ...]}
+    The item dicts are not stored; `load_name_groups` rebuilds them from the record table.
+    """
+    name_ids = {name: i for i, name in enumerate(names)}
+    groups = [
+        [name_ids[rep_name]] + [name_ids[nm] for nm in info["matched_names"]]
+        for rep_name, info in grouped_names.items()
+    ]
+    _dump_compact({"format": NAME_IDS_FORMAT, "groups": groups}, path)
+    logger.info(f"Saved {len(groups)} groups as name IDs to {path}")
+    return path
+
+def load_name_groups(path, name_table_path, records=None):
+    """
+    Load stage 4 groups saved with `save_name_groups` (or a legacy grouped-names JSON)
+    as {rep_name: {"matched_names": [...], "items": [...]}}, decoding the IDs with the
+    name table at `name_table_path`. "items" is only filled in when the record table
+    (`records`, e.g. the stage 3 unique entries) is given, since later stages mostly
+    need the names alone.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        payload = json.load(f)
+    if not (isinstance(payload, dict) and payload.get("format") == NAME_IDS_FORMAT):
+        return payload
+    names = load_name_table(name_table_path)
+
+    name_to_items = None
+    if records is not None:
+        name_to_items = defaultdict(list)
+        for record in records:
+            name_to_items[record["combined_name"]].append(record)
+
+    grouped_names = {}
+    for ids in payload["groups"]:
+        group_names = [names[i] for i in ids]
+        info = {"matched_names": group_names[1:]}
+        if name_to_items is not None:
+            info["items"] = [item for nm in group_names for item in name_to_items[nm]]
+        grouped_names[group_names[0]] = info
+    return grouped_names
+
+def save_record_groups(record_groups, path, record_table):
+    """
+    Save groups of record IDs (row numbers in the record table artifact named by
+    `record_table`) as {"format": "record-ids", "record_table": ..., "groups": {key: [ids]}}.
+    """
+    _dump_compact({"format": RECORD_IDS_FORMAT, "record_table": record_table, "groups": record_groups}, path)
+    logger.info(f"Saved {len(record_groups)} groups as record IDs to {path}")
+    return path
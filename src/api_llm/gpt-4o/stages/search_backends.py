@@ -0,0 +1,272 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from urllib.parse import unquote
+from stages.search_store import normalise_query
+
+logger = logging.getLogger(__name__)
+
+# Registry of search backends by --search-method name
+SEARCH_BACKENDS = {}
+
+class SearchBackendError(RuntimeError):
+    """A search failed; the search engine retries it."""
+
+class RateLimitError(SearchBackendError):
+    """The backend refused a search because too many were sent."""
+
+def register_backend(name):
+    """Class decorator adding a SearchBackend subclass to the registry under `name`."""
+    def register(cls):
+        cls.name = name
+        SEARCH_BACKENDS[name] = cls
+        return cls
+    return register
+
+def available_backends():
+    return sorted(SEARCH_BACKENDS)
+
+def get_backend(name, **options):
+    """Instantiate the backend registered as `name` with backend-specific `options`."""
+    if name not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend '{name}'; choose from {available_backends()}")
+    return SEARCH_BACKENDS[name](**options)
+
+class SearchBackend:
+    """
+    One web search provider. `search` runs a single query and returns up to
+    `num_results` dicts with "url", "title" and "description"; it raises
+    RateLimitError when throttled and SearchBackendError (or any exception) on other
+    failures. It is called from several threads at once, so clients are created once
+    and reused rather than per query.
+    """
+    name = None
+
+    def search(self, query, num_results=3):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _quoted(query):
+    # Search for the exact phrase
+    return f'"{query}"'
+
+@register_backend("duckduckgo")
+class DuckDuckGoBackend(SearchBackend):
+    """DuckDuckGo text search, with one DDGS client per worker thread."""
+
+    def __init__(self, region='wt-wt', safesearch='Moderate', timeout=10):
+        try:
+            from duckduckgo_search import DDGS
+        except ImportError:
+            raise RuntimeError("DuckDuckGo search module not available.")
+        try:
+            from duckduckgo_search.exceptions import RatelimitException
+        except ImportError:
+            RatelimitException = None
+        self._client_cls = DDGS
+        self._ratelimit_exc = RatelimitException
+        self.region = region
+        self.safesearch = safesearch
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _client(self):
+        # DDGS keeps an HTTP session; share it between the queries of a thread
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._client_cls(timeout=self.timeout)
+        return client
+
+    def search(self, query, num_results=3):
+        try:
+            results = self._client().text(
+                _quoted(query), region=self.region, safesearch=self.safesearch, max_results=num_results
+            )
+        except Exception as e:
+            if self._ratelimit_exc is not None and isinstance(e, self._ratelimit_exc):
+                raise RateLimitError(str(e)) from e
+            raise
+        return [
+            {
+                'url': res.get('href', ''),
+                'title': res.get('title', ''),
+                'description': res.get('body', '')
+            }
+            for res in results or []
+        ]
+
+GOOGLE_SEARCH_URL = "https://www.google.com/search"
+# Sent by the googlesearch package to skip Google's consent page
+GOOGLE_CONSENT_COOKIES = {'CONSENT': 'PENDING+987', 'SOCS': 'CAESHAgBEhIaAB'}
+
+@register_backend("google")
+class GoogleBackend(SearchBackend):
+    """
+    Google results scraped from the basic HTML results page as the `googlesearch`
+    package does, but through one `requests.Session` per worker thread, so connections
+    are kept alive between queries instead of opened for each one.
+    """
+
+    def __init__(self, lang='en', timeout=10, safe='active'):
+        try:
+            import requests
+            from bs4 import BeautifulSoup
+            from googlesearch.user_agents import get_useragent
+        except ImportError:
+            raise RuntimeError("Google search module not available.")
+        self._requests = requests
+        self._parser = BeautifulSoup
+        self._user_agent = get_useragent
+        self.lang = lang
+        self.timeout = timeout
+        self.safe = safe
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+            session.headers.update({"User-Agent": self._user_agent(), "Accept": "*/*"})
+            session.cookies.update(GOOGLE_CONSENT_COOKIES)
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def search(self, query, num_results=3):
+        try:
+            response = self._session().get(
+                GOOGLE_SEARCH_URL,
+                params={"q": _quoted(query), "num": num_results + 2, "hl": self.lang, "safe": self.safe},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except self._requests.HTTPError as e:
+            # 429 means throttled
+            if getattr(e.response, "status_code", None) == 429:
+                raise RateLimitError(str(e)) from e
+            raise
+        return self._parse_results(response.text)[:num_results]
+
+    def _parse_results(self, html):
+        # The page layout depends on the user agent googlesearch picks: the basic HTML
+        # page (googlesearch >= 1.3) or the full one (earlier versions)
+        soup = self._parser(html, "html.parser")
+        results = []
+        for block in soup.find_all("div", class_="ezO2md"):
+            link = block.find("a", href=True)
+            if link is None:
+                continue
+            title = link.find("span", class_="CVA68e")
+            description = block.find("span", class_="FrIlee")
+            results.append({
+                'url': unquote(link["href"].split("&")[0].replace("/url?q=", "")),
+                'title': title.text if title else '',
+                'description': description.text if description else '',
+            })
+        if results:
+            return results
+        for block in soup.find_all("div", attrs={"class": "g"}):
+            link = block.find("a", href=True)
+            title = block.find("h3")
+            description = block.find("div", {"style": "-webkit-line-clamp:2"})
+            if link and title and description:
+                results.append({'url': link["href"], 'title': title.text, 'description': description.text})
+        return results
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+
+# A UK postcode at the end of a query, as appended by stage 5
+TRAILING_POSTCODE_RE = re.compile(r'\s+[a-z]{1,2}[0-9][0-9a-z]?\s*[0-9][a-z]{2}$')
+
+@register_backend("fixture")
+class FixtureBackend(SearchBackend):
+    """
+    Offline backend for benchmarking stage 5 throughput and retry behaviour.
+
+    Results come from `corpus_path`, a JSON file of {query or name: results} such as
+    `web_search_results_stage5.json`; a query ending in a postcode also matches the bare
+    name, and queries missing from the corpus return no results. Without a corpus,
+    `num_results` deterministic placeholder results are made up for every query.
+
+    Each search sleeps for `latency` seconds (varied uniformly by +/- `jitter` of it),
+    then fails with probability `error_rate`, or is throttled (RateLimitError) with
+    probability `throttle_rate`. `seed` makes the injected latencies and errors repeatable.
+    With `rate_limit`, searches beyond that many in any 60 seconds are throttled too, as
+    a real search engine would.
+    """
+
+    def __init__(self, corpus_path=None, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, seed=None,
+                 rate_limit=None):
+        self.corpus = None
+        if corpus_path:
+            with open(corpus_path, 'r', encoding='utf-8') as f:
+                self.corpus = {normalise_query(query): results for query, results in json.load(f).items()}
+            logger.info(f"Loaded {len(self.corpus)} fixture search results from {corpus_path}")
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self._recent = deque()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _lookup(self, query, num_results):
+        key = normalise_query(query)
+        if self.corpus is None:
+            digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+            return [
+                {
+                    'url': f'https://example.org/{digest}/{i}',
+                    'title': f'{query} ({i + 1})',
+                    'description': f'Fixture result {i + 1} for {query}.'
+                }
+                for i in range(num_results)
+            ]
+        results = self.corpus.get(key)
+        if results is None:
+            results = self.corpus.get(TRAILING_POSTCODE_RE.sub('', key), [])
+        return results[:num_results]
+
+    def _over_rate_limit(self):
+        # Sliding 60 s window of accepted searches; called with the lock held
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 60.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.rate_limit:
+            return True
+        self._recent.append(now)
+        return False
+
+    def search(self, query, num_results=3):
+        with self._lock:
+            delay = self.latency * (1.0 + self.jitter * self._rng.uniform(-1.0, 1.0))
+            draw = self._rng.random()
+            if self.rate_limit and self._over_rate_limit():
+                raise RateLimitError(f"Fixture backend rate limit of {self.rate_limit}/min reached")
+        if delay > 0:
+            time.sleep(delay)
+        if draw < self.throttle_rate:
+            raise RateLimitError(f"Fixture backend throttled '{query}'")
+        if draw < self.throttle_rate + self.error_rate:
+            raise SearchBackendError(f"Fixture backend failed '{query}'")
+        return self._lookup(query, num_results)
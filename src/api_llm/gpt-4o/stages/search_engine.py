@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from stages.search_backends import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Per backend: starting request rate (per minute), number of concurrent requests, the
+# range the adaptive controller keeps the rate in, its additive increase (requests/min
+# per minute without throttling) and how long to pause after throttling
+BACKEND_LIMITS = {
+    "duckduckgo": {"rate_per_minute": 20, "max_concurrency": 4, "min_rate": 2, "max_rate": 60, "increase": 2, "cooldown": 60.0},
+    "google": {"rate_per_minute": 30, "max_concurrency": 4, "min_rate": 2, "max_rate": 90, "increase": 2, "cooldown": 60.0},
+    "fixture": {"rate_per_minute": 6000, "max_concurrency": 8, "min_rate": 60, "max_rate": 60000, "increase": 600, "cooldown": 1.0},
+}
+DEFAULT_LIMITS = {"rate_per_minute": 30, "max_concurrency": 4, "min_rate": 2, "max_rate": 90, "increase": 2, "cooldown": 60.0}
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter. Tokens are added at `rate_per_minute` and up
+    to `burst` may accumulate while idle. With the default burst of 1, calls to
+    `acquire` are spaced exactly 60 / rate seconds apart.
+    """
+
+    def __init__(self, rate_per_minute, burst=1):
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute must be positive")
+        self.interval = 60.0 / rate_per_minute
+        self.burst = max(1, burst)
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate_per_minute):
+        with self._lock:
+            self.interval = 60.0 / rate_per_minute
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds`."""
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+    def next_slot_in(self):
+        """Seconds until the next token is due (0 if one is available now)."""
+        with self._lock:
+            return max(0.0, self._next_slot - time.monotonic())
+
+    def acquire(self):
+        """Block until a token is available. Returns the time spent waiting."""
+        with self._lock:
+            now = time.monotonic()
+            # Idle time earns at most `burst` tokens
+            slot = max(self._next_slot, now - (self.burst - 1) * self.interval)
+            self._next_slot = slot + self.interval
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+        return max(wait, 0.0)
+
+class AdaptiveRateController:
+    """
+    AIMD rate limiter wrapping a TokenBucket. Every successful search raises the rate
+    by `increase` / rate, i.e. by `increase` requests/min per minute of searches
+    without throttling; a RateLimitError multiplies it by `decrease` and pauses all
+    requests for `cooldown` seconds. Throttles reported during that pause come from
+    requests already in flight and do not cut the rate again. The rate stays within
+    [`min_rate`, `max_rate`].
+    """
+
+    def __init__(self, rate_per_minute, min_rate, max_rate, increase=1.0, decrease=0.5, cooldown=60.0):
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.rate_per_minute = self._clamp(rate_per_minute)
+        self.bucket = TokenBucket(self.rate_per_minute)
+        self.successes = 0
+        self.throttles = 0
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def _clamp(self, rate):
+        return min(max(rate, self.min_rate), self.max_rate)
+
+    def acquire(self):
+        return self.bucket.acquire()
+
+    def on_success(self):
+        with self._lock:
+            self.successes += 1
+            self.rate_per_minute = self._clamp(self.rate_per_minute + self.increase / self.rate_per_minute)
+            self.bucket.set_rate(self.rate_per_minute)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.rate_per_minute = self._clamp(self.rate_per_minute * self.decrease)
+            self.bucket.set_rate(self.rate_per_minute)
+            self.bucket.pause(self.cooldown)
+        logger.warning(
+            f"Search backend is throttling; pausing {self.cooldown:.0f}s and lowering the rate "
+            f"to {self.rate_per_minute:.1f} requests/min."
+        )
+
+    def state(self):
+        """The learned rate and when the next request may be sent (epoch seconds), for `save_rate_state`."""
+        return {
+            "rate_per_minute": self.rate_per_minute,
+            "next_request_at": time.time() + self.bucket.next_slot_in(),
+            "updated_at": time.time(),
+        }
+
+    def restore(self, state):
+        """Resume from a saved `state`: its rate, and any pause or spacing still pending."""
+        if state.get("rate_per_minute"):
+            self.rate_per_minute = self._clamp(state["rate_per_minute"])
+            self.bucket.set_rate(self.rate_per_minute)
+        wait = state.get("next_request_at", 0) - time.time()
+        if wait > 0:
+            self.bucket.pause(wait)
+            if wait >= 1:
+                logger.info(f"Waiting {wait:.0f}s left over from the previous run before searching.")
+
+def load_rate_state(path, search_method):
+    """State saved for `search_method` in the JSON at `path` ({method: state}), or None."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f).get(search_method)
+
+def save_rate_state(path, search_method, state):
+    """Replace the state of `search_method` in the JSON at `path`, keeping other methods."""
+    states = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            states = json.load(f)
+    states[search_method] = state
+    # A temporary file of its own, so concurrent runs cannot clobber each other's write
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', prefix=os.path.basename(path),
+                                     suffix='.tmp', delete=False) as f:
+        json.dump(states, f, indent=2)
+    os.replace(f.name, path)
+
+class ConcurrentSearchEngine:
+    """
+    Runs a single-query search function over many queries with a thread pool of
+    `max_concurrency` workers, all drawing from one TokenBucket so the backend sees a
+    steady `rate_per_minute`, or from `controller` (an AdaptiveRateController) if given.
+    Failed searches are retried after an exponential backoff (`backoff` * 2**attempt
+    seconds, capped at `max_backoff`); each retry also waits for a token.
+    """
+
+    def __init__(self, search_fn, rate_per_minute=None, max_concurrency=4, max_retries=5, backoff=2.0, max_backoff=60.0,
+                 controller=None):
+        self.search_fn = search_fn
+        self.controller = controller
+        self.limiter = controller if controller is not None else TokenBucket(rate_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _search(self, query):
+        for attempt in range(self.max_retries):
+            self.limiter.acquire()
+            try:
+                results = self.search_fn(query)
+            except Exception as e:
+                if self.controller is not None and isinstance(e, RateLimitError):
+                    self.controller.on_throttle()
+                if attempt + 1 == self.max_retries:
+                    raise
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning(
+                    f"Search for '{query}' failed: {e}. Retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})..."
+                )
+                time.sleep(delay)
+            else:
+                if self.controller is not None:
+                    self.controller.on_success()
+                return results
+
+    def search_many(self, queries):
+        """
+        Search every query, yielding (query, results, error) as searches complete;
+        `error` is None on success and `results` is None on failure.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self._search, query): query for query in queries}
+            for future in as_completed(futures):
+                query = futures[future]
+                try:
+                    yield query, future.result(), None
+                except Exception as e:
+                    yield query, None, e
+
+def search_limits(search_method, rate_per_minute=None, max_concurrency=None):
+    """Rate and concurrency for `search_method`, with explicit values overriding the defaults."""
+    limits = dict(BACKEND_LIMITS.get(search_method, DEFAULT_LIMITS))
+    if rate_per_minute:
+        limits["rate_per_minute"] = rate_per_minute
+        limits["min_rate"] = min(limits["min_rate"], rate_per_minute)
+        limits["max_rate"] = max(limits["max_rate"], rate_per_minute)
+    if max_concurrency:
+        limits["max_concurrency"] = max_concurrency
+    return limits
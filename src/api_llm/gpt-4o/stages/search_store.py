@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_results (
+    method     TEXT NOT NULL,
+    name       TEXT NOT NULL,
+    results    TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (method, name)
+) WITHOUT ROWID
+"""
+
+QUERY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_cache (
+    method        TEXT NOT NULL,
+    query         TEXT NOT NULL,
+    results       TEXT NOT NULL,
+    result_count  INTEGER NOT NULL,
+    num_requested INTEGER NOT NULL,
+    searched_at   REAL NOT NULL,
+    PRIMARY KEY (method, query)
+) WITHOUT ROWID
+"""
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalise_query(query):
+    """Cache key of a search query: case-folded with whitespace collapsed."""
+    return WHITESPACE_RE.sub(' ', query).strip().casefold()
+
+class SearchResultStore:
+    """
+    Rolling web search database kept in SQLite, one row per (search method, name),
+    plus a cache of completed searches keyed by (search method, normalised query).
+
+    Each result is upserted and committed as soon as it arrives, so an interrupted run
+    keeps the searches it finished. The database runs in WAL mode with a busy timeout,
+    so several runs sharing an output directory can read and write it safely.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._conn.execute(QUERY_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, method, name):
+        """Stored results for `name` under `method`, or None if it was never searched."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT results FROM search_results WHERE method = ? AND name = ?", (method, name)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, method, name, results):
+        """Insert or replace the results for `name` under `method` and commit."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO search_results (method, name, results, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (method, name) DO UPDATE SET results = excluded.results, updated_at = excluded.updated_at",
+                (method, name, json.dumps(results, ensure_ascii=False), time.time())
+            )
+
+    def get_query(self, method, query):
+        """
+        The cached search for `query` under `method`, as a dict with "results",
+        "result_count", "num_requested" and "searched_at" (epoch seconds), or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT results, result_count, num_requested, searched_at FROM query_cache "
+                "WHERE method = ? AND query = ?", (method, normalise_query(query))
+            ).fetchone()
+        if row is None:
+            return None
+        results, result_count, num_requested, searched_at = row
+        return {
+            "results": json.loads(results),
+            "result_count": result_count,
+            "num_requested": num_requested,
+            "searched_at": searched_at,
+        }
+
+    def record_search(self, method, query, names, results, num_requested):
+        """
+        Record a completed search for `query` (asking for `num_requested` results) and
+        store its results for each of `names`, in one transaction. A search that found
+        fewer results, or none, is cached all the same.
+        """
+        encoded = json.dumps(results, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO query_cache (method, query, results, result_count, num_requested, searched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (method, query) DO UPDATE SET "
+                "results = excluded.results, result_count = excluded.result_count, "
+                "num_requested = excluded.num_requested, searched_at = excluded.searched_at",
+                (method, normalise_query(query), encoded, len(results), num_requested, now)
+            )
+            self._conn.executemany(
+                "INSERT INTO search_results (method, name, results, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (method, name) DO UPDATE SET results = excluded.results, updated_at = excluded.updated_at",
+                [(method, name, encoded, now) for name in names]
+            )
+
+    def method_results(self, method):
+        """All stored results under `method`, as {name: results}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, results FROM search_results WHERE method = ?", (method,)
+            ).fetchall()
+        return {name: json.loads(results) for name, results in rows}
+
+    def count(self, method=None):
+        with self._lock:
+            if method is None:
+                return self._conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM search_results WHERE method = ?", (method,)
+            ).fetchone()[0]
+
+    def migrate_json(self, json_path):
+        """
+        Import a legacy `all_web_search_results.json` ({method: {name: results}}).
+        Rows already in the store are kept, since they are at least as recent. The JSON
+        file is renamed to `<name>.migrated` so it is only imported once.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, 'r') as f:
+            legacy = json.load(f)
+        now = time.time()
+        rows = [
+            (method, name, json.dumps(results, ensure_ascii=False), now)
+            for method, by_name in legacy.items()
+            for name, results in by_name.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO search_results (method, name, results, updated_at) VALUES (?, ?, ?, ?)", rows
+            )
+        os.replace(json_path, f"{json_path}.migrated")
+        logger.info(f"Migrated {len(rows)} search results from {json_path} into {self.path}")
+        return len(rows)
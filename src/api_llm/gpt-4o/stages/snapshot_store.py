@@ -0,0 +1,229 @@
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Content-defined chunking of the file bytes: a chunk ends where the rolling hash of the
+# last HASH_WINDOW bytes has its low bits zero (on average every 2**CHUNK_MASK_BITS
+# bytes), so inserting or deleting data only changes the chunks around the edit.
+# Files are read READ_SIZE bytes at a time and never held whole.
+HASH_WINDOW = 48
+CHUNK_MASK_BITS = 16
+MIN_CHUNK_BYTES = 16 * 1024
+MAX_CHUNK_BYTES = 256 * 1024
+READ_SIZE = 1 << 20
+# Random 64-bit value per byte value, derived from SHA-1 so it never changes
+GEAR = np.array(
+    [int(hashlib.sha1(bytes([value])).hexdigest()[:16], 16) for value in range(256)], dtype=np.uint64
+)
+BYTES_FORMAT = "bytes"
+
+def _cut_points(window, n_new):
+    """
+    Offsets (1-based ends) within the last `n_new` bytes of `window` after which the
+    rolling hash marks a chunk boundary. `window` starts with up to HASH_WINDOW - 1
+    bytes carried over from the previous read.
+    """
+    data = np.frombuffer(window, dtype=np.uint8)
+    if len(data) < HASH_WINDOW:
+        return np.empty(0, dtype=np.int64)
+    sums = np.cumsum(GEAR[data], dtype=np.uint64)
+    # Sum of the gear values of the HASH_WINDOW bytes ending at each position (mod 2**64)
+    hashes = sums[HASH_WINDOW - 1:].copy()
+    hashes[1:] -= sums[:-HASH_WINDOW]
+    ends = np.flatnonzero((hashes & np.uint64((1 << CHUNK_MASK_BITS) - 1)) == 0) + HASH_WINDOW
+    offset = len(data) - n_new
+    return ends[ends > offset] - offset
+
+def content_chunks(stream, read_size=READ_SIZE):
+    """
+    Split the binary `stream` into content-defined chunks of MIN_CHUNK_BYTES to
+    MAX_CHUNK_BYTES bytes, reading `read_size` bytes at a time.
+    """
+    pending = bytearray()
+    carry = b''
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        start = 0
+        for cut in _cut_points(carry + block, len(block)):
+            while len(pending) + cut - start > MAX_CHUNK_BYTES:
+                take = MAX_CHUNK_BYTES - len(pending)
+                pending += block[start:start + take]
+                start += take
+                yield bytes(pending)
+                pending.clear()
+            if len(pending) + cut - start >= MIN_CHUNK_BYTES:
+                pending += block[start:cut]
+                start = cut
+                yield bytes(pending)
+                pending.clear()
+        while len(pending) + len(block) - start > MAX_CHUNK_BYTES:
+            take = MAX_CHUNK_BYTES - len(pending)
+            pending += block[start:start + take]
+            start += take
+            yield bytes(pending)
+            pending.clear()
+        pending += block[start:]
+        carry = (carry + block)[-(HASH_WINDOW - 1):]
+    if pending:
+        yield bytes(pending)
+
+class SnapshotStore:
+    """
+    Content-addressed store for the data history written by stage 0.
+
+    Layout under `root`:
+        objects/<ab>/<sha1>.gz         - gzipped bytes of one chunk of a file
+        objects/<ab>/<sha1>.json.gz    - gzipped JSON list of records (older snapshots)
+        snapshots/<run_id>/<name>.json - manifest listing the chunk hashes of a file
+
+    Files are streamed and split into chunks at content-defined byte boundaries
+    (`content_chunks`), and each chunk is stored once, so consecutive runs over mostly
+    unchanged data only add the chunks that changed. Any snapshot is rebuilt by
+    concatenating its chunks. Snapshots written before byte chunking (chunks of
+    records) can still be loaded and restored.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+
+    def _object_path(self, digest, ext=".json.gz"):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}{ext}")
+
+    def _manifest_path(self, run_id, name):
+        return os.path.join(self.snapshots_dir, run_id, f"{name}.json")
+
+    def _put_chunk(self, payload):
+        digest = hashlib.sha1(payload).hexdigest()
+        path = self._object_path(digest, ".gz")
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return digest, True
+
+    def save_stream(self, run_id, name, stream):
+        """Store the bytes of the binary `stream` as snapshot `name` of run `run_id`. Returns the manifest dict."""
+        chunks = []
+        new_chunks = 0
+        num_bytes = 0
+        for payload in content_chunks(stream):
+            digest, created = self._put_chunk(payload)
+            chunks.append(digest)
+            new_chunks += int(created)
+            num_bytes += len(payload)
+
+        manifest = {"run_id": run_id, "name": name, "format": BYTES_FORMAT, "num_bytes": num_bytes, "chunks": chunks}
+        manifest_path = self._manifest_path(run_id, name)
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info(
+            f"Snapshot {run_id}/{name}: {num_bytes} bytes in {len(chunks)} chunks "
+            f"({new_chunks} new, {len(chunks) - new_chunks} deduplicated)."
+        )
+        return manifest
+
+    def save(self, run_id, name, records):
+        """Store `records` as snapshot `name` of run `run_id`, as a JSON list. Returns the manifest dict."""
+        payload = json.dumps(records, indent=4, ensure_ascii=False).encode('utf-8')
+        return self.save_stream(run_id, name, io.BytesIO(payload))
+
+    def save_file(self, run_id, name, json_path):
+        """Store the file at `json_path` as snapshot `name` of run `run_id`, streaming it."""
+        if not os.path.exists(json_path):
+            logger.info(f"Nothing to snapshot at {json_path}; skipping {run_id}/{name}.")
+            return None
+        with open(json_path, 'rb') as f:
+            return self.save_stream(run_id, name, f)
+
+    def _read_manifest(self, run_id, name):
+        with open(self._manifest_path(run_id, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _iter_bytes(self, manifest):
+        for digest in manifest["chunks"]:
+            with gzip.open(self._object_path(digest, ".gz"), 'rb') as f:
+                yield f.read()
+
+    def load(self, run_id, name):
+        """Rebuild the list of records stored as snapshot `name` of run `run_id`."""
+        manifest = self._read_manifest(run_id, name)
+        if manifest.get("format") == BYTES_FORMAT:
+            return json.loads(b''.join(self._iter_bytes(manifest)).decode('utf-8'))
+        records = []
+        for digest in manifest["chunks"]:
+            with gzip.open(self._object_path(digest), 'rb') as f:
+                records.extend(json.loads(f.read().decode('utf-8')))
+        return records
+
+    def restore(self, run_id, name, output_path):
+        """Write snapshot `name` of run `run_id` back out as a JSON file."""
+        manifest = self._read_manifest(run_id, name)
+        if manifest.get("format") == BYTES_FORMAT:
+            # The original file, byte for byte, one chunk at a time
+            with open(output_path, 'wb') as f:
+                for payload in self._iter_bytes(manifest):
+                    f.write(payload)
+            logger.info(f"Restored {manifest['num_bytes']} bytes from {run_id}/{name} to {output_path}")
+            return output_path
+        records = self.load(run_id, name)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, indent=4)
+        logger.info(f"Restored {len(records)} records from {run_id}/{name} to {output_path}")
+        return output_path
+
+    def list_runs(self):
+        """Return {run_id: [snapshot names]} for every stored run, oldest first."""
+        runs = {}
+        for run_id in sorted(os.listdir(self.snapshots_dir)):
+            run_dir = os.path.join(self.snapshots_dir, run_id)
+            runs[run_id] = sorted(f[:-len(".json")] for f in os.listdir(run_dir) if f.endswith(".json"))
+        return runs
+
+def replace_with_link(src, dst):
+    """
+    Make `dst` refer to the same content as `src` without copying where possible.
+    Falls back to a copy on filesystems that do not support hard links, keeping the
+    modification time so stage 0's hash index still matches the file.
+    """
+    tmp_path = f"{dst}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or restore data history snapshots.')
+    parser.add_argument('store', help='Path to the snapshot store (e.g. data/raw/history)')
+    parser.add_argument('--run', help='Run id (timestamp) to restore')
+    parser.add_argument('--name', default='uk_data', help='Snapshot name within the run')
+    parser.add_argument('--output', help='Path to write the restored JSON to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    store = SnapshotStore(args.store)
+    if args.run and args.output:
+        store.restore(args.run, args.name, args.output)
+    else:
+        for run_id, names in store.list_runs().items():
+            print(f"{run_id}: {', '.join(names)}")
@@ -1,64 +1,317 @@
 import json
 import os
+import hashlib
 import logging
+import shutil
 
 logger = logging.getLogger(__name__)
 
-def stage0_check_new_data(new_data_path, old_data_path, merged_data_path, new_entries_path):
+# Fields added by the pipeline itself; they must not affect a record's identity
+PIPELINE_FIELDS = ("is_new", "change_type")
+
+def record_hash(record):
+    """
+    Stable content hash of a record, ignoring pipeline-managed fields.
+    Works for records holding unhashable values (lists, nested dicts).
+    """
+    content = {k: v for k, v in record.items() if k not in PIPELINE_FIELDS}
+    encoded = json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+def default_index_path(old_data_path):
+    return f"{os.path.splitext(old_data_path)[0]}_hashes.txt"
+
+def record_key(record, content_hash):
+    """
+    Identity of a record for keyed diffing: (dataset, unique_id).
+    Records without a unique_id fall back to being identified by their content.
+    """
+    unique_id = record.get("unique_id")
+    if unique_id is None or unique_id == "":
+        return ("#content", content_hash)
+    return (str(record.get("dataset", "")), str(unique_id))
+
+def load_hash_index(index_path):
+    """
+    Load the sidecar index as a list of (hash, key) pairs, one per record in the old database.
+    Lines are `hash<TAB>dataset<TAB>unique_id`; lines written without a key get key=None.
+    """
+    if not os.path.exists(index_path):
+        return None
+    entries = []
+    with open(index_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if not parts[0]:
+                continue
+            key = (parts[1], parts[2]) if len(parts) == 3 else None
+            entries.append((parts[0], key))
+    return entries
+
+def write_hash_index(index_path, entries, append=False):
+    with open(index_path, 'a' if append else 'w', encoding='utf-8') as f:
+        for h, key in entries:
+            f.write(f"{h}\t{key[0]}\t{key[1]}\n")
+
+def _meta_path(index_path):
+    return f"{index_path}.meta"
+
+def write_index_meta(index_path, data_path, num_old, diff_mode):
     """
-    - Loads old_data if it exists,
-    - Loads new_data,
-    - Finds the 'new entries' that exist in new_data but not in old_data,
+    Record which file the index describes (its size and modification time), how many of
+    its records predate the last run and the diff mode that wrote it.
+    """
+    stat = os.stat(data_path)
+    meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "num_old": num_old, "diff_mode": diff_mode}
+    with open(_meta_path(index_path), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def load_index_meta(index_path):
+    if not os.path.exists(_meta_path(index_path)):
+        return None
+    with open(_meta_path(index_path), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _index_matches(index_path, entries, data_path):
+    """True if the index entries were written for `data_path` as it is now."""
+    meta = load_index_meta(index_path)
+    if entries is None or meta is None or any(key is None for _, key in entries):
+        return False
+    stat = os.stat(data_path)
+    return meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns
+
+def _rebuild_index(index_path, old_data_path):
+    """Hash every record of the old database and rewrite the index from scratch."""
+    with open(old_data_path, 'r', encoding='utf-8') as f:
+        old_data = json.load(f)
+    logger.info(f"Rebuilding content-hash index for {len(old_data)} old entries at {index_path}")
+    entries = []
+    for d in old_data:
+        h = record_hash(d)
+        entries.append((h, record_key(d, h)))
+    write_hash_index(index_path, entries)
+    return entries
+
+def _append_json_records(path, records):
+    """
+    Append `records` to the JSON array in `path` without reading it, in the layout of
+    `json.dump(..., indent=4)`. The file is restored if writing fails.
+    """
+    if not records:
+        return
+    with open(path, 'r+b') as f:
+        # Find the closing bracket and the last element before it in the last few KiB
+        tail_start = max(0, f.seek(0, os.SEEK_END) - 4096)
+        f.seek(tail_start)
+        original_tail = f.read()
+        tail = original_tail.rstrip()
+        if not tail.endswith(b']'):
+            raise ValueError(f"{path} does not end with a JSON array")
+        body = tail[:-1].rstrip()
+        empty = body.endswith(b'[')
+        try:
+            f.seek(tail_start + len(body))
+            f.truncate()
+            for record in records:
+                encoded = json.dumps(record, indent=4).replace('\n', '\n    ')
+                f.write((('\n    ' if empty else ',\n    ') + encoded).encode('utf-8'))
+                empty = False
+            f.write(b'\n]')
+        except BaseException:
+            f.seek(tail_start)
+            f.truncate()
+            f.write(original_tail)
+            raise
+
+def stage0_check_new_data(new_data_path, old_data_path, merged_data_path, new_entries_path,
+                          index_path=None, diff_mode="content", deleted_entries_path=None):
+    """
+    - Loads new_data and hashes each incoming record,
+    - Compares the hashes with a sidecar index of the old database; the old database
+      itself is only read to rebuild the index, when it is missing or was not written
+      for the old file as it is now (checked by size and modification time),
     - Writes out:
-        1) A merged dataset (old + new) to `merged_data_path`
+        1) The merged dataset to `merged_data_path`
         2) The list of truly new entries to `new_entries_path`.
+    - Updates the index so it describes the merged data, which becomes the old
+      database for the next run.
 
-    Returns the merged_data (list of dicts) so it can be passed to subsequent stages.
+    diff_mode:
+      - "content": any record whose content is unseen is new. The new records are
+        appended to the old database file (copied to `merged_data_path` first unless
+        both paths are the same file), so the cost grows with the new data only.
+      - "keyed": new_data is treated as a full snapshot keyed on (dataset, unique_id).
+        Each record gets a `change_type` of "added", "modified" or "unchanged";
+        keys missing from the snapshot are "deleted", written to `deleted_entries_path`
+        and dropped from the merged data, which is the snapshot. Added and modified
+        records get is_new=True.
+
+    Returns the truly new entries. Use `load_merged_data` to read the merged data with
+    its is_new/change_type flags for the later stages.
     """
+    if index_path is None:
+        index_path = default_index_path(old_data_path)
+    if diff_mode not in ("content", "keyed"):
+        raise ValueError(f"Unknown diff mode: {diff_mode}")
 
     # Load new data
     with open(new_data_path, 'r', encoding='utf-8') as f:
         new_data = json.load(f)
 
-    # Attempt to load old data
+    # Only the index of the old database is read, unless it has to be rebuilt
     if os.path.exists(old_data_path):
-        with open(old_data_path, 'r', encoding='utf-8') as f:
-            old_data = json.load(f)
-        logger.info(f"Loaded old database with {len(old_data)} entries from {old_data_path}")
+        old_entries = load_hash_index(index_path)
+        if _index_matches(index_path, old_entries, old_data_path):
+            logger.info(f"Using content-hash index with {len(old_entries)} entries from {index_path}")
+        else:
+            old_entries = _rebuild_index(index_path, old_data_path)
     else:
-        old_data = []
         logger.info(f"No old database found at {old_data_path}; starting fresh.")
+        old_entries = []
+        write_hash_index(index_path, old_entries)
 
-    # Convert each record to a frozenset of items so we can deduplicate
-    old_data_set = {frozenset(d.items()) for d in old_data}
-    new_data_set = {frozenset(d.items()) for d in new_data}
-
-    # Identify truly new entries
-    truly_new_entries_set = new_data_set - old_data_set
-    truly_new_entries = [dict(fs) for fs in truly_new_entries_set]
-
-    # Merge old + new
-    merged_data_set = old_data_set | new_data_set
-    merged_data = [dict(fs) for fs in merged_data_set]
-
-    logger.info(f"Merged dataset has {len(merged_data)} total entries.")
-    logger.info(f"Found {len(truly_new_entries)} new entries not in the old database.")
-
-    # Mark is_new=True on truly new, else False
-    for item in merged_data:
-        if frozenset(item.items()) in truly_new_entries_set:
-            item["is_new"] = True
+    if diff_mode == "keyed":
+        merged_data, truly_new_entries, deleted_keys, index_entries = _diff_keyed(new_data, old_entries)
+        logger.info(f"Merged dataset has {len(merged_data)} total entries.")
+        # The snapshot replaces the old database. Written to a temporary file and swapped
+        # in, because the old database may be a hard link to the previous merged file.
+        tmp_merged_path = f"{merged_data_path}.tmp"
+        with open(tmp_merged_path, 'w', encoding='utf-8') as f:
+            json.dump(merged_data, f, indent=4)
+        os.replace(tmp_merged_path, merged_data_path)
+    else:
+        truly_new_entries, index_entries = _diff_content(new_data, old_entries)
+        deleted_keys = []
+        logger.info(f"Merged dataset has {len(old_entries) + len(truly_new_entries)} total entries.")
+        new_records = [{k: v for k, v in d.items() if k not in PIPELINE_FIELDS} for d in truly_new_entries]
+        if not os.path.exists(old_data_path):
+            with open(merged_data_path, 'w', encoding='utf-8') as f:
+                json.dump(new_records, f, indent=4)
         else:
-            item["is_new"] = False
-
-    # Save the merged dataset
-    with open(merged_data_path, 'w', encoding='utf-8') as f:
-        json.dump(merged_data, f, indent=4)
+            if not (os.path.exists(merged_data_path) and os.path.samefile(old_data_path, merged_data_path)):
+                shutil.copyfile(old_data_path, merged_data_path)
+            _append_json_records(merged_data_path, new_records)
+    logger.info(f"Found {len(truly_new_entries)} new entries not in the old database.")
     logger.info(f"Merged data written to {merged_data_path}")
 
     # Save new entries (if you want to track them separately)
     with open(new_entries_path, 'w', encoding='utf-8') as f:
-        json.dump(truly_new_entries, f, indent=4)
+        json.dump([{k: v for k, v in d.items() if k not in PIPELINE_FIELDS} for d in truly_new_entries], f, indent=4)
     logger.info(f"New entries written to {new_entries_path}")
 
+    if diff_mode == "keyed":
+        if deleted_entries_path is None:
+            deleted_entries_path = os.path.join(os.path.dirname(new_entries_path), "deleted_entries.json")
+        with open(deleted_entries_path, 'w', encoding='utf-8') as f:
+            json.dump([{"dataset": dataset, "unique_id": unique_id} for dataset, unique_id in deleted_keys], f, indent=4)
+        logger.info(f"Deleted entries written to {deleted_entries_path}")
+        # The snapshot replaces the old database, so the index is rewritten
+        write_hash_index(index_path, index_entries)
+    else:
+        # Index now describes old + new
+        write_hash_index(index_path, index_entries, append=True)
+    write_index_meta(index_path, merged_data_path, len(old_entries), diff_mode)
+    logger.info(f"Updated content-hash index at {index_path}")
+
+    return truly_new_entries
+
+def load_merged_data(merged_data_path, index_path):
+    """
+    Load the merged data written by `stage0_check_new_data`, with the `is_new` and
+    `change_type` of each record from that run. After a content diff, records after
+    the old ones are new, and records repeating the content of an earlier one (as an
+    old database may hold) are dropped, using the hashes in the index.
+    """
+    with open(merged_data_path, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+    meta = load_index_meta(index_path)
+    if meta is not None and meta["diff_mode"] == "keyed":
+        return records
+
+    num_old = meta["num_old"] if meta is not None else len(records)
+    entries = load_hash_index(index_path)
+    if entries is None or len(entries) != len(records):
+        entries = [(record_hash(d), None) for d in records]
+    merged_data = []
+    seen = set()
+    for position, (record, (h, _)) in enumerate(zip(records, entries)):
+        if h in seen:
+            continue
+        seen.add(h)
+        is_new = position >= num_old
+        record["is_new"] = is_new
+        record["change_type"] = "added" if is_new else "unchanged"
+        merged_data.append(record)
+    if len(merged_data) < len(records):
+        logger.info(f"Dropped {len(records) - len(merged_data)} records repeating earlier ones in {merged_data_path}")
     return merged_data
+
+def _diff_content(new_data, old_entries):
+    """Additive diff: returns the new entries and the index entries to append."""
+    known_hashes = {h for h, _ in old_entries}
+
+    # Identify truly new entries (also dropping duplicates within the new file)
+    truly_new_entries = []
+    new_index_entries = []
+    for record in new_data:
+        h = record_hash(record)
+        if h in known_hashes:
+            continue
+        known_hashes.add(h)
+        new_index_entries.append((h, record_key(record, h)))
+        truly_new_entries.append(record)
+
+    for item in truly_new_entries:
+        item["is_new"] = True
+        item["change_type"] = "added"
+    return truly_new_entries, new_index_entries
+
+def _diff_keyed(new_data, old_entries):
+    """
+    Snapshot diff keyed on (dataset, unique_id): returns the merged data (the snapshot
+    with change_type/is_new set), the added + modified entries, the deleted keys and
+    the index entries describing the snapshot.
+    """
+    old_hash_by_key = {key: h for h, key in old_entries}
+
+    merged_data = []
+    changed_entries = []
+    index_entries = []
+    seen_keys = set()
+    counts = {"added": 0, "modified": 0, "unchanged": 0}
+    duplicates = 0
+    for record in new_data:
+        h = record_hash(record)
+        key = record_key(record, h)
+        if key in seen_keys:
+            duplicates += 1
+            continue
+        seen_keys.add(key)
+
+        old_hash = old_hash_by_key.get(key)
+        if old_hash is None:
+            change_type = "added"
+        elif old_hash != h:
+            change_type = "modified"
+        else:
+            change_type = "unchanged"
+        counts[change_type] += 1
+
+        record["change_type"] = change_type
+        record["is_new"] = change_type != "unchanged"
+        merged_data.append(record)
+        index_entries.append((h, key))
+        if record["is_new"]:
+            changed_entries.append(record)
+
+    deleted_keys = [key for key in old_hash_by_key if key not in seen_keys and key[0] != "#content"]
+    deleted_keys.sort()
+    deleted_content = sum(1 for key in old_hash_by_key if key not in seen_keys and key[0] == "#content")
+
+    if duplicates:
+        logger.warning(f"Ignored {duplicates} records repeating a (dataset, unique_id) key in the new data.")
+    logger.info(
+        f"Keyed diff: {counts['added']} added, {counts['modified']} modified, "
+        f"{counts['unchanged']} unchanged, {len(deleted_keys) + deleted_content} deleted."
+    )
+    return merged_data, changed_entries, deleted_keys, index_entries
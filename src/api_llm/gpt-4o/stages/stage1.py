@@ -1,14 +1,45 @@
 import json
 import re
 import logging
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 
-def stage1_load_and_preprocess_data(data=None):
+WHITESPACE_RE = re.compile(r'\s+')
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+# Below this many distinct names, process start-up costs more than it saves
+PARALLEL_MIN_NAMES = 200_000
+
+def preprocess_name(name):
+    name = name.lower()
+    name = WHITESPACE_RE.sub(' ', name)
+    name = PUNCTUATION_RE.sub('', name)
+    return name.strip()
+
+def raw_combined_name(entry):
+    return ' '.join(filter(None, [entry.get('name', ''), entry.get('short_name', '')]))
+
+def normalise_names(raw_names, n_jobs=1):
+    """
+    Normalise each distinct raw name once and return a {raw_name: normalised_name} mapping.
+    Uses a process pool when n_jobs > 1 and there are enough distinct names to be worth it.
+    """
+    distinct_names = list(dict.fromkeys(raw_names))
+    if n_jobs > 1 and len(distinct_names) >= PARALLEL_MIN_NAMES:
+        chunksize = max(1, len(distinct_names) // (n_jobs * 16))
+        with Pool(processes=n_jobs) as pool:
+            normalised = pool.map(preprocess_name, distinct_names, chunksize=chunksize)
+    else:
+        normalised = [preprocess_name(name) for name in distinct_names]
+    return dict(zip(distinct_names, normalised))
+
+def stage1_load_and_preprocess_data(data=None, n_jobs=1):
     """
     Load and preprocess the merged data (or fallback to reading from disk).
     Convert 'name' + 'short_name' into a single 'combined_name' field.
-    Preserve 'is_new' so that we can identify new entries later.
+    Preserve 'is_new' and 'change_type' so that we can identify new entries later.
+    Each distinct raw name is normalised only once.
     """
 
     if data is None:
@@ -16,25 +47,22 @@ def stage1_load_and_preprocess_data(data=None):
         with open('/home/ubuntu/OrgSync/data/raw/uk_data.json', 'r') as file:
             data = json.load(file)
 
-    def preprocess_name(name):
-        name = name.lower()
-        name = re.sub(r'\s+', ' ', name)
-        name = re.sub(r'[^\w\s]', '', name)
-        return name.strip()
+    raw_names = [raw_combined_name(entry) for entry in data]
+    normalised_lookup = normalise_names(raw_names, n_jobs=n_jobs)
+    logger.info(f"Normalised {len(normalised_lookup)} distinct names for {len(raw_names)} entries.")
 
-    def combine_entry(entry):
-        combined_name = preprocess_name(
-            ' '.join(filter(None, [entry.get('name', ''), entry.get('short_name', '')]))
-        )
+    def combine_entry(entry, raw_name):
         return {
-            "combined_name": combined_name,
+            "combined_name": normalised_lookup[raw_name],
             "dataset": entry.get("dataset", ""),
             "unique_id": entry.get("unique_id", ""),
             "postcode": entry.get("postcode", ""),
             # Carry over the is_new flag if present, else False
             "is_new": entry.get("is_new", False),
+            # added / modified / unchanged, as classified by stage 0
+            "change_type": entry.get("change_type", ""),
         }
 
-    preprocessed_data = [combine_entry(entry) for entry in data]
+    preprocessed_data = [combine_entry(entry, raw_name) for entry, raw_name in zip(data, raw_names)]
     logger.info(f"Loaded and preprocessed {len(preprocessed_data)} entries.")
     return preprocessed_data
@@ -3,15 +3,17 @@ from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 
-def stage2_identify_identical_names(preprocessed_data):
+def stage2_identify_identical_names(preprocessed_data, as_record_ids=False):
     """
-    Identify groups of entries that share the exact same 'combined_name'.
-    Return a dict: { <combined_name>: [list_of_entries_with_that_name], ... }
-    excluding any groups of size 1.
+    Identify groups of entries that share the same canonical key (see stages/canonical.py),
+    falling back to the exact 'combined_name' for entries without one.
+    Return a dict: { <canonical_key>: [list_of_entries_with_that_key], ... }
+    excluding any groups of size 1. With `as_record_ids`, the lists hold the positions
+    of the entries in `preprocessed_data` instead of the entries themselves.
     """
     name_groups = defaultdict(list)
-    for entry in preprocessed_data:
-        name_groups[entry["combined_name"]].append(entry)
+    for row, entry in enumerate(preprocessed_data):
+        name_groups[entry.get("canonical_key") or entry["combined_name"]].append(row if as_record_ids else entry)
 
     # Filter out single-entry groups
     multi_name_groups = {name: entries for name, entries in name_groups.items() if len(entries) > 1}
@@ -1,23 +1,161 @@
+import json
 import logging
+import os
+import pickle
+from collections import Counter, defaultdict
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
+from stages.artifacts import save_sparse_matrix, load_sparse_matrix
+from stages.hashing_vectorizer import ChunkedHashingVectorizer
 
 logger = logging.getLogger(__name__)
 
-def stage3_vectorize_names(preprocessed_data):
+def canonical_name(entry):
+    """The name an entry is vectorized and searched under (see `add_canonical_names`)."""
+    return entry.get('canonical_name') or entry['combined_name']
+
+def distinct_names(unique_entries):
+    """
+    The distinct canonical names of `unique_entries` (their 'combined_name' if they have
+    none), in order of first appearance. Row i of the stage 3 name vectors corresponds
+    to distinct_names(unique_entries)[i].
+    """
+    return list(dict.fromkeys(canonical_name(entry) for entry in unique_entries))
+
+def name_table_names(unique_entries):
+    """
+    `distinct_names`, followed by every other distinct 'combined_name' in order of
+    first appearance, so name ID i < number of vector rows is also row i.
+    """
+    names = dict.fromkeys(distinct_names(unique_entries))
+    names.update(dict.fromkeys(entry['combined_name'] for entry in unique_entries))
+    return list(names)
+
+def add_canonical_names(unique_entries):
+    """
+    Give names that share a canonical key (see stages/canonical.py), e.g. "acme ltd",
+    "acme limited" and "acme", one 'canonical_name': the key's most common
+    'combined_name' (ties go to the alphabetically first). Later stages vectorize and
+    search each canonical name once, and stage 4 groups the variants together.
+    'combined_name' is left as it is. Returns new entry dicts.
+    """
+    names_by_key = defaultdict(Counter)
+    for entry in unique_entries:
+        names_by_key[entry.get("canonical_key") or entry["combined_name"]][entry["combined_name"]] += 1
+    representative = {
+        key: min(counts, key=lambda name: (-counts[name], name)) for key, counts in names_by_key.items()
+    }
+    named_entries = [
+        dict(entry, canonical_name=representative[entry.get("canonical_key") or entry["combined_name"]])
+        for entry in unique_entries
+    ]
+    num_names = len({entry["combined_name"] for entry in unique_entries})
+    logger.info(f"Mapped {num_names} distinct names to {len(representative)} canonical names.")
+    return named_entries
+
+def stage3_vectorize_names(preprocessed_data, model_dir=None, incremental=False, max_drift=0.1,
+                           engine='tfidf', hashing_options=None, n_jobs=1):
     """
     Converts each dictionary entry to a frozenset so we only remove truly duplicate
-    dictionaries. Then vectorizes the 'combined_name' field for similarity checks later.
+    dictionaries, and gives names sharing a canonical key one canonical name
+    (`add_canonical_names`). Then vectorizes each distinct canonical name once, so names
+    shared by many records get a single row (see `distinct_names` for the row order).
+
+    If `model_dir` is given, the fitted vectorizer and the vectors of every name seen so
+    far are persisted there. With `incremental=True`, the persisted model is reused and
+    only names it has not seen are transformed, until the number of names added since
+    the last full fit exceeds `max_drift` times the number it was fitted on.
+
+    With `engine='hashing'`, names are instead vectorized by a vocabulary-free
+    ChunkedHashingVectorizer (configured by `hashing_options`), in chunks across
+    `n_jobs` processes. It is cheap to recompute, so it is not persisted.
     """
     # Make entire entry hashable -> remove exact duplicates
     unique_entries = list({frozenset(entry.items()): entry for entry in preprocessed_data}.values())
+    unique_entries = add_canonical_names(unique_entries)
+
+    # Extract the distinct combined names for vectorization
+    unique_combined_names = distinct_names(unique_entries)
 
-    # Extract the combined names for vectorization
-    unique_combined_names = [entry['combined_name'] for entry in unique_entries]
-    total_unique_entries = len(unique_entries)
+    if engine == 'hashing':
+        vectorizer = ChunkedHashingVectorizer(n_jobs=n_jobs, **(hashing_options or {}))
+        name_vectors = vectorizer.fit_transform(unique_combined_names)
+        logger.info(
+            f"Vectorized {len(unique_combined_names)} distinct names for {len(unique_entries)} unique entries "
+            f"with feature hashing."
+        )
+        return vectorizer, name_vectors, unique_entries
+    if engine != 'tfidf':
+        raise ValueError(f"Unknown vectorizer engine: {engine}")
+
+    model = load_tfidf_model(model_dir) if (incremental and model_dir) else None
+    if model is not None:
+        vectorizer, name_vectors = _transform_incremental(model, unique_combined_names, model_dir, max_drift)
+        if name_vectors is not None:
+            return vectorizer, name_vectors, unique_entries
 
     # Vectorize those combined names
     vectorizer = TfidfVectorizer().fit(unique_combined_names)
     name_vectors = vectorizer.transform(unique_combined_names)
+    if model_dir:
+        save_tfidf_model(model_dir, vectorizer, unique_combined_names, name_vectors,
+                         fitted_names=len(unique_combined_names), added_since_fit=0)
 
-    logger.info(f"Vectorized {total_unique_entries} unique entries based on full uniqueness.")
+    logger.info(
+        f"Vectorized {len(unique_combined_names)} distinct names for {len(unique_entries)} unique entries."
+    )
     return vectorizer, name_vectors, unique_entries
+
+def _transform_incremental(model, names, model_dir, max_drift):
+    """
+    Reuse the persisted vectors and transform only unseen names. Returns (vectorizer, None)
+    if the drift limit would be exceeded and a full refit is needed.
+    """
+    vectorizer = model["vectorizer"]
+    cached_rows = {name: row for row, name in enumerate(model["names"])}
+    missing = [name for name in names if name not in cached_rows]
+    added_since_fit = model["state"]["added_since_fit"] + len(missing)
+    drift = added_since_fit / max(1, model["state"]["fitted_names"])
+    if drift > max_drift:
+        logger.info(f"TF-IDF drift {drift:.3f} exceeds {max_drift}; refitting on the full corpus.")
+        return vectorizer, None
+
+    all_vectors = model["vectors"]
+    if missing:
+        all_vectors = sparse.vstack([all_vectors, vectorizer.transform(missing)], format='csr')
+        for name in missing:
+            cached_rows[name] = len(cached_rows)
+        save_tfidf_model(model_dir, vectorizer, model["names"] + missing, all_vectors,
+                         fitted_names=model["state"]["fitted_names"], added_since_fit=added_since_fit)
+    name_vectors = all_vectors[[cached_rows[name] for name in names]]
+    logger.info(
+        f"Reused TF-IDF model: transformed {len(missing)} new names, reused {len(names) - len(missing)} "
+        f"(drift {drift:.3f} of {max_drift})."
+    )
+    return vectorizer, name_vectors
+
+def save_tfidf_model(model_dir, vectorizer, names, vectors, fitted_names, added_since_fit):
+    """Persist the vectorizer, the names it has vectorized and their vectors."""
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, 'vectorizer.pkl'), 'wb') as f:
+        pickle.dump(vectorizer, f)
+    with open(os.path.join(model_dir, 'names.json'), 'w') as f:
+        json.dump(names, f)
+    save_sparse_matrix(vectors, os.path.join(model_dir, 'vectors'))
+    with open(os.path.join(model_dir, 'state.json'), 'w') as f:
+        json.dump({"fitted_names": fitted_names, "added_since_fit": added_since_fit}, f, indent=2)
+
+def load_tfidf_model(model_dir):
+    """Load a model saved with `save_tfidf_model`, or None if there is none."""
+    state_path = os.path.join(model_dir, 'state.json')
+    if not os.path.exists(state_path):
+        logger.info(f"No persisted TF-IDF model at {model_dir}; fitting from scratch.")
+        return None
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    with open(os.path.join(model_dir, 'vectorizer.pkl'), 'rb') as f:
+        vectorizer = pickle.load(f)
+    with open(os.path.join(model_dir, 'names.json'), 'r') as f:
+        names = json.load(f)
+    vectors = load_sparse_matrix(os.path.join(model_dir, 'vectors'))
+    return {"vectorizer": vectorizer, "names": names, "vectors": vectors, "state": state}
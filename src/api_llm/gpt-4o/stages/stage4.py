@@ -1,35 +1,177 @@
+import hashlib
+import json
 import logging
-from collections import defaultdict
+import os
+from collections import Counter, defaultdict
+import numpy as np
 from sklearn.neighbors import NearestNeighbors
+from stages.stage3 import distinct_names, canonical_name
+from stages.knn import blockwise_kneighbors, lsh_kneighbors, candidate_kneighbors, knn_recall
+from stages.blocking import blocking_candidate_pairs
+from stages.grouping import graph_group_labels, groups_from_labels, MAX_GROUP_SIZE
+from stages.artifacts import save_array
+from stages.knn_index import load_neighbor_index, save_neighbor_index, incremental_neighbors
 
 logger = logging.getLogger(__name__)
 
-def stage4_group_similar_names(vectorizer, name_vectors, unique_entries, threshold=0.5):
+def log_recall(name_vectors, distances, indices, threshold, recall_sample, label):
+    """Log the recall of approximate neighbours against exact search on a sample of names."""
+    if not recall_sample or threshold is None:
+        return
+    recall = knn_recall(name_vectors, distances, indices, threshold, sample_size=recall_sample)
+    if recall is None:
+        logger.info(f"{label} recall: no neighbours within {threshold} in a sample of {recall_sample} names.")
+    else:
+        logger.info(f"{label} recall vs exact search on {recall_sample} sampled names: {recall:.3f}")
+
+def find_neighbors(name_vectors, n_neighbors=10, engine='brute', threshold=None, block_size=1024, n_jobs=1,
+                   lsh_options=None, recall_sample=0):
     """
-    Groups 'unique_entries' whose 'combined_name' fields are similar
-    based on the TF-IDF vectors and a cosine distance threshold.
-    
-    Returns a dict of the form:
-    {
-       <representative_name>: {
-          "matched_names": [other similar names],
-          "items": [the full item dicts (representative + matched)]
-       },
-       ...
-    }
+    Cosine k-nearest neighbours of every row of `name_vectors`, as (distances, indices).
+
+    engine:
+      - "brute": sklearn NearestNeighbors over the whole matrix at once.
+      - "blockwise": chunked sparse products pruned at `threshold` (stages/knn.py);
+        neighbours beyond the threshold come back at distance inf.
+      - "lsh": approximate; MinHash/LSH candidate pairs (configured by `lsh_options`)
+        scored exactly. If `recall_sample` > 0, recall against exact search on that
+        many sampled names is logged.
     """
+    n_neighbors = min(n_neighbors, name_vectors.shape[0])
+    if engine == 'blockwise':
+        return blockwise_kneighbors(
+            name_vectors, n_neighbors=n_neighbors, threshold=threshold,
+            block_size=block_size, n_jobs=n_jobs
+        )
+    if engine == 'lsh':
+        distances, indices = lsh_kneighbors(
+            name_vectors, n_neighbors=n_neighbors, threshold=threshold, **(lsh_options or {})
+        )
+        log_recall(name_vectors, distances, indices, threshold, recall_sample, "LSH")
+        return distances, indices
+    if engine != 'brute':
+        raise ValueError(f"Unknown kNN engine: {engine}")
+    nbrs = NearestNeighbors(
+        n_neighbors=n_neighbors, metric='cosine', algorithm='brute', n_jobs=n_jobs
+    ).fit(name_vectors)
+    return nbrs.kneighbors(name_vectors)
 
-    # We'll need quick access from combined_name -> item dicts
+def prepare_names(name_vectors, unique_entries):
+    """
+    Returns (all_names, name_to_itemlist, name_vectors) with one vector row per
+    distinct canonical name, in the order of `distinct_names`. `name_to_itemlist`
+    maps each canonical name to the item dicts of all its name variants.
+    """
+    # We'll need quick access from canonical name -> item dicts
     name_to_itemlist = defaultdict(list)
     for entry in unique_entries:
-        nm = entry["combined_name"]
+        nm = canonical_name(entry)
         name_to_itemlist[nm].append(entry)
 
-    all_names = [entry["combined_name"] for entry in unique_entries]
-    nbrs = NearestNeighbors(n_neighbors=10, metric='cosine', algorithm='brute').fit(name_vectors)
-    distances, indices = nbrs.kneighbors(name_vectors)
+    # One row per distinct name (stage 3 vectorizes each name once)
+    all_names = distinct_names(unique_entries)
+    if name_vectors.shape[0] != len(all_names):
+        # Older artifacts have one row per entry; keep the first row of each name
+        first_rows = {}
+        for row, entry in enumerate(unique_entries):
+            first_rows.setdefault(canonical_name(entry), row)
+        name_vectors = name_vectors[[first_rows[nm] for nm in all_names]]
+    return all_names, name_to_itemlist, name_vectors
 
+def search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, n_neighbors=10, engine='brute',
+                     block_size=1024, n_jobs=1, lsh_options=None, recall_sample=0, blocking=None,
+                     blocking_options=None):
+    """
+    Neighbours of every distinct name as (distances, indices): with `find_neighbors`
+    using the given kNN `engine`, or, if `blocking` strategies are given (see
+    stages/blocking.py), only among names that share a block.
+    """
+    if blocking:
+        left, right = blocking_candidate_pairs(
+            all_names, name_to_itemlist, strategies=blocking, **(blocking_options or {})
+        )
+        distances, indices = candidate_kneighbors(
+            name_vectors, left, right, n_neighbors=n_neighbors, threshold=threshold
+        )
+        log_recall(name_vectors, distances, indices, threshold, recall_sample, "Blocking")
+        return distances, indices
+    return find_neighbors(
+        name_vectors, n_neighbors=n_neighbors, engine=engine, threshold=threshold,
+        block_size=block_size, n_jobs=n_jobs, lsh_options=lsh_options, recall_sample=recall_sample
+    )
+
+def indexed_neighbors(index_dir, all_names, name_to_itemlist, name_vectors, threshold, incremental=False,
+                      **search_options):
+    """
+    `search_neighbors`, persisting the kNN graph to `index_dir` (see stages/knn_index.py).
+    With `incremental`, the saved graph is updated by querying only names that are new
+    since it was saved; a full search is done if there is no usable index.
+    Approximate searches (lsh, blocking) are not indexed.
+    """
+    if search_options.get("blocking") or search_options.get("engine") == 'lsh':
+        logger.info("Neighbour index is only kept for exact kNN engines; running a full search.")
+        return search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, **search_options)
+
+    n_neighbors = search_options.get("n_neighbors", 10)
+    result = None
+    if incremental:
+        index = load_neighbor_index(index_dir)
+        if index is None:
+            logger.info(f"No neighbour index at {index_dir}; running a full search.")
+        else:
+            result = incremental_neighbors(
+                index, all_names, name_vectors, n_neighbors, threshold,
+                block_size=search_options.get("block_size", 1024)
+            )
+    if result is None:
+        result = search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, **search_options)
+    distances, indices = result
+    save_neighbor_index(
+        index_dir, all_names, name_vectors, distances, indices,
+        {"n_neighbors": n_neighbors, "threshold": threshold}
+    )
+    return distances, indices
+
+def variant_names(name, items):
+    """`name` followed by the other distinct 'combined_name's of `items`, sorted."""
+    return [name] + sorted({item["combined_name"] for item in items} - {name})
+
+def group_neighbors(all_names, name_to_itemlist, name_vectors, distances, indices, threshold,
+                    grouping='greedy', linkage='single', max_group_size=MAX_GROUP_SIZE):
+    """
+    Groups names from their neighbours within `threshold`. A name shared by several
+    records forms a group even if it has no neighbours, so those records still reach
+    the later stages. Names are the canonical names of `prepare_names`; each group
+    lists the record names (variants) of all its canonical names.
+
+    grouping:
+      - "greedy": names are visited in list order and each claims its unclaimed
+        neighbours within the threshold.
+      - "graph": groups are formed from the thresholded neighbour graph with the given
+        `linkage` (see stages/grouping.py), with no group larger than `max_group_size`;
+        independent of input order.
+    """
     grouped_names = {}
+    if grouping == 'graph':
+        labels, graph = graph_group_labels(
+            distances, indices, threshold, all_names, linkage=linkage, name_vectors=name_vectors,
+            max_group_size=max_group_size
+        )
+        shared = np.array([len(name_to_itemlist[nm]) > 1 for nm in all_names], dtype=bool)
+        for representative, members in groups_from_labels(labels, graph, all_names, keep_singletons=shared):
+            group_names = [all_names[representative]] + [all_names[m] for m in members]
+            grouped_names[group_names[0]] = {
+                "matched_names": [
+                    variant for gnm in group_names
+                    for variant in variant_names(gnm, name_to_itemlist[gnm])
+                ][1:],
+                "items": [item for gnm in group_names for item in name_to_itemlist[gnm]],
+            }
+        logger.info(f"Grouped names into {len(grouped_names)} groups (size >= 2 records) with {linkage} linkage.")
+        return grouped_names
+    if grouping != 'greedy':
+        raise ValueError(f"Unknown grouping mode: {grouping}")
+
     used_names = set()
 
     for i, name in enumerate(all_names):
@@ -44,13 +186,17 @@ def stage4_group_similar_names(vectorizer, name_vectors, unique_entries, thresho
                     similar_names.append(neighbor_name)
 
         all_group_names = [name] + similar_names
-        if len(all_group_names) > 1:
+        # A name with several records is a group of its own even without neighbours
+        if len(all_group_names) > 1 or len(name_to_itemlist[name]) > 1:
             # Mark them as 'used'
             for gnm in all_group_names:
                 used_names.add(gnm)
 
             grouped_names[name] = {
-                "matched_names": similar_names,
+                "matched_names": [
+                    variant for gnm in all_group_names
+                    for variant in variant_names(gnm, name_to_itemlist[gnm])
+                ][1:],
                 # Gather all the item dicts from each group name
                 "items": [
                     item
@@ -63,5 +209,144 @@ def stage4_group_similar_names(vectorizer, name_vectors, unique_entries, thresho
             # (or handle singletons if you want them)
             continue
 
-    logger.info(f"Grouped names into {len(grouped_names)} groups (size >= 2).")
+    logger.info(f"Grouped names into {len(grouped_names)} groups (size >= 2 records).")
     return grouped_names
+
+def stage4_group_similar_names(vectorizer, name_vectors, unique_entries, threshold=0.5,
+                               n_neighbors=10, engine='brute', block_size=1024, n_jobs=1,
+                               lsh_options=None, recall_sample=0, blocking=None, blocking_options=None,
+                               grouping='greedy', linkage='single', max_group_size=MAX_GROUP_SIZE,
+                               index_dir=None, incremental=False):
+    """
+    Groups 'unique_entries' whose 'combined_name' fields are similar
+    based on the TF-IDF vectors and a cosine distance threshold.
+    Neighbours are found with `search_neighbors` and grouped with `group_neighbors`.
+    If `index_dir` is given, the neighbour graph is persisted there and, with
+    `incremental`, only names new since the last run are queried (`indexed_neighbors`).
+    
+    Returns a dict of the form:
+    {
+       <representative_name>: {
+          "matched_names": [other similar names],
+          "items": [the full item dicts (representative + matched)]
+       },
+       ...
+    }
+    """
+    all_names, name_to_itemlist, name_vectors = prepare_names(name_vectors, unique_entries)
+    search_options = dict(
+        n_neighbors=n_neighbors, engine=engine, block_size=block_size, n_jobs=n_jobs,
+        lsh_options=lsh_options, recall_sample=recall_sample, blocking=blocking,
+        blocking_options=blocking_options
+    )
+    if index_dir:
+        distances, indices = indexed_neighbors(
+            index_dir, all_names, name_to_itemlist, name_vectors, threshold,
+            incremental=incremental, **search_options
+        )
+    else:
+        distances, indices = search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, **search_options)
+    return group_neighbors(
+        all_names, name_to_itemlist, name_vectors, distances, indices, threshold,
+        grouping=grouping, linkage=linkage, max_group_size=max_group_size
+    )
+
+# Upper bounds of the group-size buckets reported by the threshold sweep
+SWEEP_SIZE_BUCKETS = (2, 3, 4, 5, 10, 20, 50, 100)
+
+def _size_bucket(size):
+    for upper in SWEEP_SIZE_BUCKETS:
+        if size <= upper:
+            return str(upper) if upper <= 5 else f"<={upper}"
+    return f">{SWEEP_SIZE_BUCKETS[-1]}"
+
+SWEEP_BUCKET_LABELS = [_size_bucket(upper) for upper in SWEEP_SIZE_BUCKETS] + [_size_bucket(SWEEP_SIZE_BUCKETS[-1] + 1)]
+
+def _neighbor_cache_key(all_names, name_vectors, search_options):
+    """Digest identifying the names, their vectors and the neighbour search settings."""
+    digest = hashlib.sha1()
+    digest.update("\n".join(all_names).encode('utf-8'))
+    vectors = name_vectors.tocsr()
+    for array in (vectors.data, vectors.indices, vectors.indptr):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps(search_options, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+def cached_neighbors(cache_dir, all_names, name_to_itemlist, name_vectors, threshold, **search_options):
+    """
+    `search_neighbors` at `threshold`, cached in `cache_dir`. A cached result is reused
+    if it was computed for the same names, vectors and settings at a threshold at least
+    as loose: the neighbours within a tighter threshold are a prefix of each row.
+    """
+    key = _neighbor_cache_key(all_names, name_vectors, search_options)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta["key"] == key and meta["threshold"] >= threshold:
+            logger.info(f"Using cached neighbours from {cache_dir} (threshold {meta['threshold']}).")
+            distances = np.load(os.path.join(cache_dir, "distances.npy"))
+            indices = np.load(os.path.join(cache_dir, "indices.npy"))
+            return distances, indices
+
+    distances, indices = search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, **search_options)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_array(distances, os.path.join(cache_dir, "distances.npy"))
+    save_array(indices, os.path.join(cache_dir, "indices.npy"))
+    with open(meta_path, 'w') as f:
+        json.dump({"key": key, "threshold": threshold}, f)
+    logger.info(f"Cached neighbours at threshold {threshold} in {cache_dir}")
+    return distances, indices
+
+def stage4_sweep_thresholds(name_vectors, unique_entries, thresholds, cache_dir, new_data_only=False,
+                            grouping='greedy', linkage='single', max_group_size=MAX_GROUP_SIZE,
+                            **search_options):
+    """
+    Groups names at each of `thresholds` from a single neighbour search at the loosest
+    one (cached in `cache_dir`, see `cached_neighbors`), and summarises each result:
+    number of groups, names grouped, a group-size histogram and the projected load on
+    the later stages (one web search per grouped canonical name in stage 5, one LLM
+    call per group of two or more names in stage 6). With `new_data_only`, only groups containing new entries count,
+    as in `--data-mode new`.
+
+    Returns a list of per-threshold summary dicts, in the order of `thresholds`.
+    """
+    all_names, name_to_itemlist, name_vectors = prepare_names(name_vectors, unique_entries)
+    distances, indices = cached_neighbors(
+        cache_dir, all_names, name_to_itemlist, name_vectors, max(thresholds), **search_options
+    )
+
+    summaries = []
+    for threshold in thresholds:
+        grouped_names = group_neighbors(
+            all_names, name_to_itemlist, name_vectors, distances, indices, threshold,
+            grouping=grouping, linkage=linkage, max_group_size=max_group_size
+        )
+        if new_data_only:
+            grouped_names = {
+                rep_name: info for rep_name, info in grouped_names.items()
+                if any(item.get("is_new", False) for item in info["items"])
+            }
+        sizes = [1 + len(info["matched_names"]) for info in grouped_names.values()]
+        histogram = Counter(_size_bucket(size) for size in sizes)
+        summaries.append({
+            "threshold": threshold,
+            "groups": len(grouped_names),
+            "grouped_names": sum(sizes),
+            "largest_group": max(sizes, default=0),
+            "group_size_histogram": {
+                bucket: histogram[bucket] for bucket in SWEEP_BUCKET_LABELS if histogram[bucket]
+            },
+            "projected_web_searches": sum(
+                len({canonical_name(item) for item in info["items"]}) for info in grouped_names.values()
+            ),
+            "projected_llm_calls": sum(1 for info in grouped_names.values() if info["matched_names"]),
+        })
+
+    logger.info("threshold  groups  grouped names  largest  web searches  LLM calls")
+    for summary in summaries:
+        logger.info(
+            f"{summary['threshold']:>9}  {summary['groups']:>6}  {summary['grouped_names']:>13}  "
+            f"{summary['largest_group']:>7}  {summary['projected_web_searches']:>12}  {summary['projected_llm_calls']:>9}"
+        )
+    return summaries
@@ -1,48 +1,87 @@
 import logging
-import json
 import os
+import time
 from tqdm import tqdm
-from stages.utils import perform_web_search
+from stages.search_backends import get_backend
+from stages.search_engine import (
+    AdaptiveRateController, ConcurrentSearchEngine, search_limits, load_rate_state, save_rate_state
+)
+from stages.search_store import SearchResultStore, normalise_query
 
 logger = logging.getLogger(__name__)
 
-def stage5_perform_web_search(grouped_names, all_names_and_items, search_method='duckduckgo', num_results=3, output_dir='outputs'):
+def stage5_perform_web_search(grouped_names, all_names_and_items, search_method='duckduckgo', num_results=3, output_dir='outputs',
+                              rate_per_minute=None, max_concurrency=None, max_retries=5, ttl_days=30,
+                              backend_options=None, adaptive=True):
     """
-    - Maintains a rolling database of all web searches in 'all_web_search_results.json'.
-    - For the given search_method, only fetch new results if we have < num_results for that name (or it's absent).
-    - Returns the entire dictionary, but the pipeline typically uses only the sub-dict for the active method.
+    - Maintains a rolling database of all web searches in 'all_web_search_results.sqlite'
+      (see stages/search_store.py), migrating a legacy 'all_web_search_results.json' on first use.
+      Each result is committed as it arrives.
+    - Searches are cached by normalised query, so names producing the same query share one search.
+      A cached search is reused until it is `ttl_days` old (never expires if <= 0), even if it
+      returned fewer than num_results hits or none; it is repeated early only if it asked for
+      fewer than num_results. Names stored before the query cache existed keep the old rule:
+      they are searched again only if they have < num_results results.
+    - Returns {search_method: {name: results}} with every stored result for the active method.
     
     Modification:
       - Use the postcode from all_names_and_items to form the search query as '{name} {postcode}'
+      - Names with a 'canonical_name' (stage 3) are searched under it, so the variants of a name
+        share one search.
+      - Searches run concurrently (`max_concurrency` threads) at a steady `rate_per_minute`
+        (see stages/search_engine.py; defaults depend on the search method).
+      - search_method names a backend in stages/search_backends.py, created with `backend_options`.
+      - With `adaptive`, the rate is tuned as the searches run (AIMD, see AdaptiveRateController) and
+        saved per search method in 'search_rate_state.json', so the next run starts from the learned
+        rate and honours any pause still pending. An explicit rate_per_minute sets the starting rate.
     """
 
-    if search_method == 'duckduckgo':
-        logger.info(f"Due to rate limits, the program will wait for 60 seconds every 20 searches.")
+    limits = search_limits(search_method, rate_per_minute, max_concurrency)
+    controller = None
+    rate_state_path = os.path.join(output_dir, 'search_rate_state.json')
+    if adaptive:
+        controller = AdaptiveRateController(
+            limits["rate_per_minute"], limits["min_rate"], limits["max_rate"],
+            increase=limits["increase"], cooldown=limits["cooldown"]
+        )
+        saved_state = load_rate_state(rate_state_path, search_method)
+        if saved_state:
+            if rate_per_minute:
+                saved_state = dict(saved_state, rate_per_minute=None)
+            controller.restore(saved_state)
+        limits["rate_per_minute"] = controller.rate_per_minute
+    logger.info(
+        f"Searching with {search_method} at {limits['rate_per_minute']:.1f} requests/min"
+        f"{' (adaptive)' if adaptive else ''}, {limits['max_concurrency']} at a time."
+    )
 
-    # Path to the rolling DB
-    rolling_db_path = os.path.join(output_dir, 'all_web_search_results.json')
-
-    # Load existing DB if it exists; else initialize
-    if os.path.exists(rolling_db_path):
-        with open(rolling_db_path, 'r') as f:
-            all_web_search_results = json.load(f)
-        logger.info(f"Loaded existing web search DB from {rolling_db_path}")
-    else:
-        all_web_search_results = {}
-        logger.info("Initializing new web search DB.")
-
-    # Ensure we have a sub-dict for this search method
-    if search_method not in all_web_search_results:
-        logger.info(f"Couldn't find any previous search results using {search_method}")
-        all_web_search_results[search_method] = {}
+    # Open the rolling DB, importing the JSON DB written by earlier versions
+    rolling_db_path = os.path.join(output_dir, 'all_web_search_results.sqlite')
+    with SearchResultStore(rolling_db_path) as store, get_backend(search_method, **(backend_options or {})) as backend:
+        store.migrate_json(os.path.join(output_dir, 'all_web_search_results.json'))
+        logger.info(f"Web search DB at {rolling_db_path} has {store.count(search_method)} results for {search_method}.")
+        try:
+            search_names(store, backend, grouped_names, all_names_and_items, num_results, limits, max_retries, ttl_days,
+                         controller)
+        finally:
+            if controller is not None:
+                save_rate_state(rate_state_path, search_method, controller.state())
+        return {search_method: store.method_results(search_method)}
 
-    # Pre-process all_names_and_items to build a lookup of normalized name -> postcode
+def search_names(store, backend, grouped_names, all_names_and_items, num_results, limits, max_retries, ttl_days,
+                 controller=None):
+    """Search every grouped name without a usable cached search, storing each result as it arrives."""
+    search_method = backend.name
+    # Pre-process all_names_and_items to build a lookup of normalized name -> postcode,
+    # and of each name to the canonical name it is searched under (stage 3)
     postcode_lookup = {}
+    canonical_lookup = {}
     for entry in all_names_and_items:
         key = entry["combined_name"].lower()
         # Use the first postcode encountered for this name
         if key not in postcode_lookup:
             postcode_lookup[key] = entry["postcode"]
+        canonical_lookup.setdefault(key, entry.get("canonical_name") or entry["combined_name"])
 
     # Extract all names from grouped_names
     unique_names = set()
@@ -51,41 +90,76 @@ def stage5_perform_web_search(grouped_names, all_names_and_items, search_method=
         for nm in info["matched_names"]:
             unique_names.add(nm)
 
-    # We'll gather a list of names that need searching
-    names_to_search = []
-    for name in unique_names:
-        existing_results = all_web_search_results[search_method].get(name, [])
-        # If we have fewer than num_results, we do a fresh search
-        if len(existing_results) < num_results:
-            names_to_search.append(name)
-
-    logger.info(f"{len(names_to_search)} out of {len(unique_names)} names need new web searches.")
-
-    # Perform the new/updated searches
-    for name in tqdm(names_to_search, desc='Performing new web searches'):
+    # Build the query for each name, with the postcode if available, and group the
+    # names by normalised query so each distinct query is searched once
+    names_for_query = {}
+    query_text = {}
+    for name in sorted(unique_names):
+        # Variants of a name ("acme limited", "acme") share the search of its canonical name
+        search_name = canonical_lookup.get(name.lower(), name)
         # Look up the postcode for the name (using a case-insensitive key)
-        normalized_name = name.lower()
-        postcode = postcode_lookup.get(normalized_name, "").strip()
-        # Build the query with the postcode if available
-        if postcode:
-            query = f"{name} {postcode}"
-        else:
-            query = name
+        postcode = (postcode_lookup.get(search_name.lower()) or postcode_lookup.get(name.lower()) or "").strip()
+        query = f"{search_name} {postcode}" if postcode else search_name
+        key = normalise_query(query)
+        query_text.setdefault(key, query)
+        names_for_query.setdefault(key, []).append(name)
 
-        try:
-            # Perform search with the constructed query
-            new_results_dict = perform_web_search([query], num_results=num_results, search_method=search_method)
-            # The results are expected to be in the dict with the key as our query
-            found = new_results_dict.get(query, [])
-            # Update the DB entry using the original name as the key
-            all_web_search_results[search_method][name] = found
-        except Exception as e:
-            logger.error(f"Error searching for '{name}': {e}")
-            # Keep old results if something fails
+    now = time.time()
+    max_age = ttl_days * 86400 if ttl_days and ttl_days > 0 else None
+    queries_to_search = {}
+    reused = 0
+    for key, names in names_for_query.items():
+        cached = store.get_query(search_method, key)
+        if cached is not None:
+            fresh = max_age is None or now - cached["searched_at"] < max_age
+            if fresh and cached["num_requested"] >= num_results:
+                # Share the cached search with any name that does not have it yet
+                missing = [name for name in names if store.get(search_method, name) is None]
+                if missing:
+                    store.record_search(search_method, key, missing, cached["results"], cached["num_requested"])
+                reused += 1
+                continue
+        elif all(len(store.get(search_method, name) or []) >= num_results for name in names):
+            # Stored before the query cache existed; keep the old completeness rule
+            continue
+        queries_to_search[query_text[key]] = names
 
-    # Save the updated rolling DB
-    with open(rolling_db_path, 'w') as f:
-        json.dump(all_web_search_results, f, indent=2)
-    logger.info(f"Updated rolling DB saved to {rolling_db_path}")
+    logger.info(
+        f"{len(queries_to_search)} of {len(names_for_query)} distinct queries ({len(unique_names)} names) "
+        f"need new web searches; {reused} answered from the query cache."
+    )
 
-    return all_web_search_results
+    # Perform the new/updated searches
+    engine = ConcurrentSearchEngine(
+        lambda query: backend.search(query, num_results=num_results),
+        rate_per_minute=limits["rate_per_minute"],
+        max_concurrency=limits["max_concurrency"],
+        max_retries=max_retries,
+        controller=controller,
+    )
+    started = time.monotonic()
+    completed = 0
+    with tqdm(total=len(queries_to_search), desc='Performing new web searches') as pbar:
+        for query, found, error in engine.search_many(queries_to_search):
+            names = queries_to_search[query]
+            if error is None:
+                # Cache the search, even if it came back short, and update the DB
+                # entry of every name that produced this query
+                store.record_search(search_method, query, names, found, num_results)
+                completed += 1
+            else:
+                # Failures are not cached; keep old results if something fails
+                logger.error(f"Error searching for '{query}': {error}")
+            pbar.update(1)
+    if queries_to_search:
+        elapsed = time.monotonic() - started
+        achieved = completed / elapsed * 60 if elapsed > 0 else 0.0
+        logger.info(
+            f"Completed {completed} of {len(queries_to_search)} searches in {elapsed:.0f}s "
+            f"({achieved:.1f} queries/min achieved)."
+        )
+        if controller is not None:
+            logger.info(
+                f"Adaptive rate ended at {controller.rate_per_minute:.1f} requests/min "
+                f"after {controller.throttles} throttled requests."
+            )
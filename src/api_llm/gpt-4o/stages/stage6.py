@@ -36,6 +36,11 @@ def stage6_process_groups_with_llm(grouped_names, web_search_results):
     pbar = tqdm(total=num_groups, desc='Processing groups with LLM')
     for unique_name, info in grouped_names.items():
         matched_names_list = info.get("matched_names", [])
+        if not matched_names_list:
+            # One name shared by several records; nothing for the LLM to decide
+            refined_groups[unique_name] = [unique_name]
+            pbar.update(1)
+            continue
         # Build a dict mapping each name in the group to its search results.
         group_names = [unique_name] + matched_names_list
         group_search_results = {
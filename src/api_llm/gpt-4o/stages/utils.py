@@ -1,11 +1,12 @@
 import os
 import sys
-import time
 import random
 import logging
 from pathlib import Path
 import yaml
 from pydantic import BaseModel
+from stages.search_backends import get_backend
+from stages.search_engine import AdaptiveRateController, ConcurrentSearchEngine, search_limits
 
 class GroupResponse(BaseModel):
     selected_names: list[str]
@@ -50,13 +51,7 @@ def configure_environment():
     os.environ['MASTER_ADDR'] = 'localhost'
     os.environ['MASTER_PORT'] = '12355'
 
-# Try importing search modules and model
-try:
-    from googlesearch import search as google_search
-except ImportError:
-    google_search = None
-    logger.warning("Google search module not available.")
-
+# Try importing the model
 try:
     from models.llama3.reference_impl.generation import Llama
     from models.llama3.api.datatypes import (
@@ -69,12 +64,6 @@ except ModuleNotFoundError as e:
     logger.critical(f"Error importing Llama model modules: {e}")
     sys.exit(1)
 
-try:
-    from duckduckgo_search import DDGS
-except ImportError:
-    DDGS = None
-    logger.warning("DuckDuckGo search module not available.")
-
 logger.info("Initializing the Llama generator.")
 generator = Llama.build(
     ckpt_dir=str(DEFAULT_CKPT_DIR),
@@ -88,49 +77,28 @@ def get_generator():
     return generator
 
 def perform_web_search(names, num_results=3, max_retries=5, search_method='duckduckgo', api_key=None):
-    if search_method == 'duckduckgo' and DDGS is None:
-        logger.error("DuckDuckGo search module not available.")
+    try:
+        backend = get_backend(search_method)
+    except RuntimeError as e:
+        logger.error(str(e))
         sys.exit(1)
 
+    # One search at a time, at a rate that backs off when the backend throttles
+    limits = search_limits(search_method)
+    controller = AdaptiveRateController(
+        limits["rate_per_minute"], limits["min_rate"], limits["max_rate"],
+        increase=limits["increase"], cooldown=limits["cooldown"]
+    )
+    engine = ConcurrentSearchEngine(
+        lambda name: backend.search(name, num_results=num_results),
+        max_concurrency=1, max_retries=max_retries, controller=controller,
+    )
+
     web_search_results = {}
-    search_count = 0  # Counter to track the number of searches
-
-    for name in names:
-        search_count += 1  # Increment the search count
-        retries = 0
-        success = False
-
-        while retries < max_retries and not success:
-            try:
-                query = f'"{name}"'
-                search_results = []
-                ddgs = DDGS()
-                results = ddgs.text(query, region='wt-wt', safesearch='Moderate', max_results=num_results)
-                
-                if results:
-                    for res in results:
-                        search_results.append({
-                            'url': res.get('href', ''),
-                            'title': res.get('title', ''),
-                            'description': res.get('body', '')
-                        })
-                
-                success = True
-
-            except Exception as e:
-                retries += 1
-                logger.error(f"Error during web search for '{name}': {e}. Retrying ({retries}/{max_retries})...")
-                time.sleep(64 * retries)
-                
-        if not success:
-            logger.error(f"Failed to retrieve search results for '{name}' after {retries} retries.")
-            web_search_results[name] = []
-        else:
-            web_search_results[name] = search_results
-
-        # Pause for one minute if the search count is a multiple of 20
-        if (search_count +1) % 20 == 0 and search_method=='duckduckgo':
-            logger.info(f"Pausing for 1 minute after {search_count} searches...")
-            time.sleep(60)
+    for name, search_results, error in engine.search_many(names):
+        if error is not None:
+            logger.error(f"Failed to retrieve search results for '{name}' after {max_retries} retries: {error}")
+            search_results = []
+        web_search_results[name] = search_results
 
     return web_search_results
@@ -0,0 +1,9 @@
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Tests import the pipeline modules the way main.py does ("from stages...")
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+# and the setup helpers the way setup.py does ("from src.setup_utils ...")
+sys.path.insert(1, os.path.abspath(os.path.join(TESTS_DIR, "..", "..", "..", "..")))
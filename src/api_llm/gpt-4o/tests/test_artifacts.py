@@ -0,0 +1,52 @@
+import pickle
+
+import numpy as np
+from scipy import sparse
+
+from stages.artifacts import save_records, load_records, save_sparse_matrix, load_sparse_matrix
+
+MIXED_RECORDS = [
+    {"name": "acme ltd", "unique_id": "gtr-1", "dataset": "gtr"},
+    {"name": "acme limited", "unique_id": "cordis-2", "dataset": "cordis", "postcode": "BS1 2AB"},
+    {"name": "bristol robotics labs", "unique_id": "gtr-3", "dataset": "gtr", "is_new": True},
+]
+
+def test_records_with_mixed_keys_keep_every_field(tmp_path):
+    path = save_records(MIXED_RECORDS, str(tmp_path / "records"))
+    assert path.endswith(".arrow")
+    columns = ["name", "unique_id", "dataset", "postcode", "is_new"]
+    assert load_records(str(tmp_path / "records")) == [
+        {column: record.get(column) for column in columns} for record in MIXED_RECORDS
+    ]
+    assert load_records(str(tmp_path / "records"), columns=["unique_id", "postcode"]) == [
+        {"unique_id": "gtr-1", "postcode": None},
+        {"unique_id": "cordis-2", "postcode": "BS1 2AB"},
+        {"unique_id": "gtr-3", "postcode": None},
+    ]
+
+def test_records_fall_back_to_pickle_for_mixed_types(tmp_path):
+    records = [{"unique_id": 1}, {"unique_id": "gtr-2"}]
+    path = save_records(records, str(tmp_path / "records"))
+    assert path.endswith(".pkl")
+    assert load_records(str(tmp_path / "records")) == records
+    # A stale table in the other format is removed so restarts cannot pick it up
+    assert not (tmp_path / "records.arrow").exists()
+
+def memory_owner(array):
+    while isinstance(array, np.ndarray) and not isinstance(array, np.memmap) and array.base is not None:
+        array = array.base
+    return array
+
+def test_sparse_matrix_round_trip_is_memory_mapped(tmp_path):
+    matrix = sparse.random(50, 30, density=0.1, format='csr', random_state=0)
+    save_sparse_matrix(matrix, str(tmp_path / "vectors"))
+    loaded = load_sparse_matrix(str(tmp_path / "vectors"))
+    assert loaded.shape == matrix.shape
+    assert (loaded != matrix).nnz == 0
+    assert isinstance(memory_owner(loaded.data), np.memmap)
+
+def test_legacy_pickled_matrix_still_loads(tmp_path):
+    matrix = sparse.identity(4, format='csr')
+    with open(tmp_path / "vectors.pkl", 'wb') as f:
+        pickle.dump(matrix, f)
+    assert (load_sparse_matrix(str(tmp_path / "vectors")) != matrix).nnz == 0
@@ -0,0 +1,49 @@
+import sqlite3
+
+from stages.canonical import DEFAULT_RULES, add_canonical_keys
+from stages.stage1 import stage1_load_and_preprocess_data
+from stages.stage3 import stage3_vectorize_names, distinct_names
+from stages.stage4 import stage4_group_similar_names
+from stages.stage5 import stage5_perform_web_search
+
+RAW_RECORDS = [
+    {"name": "Acme Ltd", "unique_id": "1", "dataset": "cordis", "postcode": "BS1 2AB"},
+    {"name": "ACME Limited", "unique_id": "2", "dataset": "gtr", "postcode": "BS1 2AB"},
+    {"name": "Acme", "unique_id": "3", "dataset": "gtr", "postcode": ""},
+    {"name": "Acme Ltd", "unique_id": "4", "dataset": "cordis", "postcode": "BS1 2AB"},
+    {"name": "Bristol Robotics Labs", "unique_id": "5", "dataset": "gtr", "postcode": "BS8 1TH"},
+]
+
+def preprocessed_records():
+    return add_canonical_keys(stage1_load_and_preprocess_data(RAW_RECORDS), DEFAULT_RULES)
+
+def test_legal_suffix_variants_share_one_stage3_row():
+    _, name_vectors, unique_entries = stage3_vectorize_names(preprocessed_records())
+    names = distinct_names(unique_entries)
+    assert names == ["acme ltd", "bristol robotics labs"]
+    assert name_vectors.shape[0] == 2
+    # Every record keeps its own name and gets the canonical one alongside it
+    acme = [entry for entry in unique_entries if entry["canonical_name"] == "acme ltd"]
+    assert sorted(entry["unique_id"] for entry in acme) == ["1", "2", "3", "4"]
+    assert sorted(entry["combined_name"] for entry in acme) == ["acme", "acme limited", "acme ltd", "acme ltd"]
+
+def test_legal_suffix_variants_form_one_stage4_group():
+    vectorizer, name_vectors, unique_entries = stage3_vectorize_names(preprocessed_records())
+    grouped_names = stage4_group_similar_names(vectorizer, name_vectors, unique_entries, threshold=0.2)
+    assert list(grouped_names) == ["acme ltd"]
+    assert grouped_names["acme ltd"]["matched_names"] == ["acme", "acme limited"]
+    assert sorted(item["unique_id"] for item in grouped_names["acme ltd"]["items"]) == ["1", "2", "3", "4"]
+
+def test_legal_suffix_variants_share_one_stage5_query(tmp_path):
+    vectorizer, name_vectors, unique_entries = stage3_vectorize_names(preprocessed_records())
+    grouped_names = stage4_group_similar_names(vectorizer, name_vectors, unique_entries, threshold=0.2)
+    results = stage5_perform_web_search(
+        grouped_names, unique_entries, search_method="fixture", num_results=2, output_dir=str(tmp_path),
+        adaptive=False
+    )
+    # Every variant gets the results of the one search
+    assert sorted(results["fixture"]) == ["acme", "acme limited", "acme ltd"]
+    assert results["fixture"]["acme"] == results["fixture"]["acme ltd"]
+    with sqlite3.connect(tmp_path / "all_web_search_results.sqlite") as conn:
+        queries = [row[0] for row in conn.execute("SELECT query FROM query_cache")]
+    assert queries == ["acme ltd bs1 2ab"]
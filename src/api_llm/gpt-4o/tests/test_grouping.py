@@ -0,0 +1,46 @@
+import numpy as np
+
+from stages.grouping import graph_group_labels
+
+def chain_neighbors(n_names, distance=0.1):
+    """kNN arrays for a chain of near-duplicates: name i is close to i - 1 and i + 1 only."""
+    rows = np.arange(n_names)
+    indices = np.stack([rows, np.maximum(rows - 1, 0), np.minimum(rows + 1, n_names - 1)], axis=1)
+    distances = np.full(indices.shape, distance)
+    distances[:, 0] = 0.0
+    return distances, indices
+
+def test_single_linkage_chain_is_one_component_without_cap():
+    distances, indices = chain_neighbors(300)
+    names = [f"name {i:04d}" for i in range(300)]
+    labels, _ = graph_group_labels(distances, indices, 0.5, names, linkage="single", max_group_size=None)
+    assert len(np.unique(labels)) == 1
+
+def test_single_linkage_respects_max_group_size():
+    distances, indices = chain_neighbors(300)
+    names = [f"name {i:04d}" for i in range(300)]
+    labels, _ = graph_group_labels(distances, indices, 0.5, names, linkage="single", max_group_size=50)
+    sizes = np.bincount(labels)
+    assert sizes.max() <= 50
+    # Splitting a chain only cuts edges, so the names still end up in groups
+    assert (sizes[sizes > 0] > 1).all()
+
+def test_capped_groups_do_not_depend_on_input_order():
+    distances, indices = chain_neighbors(120)
+    names = [f"name {i:04d}" for i in range(120)]
+    labels, _ = graph_group_labels(distances, indices, 0.5, names, linkage="single", max_group_size=25)
+
+    perm = np.random.default_rng(0).permutation(120)
+    inverse = np.argsort(perm)
+    shuffled_labels, _ = graph_group_labels(
+        distances[perm], inverse[indices[perm]], 0.5, [names[i] for i in perm],
+        linkage="single", max_group_size=25
+    )
+
+    def groups(labels, names):
+        by_label = {}
+        for label, name in zip(labels, names):
+            by_label.setdefault(label, set()).add(name)
+        return sorted(sorted(group) for group in by_label.values())
+
+    assert groups(labels, names) == groups(shuffled_labels, [names[i] for i in perm])
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from benchmarks.synthetic_data import generate_records
+from stages.blocking import blocking_candidate_pairs
+from stages.knn import blockwise_kneighbors, knn_recall, lsh_kneighbors
+from stages.stage1 import stage1_load_and_preprocess_data
+from stages.stage4 import find_neighbors, prepare_names, search_neighbors
+
+@pytest.fixture(scope="module")
+def name_vectors():
+    """TF-IDF vectors of the distinct names of 2000 synthetic records."""
+    entries = stage1_load_and_preprocess_data(generate_records(2000, seed=3))
+    names = list(dict.fromkeys(entry["combined_name"] for entry in entries))
+    return TfidfVectorizer().fit_transform(names)
+
+def within(distances, indices, threshold):
+    return [
+        sorted(zip(np.round(d[d <= threshold], 9), i[d <= threshold]))
+        for d, i in zip(distances, indices)
+    ]
+
+@pytest.mark.parametrize("block_size, n_jobs", [(64, 1), (1000, 1), (128, 2)])
+def test_blockwise_matches_brute_force_within_threshold(name_vectors, block_size, n_jobs):
+    threshold = 0.4
+    brute_distances, brute_indices = find_neighbors(name_vectors, n_neighbors=10, engine='brute')
+    distances, indices = blockwise_kneighbors(
+        name_vectors, n_neighbors=10, threshold=threshold, block_size=block_size, n_jobs=n_jobs
+    )
+    assert np.isinf(distances[distances > threshold]).all()
+    # Rows whose 10th neighbour is within the threshold may tie at the cut-off; compare
+    # the others neighbour for neighbour
+    complete = brute_distances[:, -1] > threshold + 1e-9
+    expected = within(brute_distances[complete], brute_indices[complete], threshold)
+    actual = within(distances[complete], indices[complete], threshold)
+    assert [len(row) for row in actual] == [len(row) for row in expected]
+    assert [d for row in actual for d, _ in row] == pytest.approx([d for row in expected for d, _ in row], abs=1e-6)
+    assert [{j for _, j in row} for row in actual] == [{j for _, j in row} for row in expected]
+
+def test_blockwise_orders_ties_by_index():
+    # Rows 0, 2 and 3 are identical, so row 0's neighbours 0, 2, 3 all tie at distance 0
+    X = sparse.csr_matrix(np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 0.0], [1.0, 0.0]]))
+    distances, indices = blockwise_kneighbors(X, n_neighbors=3, threshold=0.5)
+    assert indices[0].tolist() == [0, 2, 3]
+    assert indices[3].tolist() == [0, 2, 3]
+    assert indices[1].tolist() == [1, 1, 1]
+    assert np.isinf(distances[1, 1:]).all()
+
+def test_knn_recall_of_exact_search_is_one(name_vectors):
+    distances, indices = blockwise_kneighbors(name_vectors, n_neighbors=10, threshold=0.3)
+    assert knn_recall(name_vectors, distances, indices, 0.3, sample_size=500) == 1.0
+
+def test_lsh_recall_against_exact_search(name_vectors):
+    threshold = 0.3
+    distances, indices = lsh_kneighbors(name_vectors, n_neighbors=10, threshold=threshold)
+    assert knn_recall(name_vectors, distances, indices, threshold, sample_size=2000) >= 0.95
+
+def test_lsh_results_are_exact_distances(name_vectors):
+    # LSH only restricts the candidates; every neighbour it reports is scored exactly
+    distances, indices = lsh_kneighbors(name_vectors, n_neighbors=10, threshold=0.3)
+    X = name_vectors.toarray()
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    found = np.isfinite(distances)
+    rows = np.nonzero(found)[0]
+    exact = 1.0 - np.einsum('ij,ij->i', X[rows], X[indices[found]])
+    assert distances[found] == pytest.approx(exact, abs=1e-9)
+
+@pytest.fixture(scope="module")
+def blocking_inputs(name_vectors):
+    entries = stage1_load_and_preprocess_data(generate_records(2000, seed=3))
+    return prepare_names(name_vectors, entries)
+
+def blocking_recall(blocking_inputs, strategies, threshold=0.3):
+    all_names, name_to_itemlist, vectors = blocking_inputs
+    distances, indices = search_neighbors(
+        all_names, name_to_itemlist, vectors, threshold, blocking=list(strategies)
+    )
+    return knn_recall(vectors, distances, indices, threshold, sample_size=2000)
+
+def test_token_blocking_keeps_every_close_pair(blocking_inputs):
+    assert blocking_recall(blocking_inputs, ["tokens"]) == 1.0
+
+def test_sorted_neighbourhood_adds_recall_to_postcode_blocking(blocking_inputs):
+    postcode = blocking_recall(blocking_inputs, ["postcode"])
+    combined = blocking_recall(blocking_inputs, ["postcode", "sorted"])
+    assert 0.0 < postcode < combined <= 1.0
+
+def test_postcode_blocks_pair_names_sharing_an_outward_code():
+    all_names = ["acme", "acme labs", "zenith", "nowhere co", "nowhere"]
+    name_to_items = {
+        "acme": [{"postcode": "BS1 2AB"}],
+        "acme labs": [{"postcode": "bs1 9zz"}, {"postcode": "OX1 1AA"}],
+        "zenith": [{"postcode": "OX1 3PQ"}],
+        "nowhere co": [{"postcode": ""}],
+        "nowhere": [{"postcode": "not a postcode"}],
+    }
+    left, right = blocking_candidate_pairs(all_names, name_to_items, strategies=["postcode"])
+    # BS1 pairs 0-1, OX1 pairs 1-2; the two names without a postcode share the token "nowhere"
+    assert list(zip(left.tolist(), right.tolist())) == [(0, 1), (1, 2), (3, 4)]
+
+def test_unknown_blocking_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        blocking_candidate_pairs(["a"], {"a": []}, strategies=["soundex"])
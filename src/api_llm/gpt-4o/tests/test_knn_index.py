@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from benchmarks.synthetic_data import generate_records
+from stages.knn_index import incremental_neighbors, load_neighbor_index
+from stages.stage1 import stage1_load_and_preprocess_data
+from stages.stage4 import indexed_neighbors
+
+SEARCH = {"engine": 'blockwise', "n_neighbors": 5, "block_size": 256}
+THRESHOLD = 0.4
+
+@pytest.fixture(scope="module")
+def runs():
+    """Names of two runs: the second drops some names of the first and adds others."""
+    entries = stage1_load_and_preprocess_data(generate_records(1500, seed=5))
+    names = list(dict.fromkeys(entry["combined_name"] for entry in entries))
+    # One vocabulary for both runs, so vectors of kept names are unchanged
+    vectorizer = TfidfVectorizer().fit(names)
+    old_names = names[:900]
+    new_names = [nm for i, nm in enumerate(names) if i % 7 != 3]
+    return (
+        (old_names, vectorizer.transform(old_names)),
+        (new_names, vectorizer.transform(new_names)),
+    )
+
+def full_search(tmp_path, names, vectors):
+    return indexed_neighbors(str(tmp_path / "full"), names, {}, vectors, THRESHOLD, **SEARCH)
+
+def test_incremental_update_equals_full_rebuild(tmp_path, runs):
+    (old_names, old_vectors), (new_names, new_vectors) = runs
+    index_dir = str(tmp_path / "index")
+    indexed_neighbors(index_dir, old_names, {}, old_vectors, THRESHOLD, **SEARCH)
+
+    # The saved index is reusable, so no full search is run
+    assert incremental_neighbors(load_neighbor_index(index_dir), new_names, new_vectors, 5, THRESHOLD) is not None
+    distances, indices = indexed_neighbors(
+        index_dir, new_names, {}, new_vectors, THRESHOLD, incremental=True, **SEARCH
+    )
+    expected_distances, expected_indices = full_search(tmp_path, new_names, new_vectors)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-9)
+    np.testing.assert_array_equal(indices, expected_indices)
+
+    # The updated graph is saved for the next run
+    index = load_neighbor_index(index_dir)
+    assert index["names"] == new_names
+    np.testing.assert_array_equal(index["indices"], expected_indices)
+
+def test_index_with_other_settings_is_not_reused(tmp_path, runs):
+    (old_names, old_vectors), (new_names, new_vectors) = runs
+    index_dir = str(tmp_path / "index")
+    indexed_neighbors(index_dir, old_names, {}, old_vectors, THRESHOLD, **SEARCH)
+    index = load_neighbor_index(index_dir)
+    assert incremental_neighbors(index, new_names, new_vectors, 5, 0.3) is None
+    assert incremental_neighbors(index, new_names, new_vectors, 8, THRESHOLD) is None
+
+def test_index_with_changed_vectors_is_not_reused(tmp_path, runs):
+    (old_names, old_vectors), _ = runs
+    index_dir = str(tmp_path / "index")
+    indexed_neighbors(index_dir, old_names, {}, old_vectors, THRESHOLD, **SEARCH)
+    refitted = TfidfVectorizer().fit_transform(old_names)
+    assert incremental_neighbors(load_neighbor_index(index_dir), old_names, refitted, 5, THRESHOLD) is None
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("bs4")
+pytest.importorskip("googlesearch")
+
+from stages.search_backends import get_backend, RateLimitError
+
+RESULTS_PAGE = """
+<div class="ezO2md"><a href="/url?q=https://acme.example/&amp;sa=U"><span class="CVA68e">Acme Ltd</span></a>
+<span class="FrIlee">Acme makes anvils.</span></div>
+<div class="ezO2md"><a href="/url?q=https://acme.example/about&amp;sa=U"><span class="CVA68e">About Acme</span></a>
+<span class="FrIlee">About us.</span></div>
+"""
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+def test_google_backend_reuses_one_session(monkeypatch):
+    import requests
+    sessions = []
+    original_init = requests.Session.__init__
+
+    def counting_init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        sessions.append(self)
+
+    monkeypatch.setattr(requests.Session, "__init__", counting_init)
+    monkeypatch.setattr(requests.Session, "get", lambda self, url, **kwargs: FakeResponse(RESULTS_PAGE))
+    with get_backend("google") as backend:
+        first = backend.search("acme ltd", num_results=1)
+        backend.search("acme limited", num_results=3)
+    assert len(sessions) == 1
+    assert first == [{"url": "https://acme.example/", "title": "Acme Ltd", "description": "Acme makes anvils."}]
+
+def test_google_backend_reports_throttling(monkeypatch):
+    import requests
+    monkeypatch.setattr(requests.Session, "get", lambda self, url, **kwargs: FakeResponse("", status_code=429))
+    with get_backend("google") as backend:
+        with pytest.raises(RateLimitError):
+            backend.search("acme ltd")
@@ -0,0 +1,154 @@
+import os
+import threading
+
+import pytest
+
+import stages.search_engine as search_engine
+from stages.search_backends import RateLimitError
+from stages.search_engine import (
+    AdaptiveRateController, ConcurrentSearchEngine, TokenBucket, load_rate_state, save_rate_state
+)
+
+class FakeClock:
+    """Stands in for the `time` module: sleeping advances the clock instantly."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        with self._lock:
+            return self.now
+
+    def time(self):
+        return self.monotonic()
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(search_engine, "time", clock)
+    return clock
+
+def acquire_times(bucket, clock, count):
+    times = []
+    for _ in range(count):
+        bucket.acquire()
+        times.append(clock.now - 1000.0)
+    return times
+
+def test_token_bucket_spaces_requests(clock):
+    bucket = TokenBucket(rate_per_minute=30)
+    assert acquire_times(bucket, clock, 4) == pytest.approx([0.0, 2.0, 4.0, 6.0])
+
+def test_token_bucket_burst_after_idle(clock):
+    bucket = TokenBucket(rate_per_minute=60, burst=3)
+    bucket.acquire()
+    clock.sleep(10)
+    # Idle time earns at most 3 tokens
+    assert acquire_times(bucket, clock, 5) == pytest.approx([10.0, 10.0, 10.0, 11.0, 12.0])
+
+def test_token_bucket_pause_and_set_rate(clock):
+    bucket = TokenBucket(rate_per_minute=60)
+    bucket.acquire()
+    bucket.pause(30)
+    assert bucket.next_slot_in() == pytest.approx(30.0)
+    bucket.set_rate(120)
+    assert acquire_times(bucket, clock, 3) == pytest.approx([30.0, 30.5, 31.0])
+
+def test_token_bucket_rejects_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate_per_minute=0)
+
+def test_engine_searches_every_query_at_the_rate(clock):
+    started = []
+
+    def search(query):
+        started.append(clock.monotonic() - 1000.0)
+        return [query.upper()]
+
+    # One worker, since the fake clock is shared by all the threads that sleep on it
+    engine = ConcurrentSearchEngine(search, rate_per_minute=60, max_concurrency=1)
+    results = {query: (found, error) for query, found, error in engine.search_many(["a", "b", "c", "d"])}
+    assert results == {q: ([q.upper()], None) for q in "abcd"}
+    assert started == pytest.approx([0.0, 1.0, 2.0, 3.0])
+
+def test_engine_retries_then_reports_failures(clock):
+    attempts = {}
+
+    def search(query):
+        attempts[query] = attempts.get(query, 0) + 1
+        if query == "down" or attempts[query] < 2:
+            raise RuntimeError(f"failed {query}")
+        return [query]
+
+    engine = ConcurrentSearchEngine(search, rate_per_minute=6000, max_concurrency=2, max_retries=3)
+    results = {query: (found, error) for query, found, error in engine.search_many(["flaky", "down"])}
+    assert results["flaky"] == (["flaky"], None)
+    found, error = results["down"]
+    assert found is None and str(error) == "failed down"
+    assert attempts == {"flaky": 2, "down": 3}
+
+def test_controller_raises_rate_additively(clock):
+    controller = AdaptiveRateController(30, min_rate=2, max_rate=40, increase=2)
+    # About `increase` requests/min more per minute of successes: 30 searches at ~30/min
+    for _ in range(30):
+        controller.on_success()
+    assert 31.9 < controller.rate_per_minute < 32.1
+    for _ in range(10_000):
+        controller.on_success()
+    assert controller.rate_per_minute == 40
+    assert controller.bucket.interval == pytest.approx(1.5)
+
+def test_controller_backs_off_once_per_cooldown(clock):
+    controller = AdaptiveRateController(30, min_rate=5, max_rate=90, cooldown=60.0)
+    controller.on_throttle()
+    assert controller.rate_per_minute == 15
+    assert controller.bucket.next_slot_in() == pytest.approx(60.0)
+    # Throttles from requests already in flight do not cut the rate again
+    controller.on_throttle()
+    assert controller.rate_per_minute == 15
+    clock.sleep(61)
+    controller.on_throttle()
+    controller.on_throttle()
+    clock.sleep(61)
+    controller.on_throttle()
+    assert controller.rate_per_minute == 5
+    assert controller.throttles == 5
+
+def test_engine_reports_throttles_to_controller(clock):
+    calls = []
+
+    def search(query):
+        calls.append(query)
+        if len(calls) == 1:
+            raise RateLimitError("slow down")
+        return [query]
+
+    controller = AdaptiveRateController(60, min_rate=2, max_rate=90, cooldown=30.0)
+    engine = ConcurrentSearchEngine(search, max_concurrency=1, max_retries=2, backoff=0.0, controller=controller)
+    assert list(engine.search_many(["q"])) == [("q", ["q"], None)]
+    assert controller.throttles == 1 and controller.successes == 1
+    # The retry waited out the cooldown pause
+    assert clock.now - 1000.0 == pytest.approx(30.0)
+
+def test_controller_state_round_trip(tmp_path, clock):
+    controller = AdaptiveRateController(30, min_rate=2, max_rate=90, cooldown=60.0)
+    controller.on_throttle()
+    path = str(tmp_path / "search_rate_state.json")
+    save_rate_state(path, "google", {"rate_per_minute": 50.0, "next_request_at": 0, "updated_at": 0})
+    save_rate_state(path, "duckduckgo", controller.state())
+    assert os.listdir(tmp_path) == ["search_rate_state.json"]
+    assert load_rate_state(path, "google")["rate_per_minute"] == 50.0
+    assert load_rate_state(path, "fixture") is None
+    assert load_rate_state(str(tmp_path / "missing.json"), "google") is None
+
+    restored = AdaptiveRateController(30, min_rate=2, max_rate=90)
+    clock.sleep(20)
+    restored.restore(load_rate_state(path, "duckduckgo"))
+    assert restored.rate_per_minute == 15
+    # The rest of the pause carries over to the next run
+    assert restored.bucket.next_slot_in() == pytest.approx(40.0)
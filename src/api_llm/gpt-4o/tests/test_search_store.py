@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+
+from stages.search_store import SearchResultStore, normalise_query
+from stages.stage5 import search_names
+
+RESULTS = [{"url": "https://example.org/acme", "title": "Acme", "description": "Acme Ltd, Bristol"}]
+
+def test_results_round_trip_and_upsert(tmp_path):
+    path = str(tmp_path / "search.sqlite")
+    with SearchResultStore(path) as store:
+        assert store.get("duckduckgo", "acme ltd") is None
+        store.put("duckduckgo", "acme ltd", RESULTS)
+        store.put("duckduckgo", "acme ltd", RESULTS * 2)
+        store.put("google", "acme ltd", [])
+    # Committed on write, so a new connection sees every result
+    with SearchResultStore(path) as store:
+        assert store.get("duckduckgo", "acme ltd") == RESULTS * 2
+        assert store.get("google", "acme ltd") == []
+        assert store.method_results("duckduckgo") == {"acme ltd": RESULTS * 2}
+        assert store.count() == 2
+        assert store.count("google") == 1
+
+def test_migrate_json_keeps_existing_rows(tmp_path):
+    json_path = tmp_path / "all_web_search_results.json"
+    json_path.write_text(json.dumps({"duckduckgo": {"acme ltd": [], "zeta quantum": RESULTS}}))
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        store.put("duckduckgo", "acme ltd", RESULTS)
+        assert store.migrate_json(str(json_path)) == 2
+        assert store.get("duckduckgo", "acme ltd") == RESULTS
+        assert store.get("duckduckgo", "zeta quantum") == RESULTS
+        # The JSON file is imported once
+        assert not json_path.exists()
+        assert (tmp_path / "all_web_search_results.json.migrated").exists()
+        assert store.migrate_json(str(json_path)) == 0
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / "search.sqlite")
+    with SearchResultStore(path) as store, SearchResultStore(path) as other:
+        def write(target, offset):
+            for i in range(50):
+                target.put("duckduckgo", f"name {offset + i}", RESULTS)
+
+        threads = [threading.Thread(target=write, args=(target, 50 * offset))
+                   for offset, target in enumerate([store, store, other, other])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert store.count("duckduckgo") == 200
+
+def test_record_search_caches_query_and_names(tmp_path):
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        store.record_search("duckduckgo", "Acme  Ltd BS1 2AB", ["acme ltd", "acme limited"], RESULTS, 3)
+        cached = store.get_query("duckduckgo", "acme ltd bs1 2ab")
+        assert cached["results"] == RESULTS
+        assert cached["result_count"] == 1
+        assert cached["num_requested"] == 3
+        assert store.get("duckduckgo", "acme limited") == RESULTS
+        assert store.get_query("google", "acme ltd bs1 2ab") is None
+
+def test_normalise_query():
+    assert normalise_query("  Acme\tLtd   BS1 2AB ") == "acme ltd bs1 2ab"
+
+class RecordingBackend:
+    """Backend stand-in returning canned results and recording each query."""
+    name = "fixture"
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def search(self, query, num_results=3):
+        self.queries.append(query)
+        return self.results.get(query, [])[:num_results]
+
+LIMITS = {"rate_per_minute": 6000.0, "max_concurrency": 2}
+GROUPED = {"acme ltd": {"matched_names": ["acme limited"]}, "zeta quantum": {"matched_names": []}}
+ITEMS = [
+    {"combined_name": "acme ltd", "postcode": "BS1 2AB"},
+    {"combined_name": "acme limited", "postcode": "BS1 2AB", "canonical_name": "acme ltd"},
+    {"combined_name": "zeta quantum", "postcode": ""},
+]
+
+def run_search(store, backend, ttl_days=30, num_results=3):
+    search_names(store, backend, GROUPED, ITEMS, num_results, LIMITS, max_retries=1, ttl_days=ttl_days)
+
+def age_searches(store, days):
+    with store._conn:
+        store._conn.execute("UPDATE query_cache SET searched_at = ?", (time.time() - days * 86400,))
+
+def test_names_sharing_a_query_are_searched_once(tmp_path):
+    backend = RecordingBackend({"acme ltd BS1 2AB": RESULTS})
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        run_search(store, backend)
+        assert sorted(backend.queries) == ["acme ltd BS1 2AB", "zeta quantum"]
+        assert store.get("fixture", "acme limited") == RESULTS
+        # The search for "zeta quantum" found nothing; it is cached all the same
+        assert store.get("fixture", "zeta quantum") == []
+        assert store.get_query("fixture", "zeta quantum")["result_count"] == 0
+
+        run_search(store, backend)
+        assert len(backend.queries) == 2
+
+def test_cached_searches_expire_after_ttl(tmp_path):
+    backend = RecordingBackend({"acme ltd BS1 2AB": RESULTS})
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        run_search(store, backend)
+        age_searches(store, 10)
+        run_search(store, backend, ttl_days=30)
+        assert len(backend.queries) == 2
+        run_search(store, backend, ttl_days=5)
+        assert len(backend.queries) == 4
+        # A TTL of 0 never expires
+        age_searches(store, 1000)
+        run_search(store, backend, ttl_days=0)
+        assert len(backend.queries) == 4
+
+def test_searches_asking_for_fewer_results_are_repeated(tmp_path):
+    backend = RecordingBackend({"acme ltd BS1 2AB": RESULTS})
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        run_search(store, backend, num_results=1)
+        run_search(store, backend, num_results=1)
+        assert len(backend.queries) == 2
+        run_search(store, backend, num_results=3)
+        assert len(backend.queries) == 4
+
+def test_failed_searches_are_not_cached(tmp_path):
+    class FailingBackend(RecordingBackend):
+        def search(self, query, num_results=3):
+            super().search(query, num_results)
+            raise RuntimeError("network down")
+
+    with SearchResultStore(str(tmp_path / "search.sqlite")) as store:
+        run_search(store, FailingBackend({}))
+        assert store.get_query("fixture", "zeta quantum") is None
+        assert store.get("fixture", "zeta quantum") is None
+        backend = RecordingBackend({})
+        run_search(store, backend)
+        assert len(backend.queries) == 2
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from src.setup_utils import iter_json_array, write_json_array
+
+RECORDS = [
+    {"name": "Acme Ltd", "postcode": "BS1 2AB", "tags": ["robotics", "ai"], "funding": 1250000.5},
+    {"name": "Zeta \"Quantum\" é", "postcode": None, "nested": {"a": [1, 2, {"b": "]"}]}},
+    12345678901234567890,
+    "a string with , and ] inside",
+    [],
+    {},
+    True,
+]
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 1 << 20])
+def test_iter_json_array_matches_json_load(tmp_path, chunk_size):
+    path = tmp_path / "records.json"
+    path.write_text(json.dumps(RECORDS, indent=4), encoding="utf-8")
+    assert list(iter_json_array(str(path), chunk_size=chunk_size)) == RECORDS
+
+@pytest.mark.parametrize("text", ["[]", "  [ ]\n", "[1,2 , 3]"])
+def test_iter_json_array_compact_and_empty(tmp_path, text):
+    path = tmp_path / "records.json"
+    path.write_text(text)
+    assert list(iter_json_array(str(path), chunk_size=2)) == json.loads(text)
+
+@pytest.mark.parametrize("text", ['{"a": 1}', "[1, 2", '[{"a": 1}, {"b": '])
+def test_iter_json_array_rejects_bad_input(tmp_path, text):
+    path = tmp_path / "records.json"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), chunk_size=3))
+
+@pytest.mark.parametrize("records", [RECORDS, [], [{"only": 1}]])
+def test_write_json_array_matches_json_dump(tmp_path, records):
+    path = tmp_path / "records.json"
+    assert write_json_array(iter(records), str(path)) == len(records)
+    assert path.read_text(encoding="utf-8") == json.dumps(records, indent=4)
+    assert list(iter_json_array(str(path), chunk_size=5)) == records
@@ -0,0 +1,34 @@
+import json
+from stages.snapshot_store import SnapshotStore, content_chunks
+
+def make_records(start, count):
+    return [{"name": f"Organisation {i}", "postcode": f"AB{i % 90 + 10} 1CD", "id": i} for i in range(start, start + count)]
+
+def test_save_file_round_trip_and_dedup(tmp_path):
+    records = make_records(0, 20000)
+    first = tmp_path / "first.json"
+    first.write_text(json.dumps(records, indent=4))
+    # A small insertion in the middle of the file
+    second = tmp_path / "second.json"
+    second.write_text(json.dumps(records[:10000] + make_records(90000, 5) + records[10000:], indent=4))
+
+    store = SnapshotStore(str(tmp_path / "history"))
+    one = store.save_file("run1", "uk_data", str(first))
+    two = store.save_file("run2", "uk_data", str(second))
+
+    assert len(one["chunks"]) > 4
+    assert len(set(two["chunks"]) - set(one["chunks"])) <= 2
+    restored = tmp_path / "restored.json"
+    store.restore("run2", "uk_data", str(restored))
+    assert restored.read_bytes() == second.read_bytes()
+    assert store.load("run1", "uk_data") == records
+
+def test_chunks_do_not_depend_on_read_size(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(make_records(0, 5000), indent=4))
+    with open(path, 'rb') as f:
+        whole = list(content_chunks(f))
+    with open(path, 'rb') as f:
+        small_reads = list(content_chunks(f, read_size=1000))
+    assert whole == small_reads
+    assert b''.join(whole) == path.read_bytes()
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+
+from stages.snapshot_store import replace_with_link
+from stages.stage0 import stage0_check_new_data, load_merged_data
+
+def record(i, name=None):
+    return {"name": name or f"Organisation {i}", "unique_id": str(i), "dataset": "gtr", "postcode": "BS1 2AB"}
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+
+def run_content_diff(tmp_path, new_data):
+    """One stage 0 run as main.py does it: diff, load the merged data, make it the old data."""
+    paths = {name: str(tmp_path / f"{name}.json") for name in ("uk_data", "old_uk_data", "merged_uk_data", "new_entries")}
+    index_path = str(tmp_path / "old_uk_data_hashes.txt")
+    write_json(paths["uk_data"], new_data)
+    new_entries = stage0_check_new_data(
+        paths["uk_data"], paths["old_uk_data"], paths["merged_uk_data"], paths["new_entries"], index_path=index_path
+    )
+    merged_data = load_merged_data(paths["merged_uk_data"], index_path)
+    replace_with_link(paths["merged_uk_data"], paths["old_uk_data"])
+    return new_entries, merged_data, paths
+
+def flags(merged_data):
+    return [(d["unique_id"], d["is_new"], d["change_type"]) for d in merged_data]
+
+def test_content_diff_appends_new_records_using_the_index(tmp_path, caplog):
+    run_content_diff(tmp_path, [record(1), record(2)])
+
+    caplog.set_level(logging.INFO)
+    new_entries, merged_data, paths = run_content_diff(tmp_path, [record(2), record(3), record(3)])
+    assert [d["unique_id"] for d in new_entries] == ["3"]
+    assert flags(merged_data) == [("1", False, "unchanged"), ("2", False, "unchanged"), ("3", True, "added")]
+    assert "Using content-hash index with 2 entries" in caplog.text
+    # The file on disk is the old records with the new one appended, without pipeline fields
+    with open(paths["merged_uk_data"], 'r', encoding='utf-8') as f:
+        assert f.read() == json.dumps([record(1), record(2), record(3)], indent=4)
+
+def test_content_diff_rebuilds_index_after_same_length_edit(tmp_path, caplog):
+    _, _, paths = run_content_diff(tmp_path, [record(1), record(2)])
+    # Edit the history without changing its number of records or its size
+    size = os.path.getsize(paths["old_uk_data"])
+    write_json(paths["old_uk_data"], [record(1), record(2, name="Organisation X")])
+    assert os.path.getsize(paths["old_uk_data"]) == size
+
+    caplog.set_level(logging.INFO)
+    new_entries, merged_data, _ = run_content_diff(tmp_path, [record(2, name="Organisation X")])
+    assert "Rebuilding content-hash index for 2 old entries" in caplog.text
+    assert new_entries == []
+    assert flags(merged_data) == [("1", False, "unchanged"), ("2", False, "unchanged")]
+
+def test_duplicates_in_old_history_are_dropped(tmp_path):
+    write_json(tmp_path / "old_uk_data.json", [record(1), record(2), record(1)])
+    new_entries, merged_data, _ = run_content_diff(tmp_path, [record(4)])
+    assert [d["unique_id"] for d in new_entries] == ["4"]
+    assert flags(merged_data) == [("1", False, "unchanged"), ("2", False, "unchanged"), ("4", True, "added")]
+
+def run_keyed_diff(tmp_path, new_data):
+    paths = {name: str(tmp_path / f"{name}.json") for name in ("uk_data", "old_uk_data", "merged_uk_data", "new_entries")}
+    index_path = str(tmp_path / "old_uk_data_hashes.txt")
+    deleted_path = str(tmp_path / "deleted_entries.json")
+    write_json(paths["uk_data"], new_data)
+    changed = stage0_check_new_data(
+        paths["uk_data"], paths["old_uk_data"], paths["merged_uk_data"], paths["new_entries"],
+        index_path=index_path, diff_mode="keyed", deleted_entries_path=deleted_path
+    )
+    merged_data = load_merged_data(paths["merged_uk_data"], index_path)
+    replace_with_link(paths["merged_uk_data"], paths["old_uk_data"])
+    with open(deleted_path, 'r', encoding='utf-8') as f:
+        deleted = json.load(f)
+    return changed, merged_data, deleted
+
+def test_keyed_diff_classifies_added_modified_unchanged_and_deleted(tmp_path):
+    run_keyed_diff(tmp_path, [record(1), record(2), record(3)])
+
+    changed, merged_data, deleted = run_keyed_diff(
+        tmp_path, [record(1), record(2, name="Organisation Two"), record(4)]
+    )
+    assert [(d["unique_id"], d["change_type"]) for d in changed] == [("2", "modified"), ("4", "added")]
+    assert flags(merged_data) == [("1", False, "unchanged"), ("2", True, "modified"), ("4", True, "added")]
+    assert deleted == [{"dataset": "gtr", "unique_id": "3"}]
+
+def test_keyed_diff_ignores_repeated_keys_in_the_snapshot(tmp_path):
+    changed, merged_data, _ = run_keyed_diff(tmp_path, [record(1), record(1, name="Duplicate key")])
+    assert flags(merged_data) == [("1", True, "added")]
+    assert merged_data[0]["name"] == "Organisation 1"
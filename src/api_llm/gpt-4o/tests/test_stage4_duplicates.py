@@ -0,0 +1,30 @@
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from stages.stage3 import distinct_names
+from stages.stage4 import stage4_group_similar_names
+
+ENTRIES = [
+    {"combined_name": "acme ltd", "unique_id": "1"},
+    {"combined_name": "bristol robotics labs", "unique_id": "2"},
+    {"combined_name": "acme ltd", "unique_id": "4"},
+    {"combined_name": "zeta quantum", "unique_id": "5"},
+    {"combined_name": "oxford photonics", "unique_id": "6"},
+    {"combined_name": "oxford photonics", "unique_id": "7"},
+]
+
+def group_ids(grouped_names):
+    return {
+        rep_name: sorted(item["unique_id"] for item in info["items"])
+        for rep_name, info in grouped_names.items()
+    }
+
+@pytest.mark.parametrize("grouping", ["greedy", "graph"])
+def test_shared_names_without_neighbours_form_groups(grouping):
+    names = distinct_names(ENTRIES)
+    vectorizer = TfidfVectorizer().fit(names)
+    grouped_names = stage4_group_similar_names(
+        vectorizer, vectorizer.transform(names), ENTRIES, threshold=0.2, grouping=grouping
+    )
+    assert group_ids(grouped_names) == {"acme ltd": ["1", "4"], "oxford photonics": ["6", "7"]}
+    assert all(info["matched_names"] == [] for info in grouped_names.values())
@@ -0,0 +1,63 @@
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import stages.stage4 as stage4
+from benchmarks.synthetic_data import generate_records
+from stages.stage1 import stage1_load_and_preprocess_data
+from stages.stage3 import distinct_names
+
+THRESHOLDS = [0.2, 0.3, 0.4]
+
+@pytest.fixture(scope="module")
+def inputs():
+    entries = stage1_load_and_preprocess_data(generate_records(600, seed=11))
+    names = distinct_names(entries)
+    vectorizer = TfidfVectorizer().fit(names)
+    return vectorizer, vectorizer.transform(names), entries
+
+@pytest.fixture
+def searches(monkeypatch):
+    """Thresholds of the neighbour searches actually run."""
+    calls = []
+    search_neighbors = stage4.search_neighbors
+
+    def counting_search(all_names, name_to_itemlist, name_vectors, threshold, **options):
+        calls.append(threshold)
+        return search_neighbors(all_names, name_to_itemlist, name_vectors, threshold, **options)
+
+    monkeypatch.setattr(stage4, "search_neighbors", counting_search)
+    return calls
+
+def test_sweep_matches_grouping_at_each_threshold(tmp_path, inputs, searches):
+    vectorizer, name_vectors, entries = inputs
+    summaries = stage4.stage4_sweep_thresholds(name_vectors, entries, THRESHOLDS, str(tmp_path))
+    assert searches == [0.4]
+    assert [summary["threshold"] for summary in summaries] == THRESHOLDS
+    for summary in summaries:
+        grouped_names = stage4.stage4_group_similar_names(
+            vectorizer, name_vectors, entries, threshold=summary["threshold"]
+        )
+        assert summary["groups"] == len(grouped_names)
+        assert summary["grouped_names"] == sum(1 + len(info["matched_names"]) for info in grouped_names.values())
+    assert summaries[0]["groups"] > 0
+
+def test_sweep_reuses_looser_cached_search(tmp_path, inputs, searches):
+    _, name_vectors, entries = inputs
+    first = stage4.stage4_sweep_thresholds(name_vectors, entries, THRESHOLDS, str(tmp_path))
+    # Tighter thresholds are read from the cached search at 0.4
+    again = stage4.stage4_sweep_thresholds(name_vectors, entries, [0.2, 0.3], str(tmp_path))
+    assert searches == [0.4]
+    assert again == first[:2]
+
+    # A looser threshold or other search settings need a new search
+    stage4.stage4_sweep_thresholds(name_vectors, entries, [0.5], str(tmp_path))
+    stage4.stage4_sweep_thresholds(name_vectors, entries, [0.3], str(tmp_path), n_neighbors=5)
+    assert searches == [0.4, 0.5, 0.3]
+
+def test_sweep_cache_is_keyed_by_names(tmp_path, inputs, searches):
+    _, name_vectors, entries = inputs
+    stage4.stage4_sweep_thresholds(name_vectors, entries, THRESHOLDS, str(tmp_path))
+    names = distinct_names(entries[:300])
+    fewer = TfidfVectorizer().fit_transform(names)
+    stage4.stage4_sweep_thresholds(fewer, entries[:300], [0.2], str(tmp_path))
+    assert searches == [0.4, 0.2]
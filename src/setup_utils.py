@@ -1,7 +1,7 @@
 # imports
 import json
 import os
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Callable, Iterable, Iterator, Optional
 
 def load_json(filepath: str, encoding="utf-8") -> Dict:
     """Load JSON data from file."""
@@ -25,6 +25,128 @@ def save_json(data: Any, filename: str, save_dir: str|None = None, encoding="utf
     print(f"Data saved to {save_path}")
 
 
+def iter_json_array(filepath: str, encoding="utf-8", chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    Yield the elements of a top-level JSON array one at a time.
+
+    Only `chunk_size` characters plus the element currently being decoded are
+    held in memory, so arbitrarily large exports can be filtered record by record.
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r', encoding=encoding) as f:
+        buffer = f.read(chunk_size)
+        eof = not buffer
+        pos = 0
+        expect_open = True
+
+        while True:
+            # Skip whitespace and separators, topping up the buffer when it runs dry
+            while pos < len(buffer) and (buffer[pos].isspace() or (buffer[pos] == ',' and not expect_open)):
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {filepath}")
+                buffer = f.read(chunk_size)
+                eof = not buffer
+                pos = 0
+                continue
+
+            if expect_open:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Expected a top-level JSON array in {filepath}")
+                expect_open = False
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                # A value not followed by a delimiter may be truncated (e.g. a number split across chunks)
+                complete = eof or (end < len(buffer) and (buffer[end].isspace() or buffer[end] in ',]'))
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+
+            if not complete:
+                # Drop the consumed prefix and read more before decoding again
+                more = f.read(chunk_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+
+            yield element
+            pos = end
+
+def write_json_array(records: Iterable[Any], filepath: str, encoding="utf-8") -> int:
+    """
+    Write records to a JSON array file incrementally.
+
+    Output is byte-identical to `json.dump(list(records), f, indent=4)` but
+    never holds more than one record in memory. Returns the number written.
+    """
+    count = 0
+    with open(filepath, 'w', encoding=encoding) as f:
+        f.write('[')
+        for record in records:
+            encoded = json.dumps(record, indent=4).replace('\n', '\n    ')
+            f.write((',\n    ' if count else '\n    ') + encoded)
+            count += 1
+        f.write('\n]' if count else ']')
+    return count
+
+def ingest_source(source: Dict[str, Any], part_path: str, stream: bool = False) -> int:
+    """
+    Parse, filter and transform one raw source file, writing the resulting records
+    to `part_path` as JSON lines. Runs independently of other sources, so it can be
+    executed in a worker process.
+
+    Args:
+        source: Dictionary with keys
+            path: raw JSON file to read
+            kind: "cordis" or "gtr" (GtR records are flattened with process_gtr_record)
+            uk_only: keep only entries whose country is "UK"
+            project: apply projection_steps with the keys below, else keep records as-is
+            dataset, fields_to_keep, map_names, str_fields: arguments to projection_steps
+        part_path: JSON-lines file to write
+        stream: parse the source element by element instead of loading it whole
+
+    Returns:
+        Number of records written
+    """
+    steps = []
+    if source.get("uk_only"):
+        steps.append(where(lambda entry: entry.get("country") == "UK"))
+    if source["kind"] == "gtr":
+        steps.append(process_gtr_record)
+    if source.get("project"):
+        steps.extend(projection_steps(
+            source["dataset"],
+            source["fields_to_keep"],
+            source["map_names"],
+            source["str_fields"],
+        ))
+    transform = transform_pipeline(*steps)
+
+    records = iter_json_array(source["path"]) if stream else load_json(source["path"])
+    count = 0
+    with open(part_path, 'w', encoding='utf-8') as f:
+        for entry in transform(records):
+            f.write(json.dumps(entry) + '\n')
+            count += 1
+    return count
+
+def iter_json_lines(filepaths: Iterable[str], encoding="utf-8") -> Iterator[Any]:
+    """Yield records from JSON-lines files, in file order."""
+    for filepath in filepaths:
+        with open(filepath, 'r', encoding=encoding) as f:
+            for line in f:
+                yield json.loads(line)
+
+
 def process_uktin_names_only(raw_data):
     """
     Parse a JSON containing project information and extract all organization names
@@ -56,6 +178,56 @@ def process_uktin_names_only(raw_data):
     
     return organizations
 
+def process_gtr_record(org: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Transform a single GTR organization record from nested to flat structure.
+    
+    Args:
+        org: Dictionary containing one raw GTR organization
+        
+    Returns:
+        Transformed organization dictionary
+    """
+    # Initialize the transformed organization record
+    transformed_org = {
+        'name': org['name'],
+        'id': org['id'],
+        'created': org['created'],
+        'href': org['href'],
+        # 'dataset': 'gtr' # can add const field but currently handled in setup.py for dataset
+    }
+
+    # Process address information
+    if org.get('addresses') and org['addresses'].get('address'):
+        address = org['addresses']['address'][0]  # Taking first address since data shows only one exists
+        transformed_org.update({
+            'address.postCode': address.get('postCode'),
+            'address.region': address.get('region'),
+            'address.country': address.get('country'),
+            'address.type': address.get('type')
+        })
+        
+    # Process links - group by relationship type
+    if org.get('links') and org['links'].get('link'):
+        link_groups = {}
+
+        for link in org['links']['link']:
+            rel_type = link.get('rel')
+            if rel_type:
+                # Extract ID from href
+                entity_id = link['href'].split('/')[-1]
+                
+                # Initialize list for this relationship type if it doesn't exist
+                if f'link.{rel_type}' not in link_groups:
+                    link_groups[f'link.{rel_type}'] = []
+                    
+                link_groups[f'link.{rel_type}'].append(entity_id)
+        
+        # Add all link groups to transformed organization
+        transformed_org.update(link_groups)
+
+    return transformed_org
+
 def process_gtr_data(raw_data):
     """
     Transform GTR organization data from nested to flat structure.
@@ -66,50 +238,7 @@ def process_gtr_data(raw_data):
     Returns:
         List of transformed organization dictionaries
     """
-    processed_data = []
-    
-    for org in raw_data:
-        # Initialize the transformed organization record
-        transformed_org = {
-            'name': org['name'],
-            'id': org['id'],
-            'created': org['created'],
-            'href': org['href'],
-            # 'dataset': 'gtr' # can add const field but currently handled in setup.py for dataset
-        }
- 
-        # Process address information
-        if org.get('addresses') and org['addresses'].get('address'):
-            address = org['addresses']['address'][0]  # Taking first address since data shows only one exists
-            transformed_org.update({
-                'address.postCode': address.get('postCode'),
-                'address.region': address.get('region'),
-                'address.country': address.get('country'),
-                'address.type': address.get('type')
-            })
-            
-        # Process links - group by relationship type
-        if org.get('links') and org['links'].get('link'):
-            link_groups = {}
-
-            for link in org['links']['link']:
-                rel_type = link.get('rel')
-                if rel_type:
-                    # Extract ID from href
-                    entity_id = link['href'].split('/')[-1]
-                    
-                    # Initialize list for this relationship type if it doesn't exist
-                    if f'link.{rel_type}' not in link_groups:
-                        link_groups[f'link.{rel_type}'] = []
-                        
-                    link_groups[f'link.{rel_type}'].append(entity_id)
-            
-            # Add all link groups to transformed organization
-            transformed_org.update(link_groups)
-        
-        processed_data.append(transformed_org)
-    
-    return processed_data
+    return [process_gtr_record(org) for org in raw_data]
 
 def add_const_field_json(data: List[Dict[str, Any]], field_name: str, field_value: Any) -> List[Dict[str, Any]]:
     """Add a constant field to all dictionaries in a list."""
@@ -134,3 +263,78 @@ def convert_entries_to_str(data: List[Dict[str, Any]], fields: List[str]) -> Lis
             if field in entry and not isinstance(entry[field], str):
                 entry[field] = str(entry[field])
     return data
+
+
+# ---------------------------------------------------------------------------
+# Lazy record transforms
+#
+# Each step maps one record to a record (or None to drop it). Steps edit records in
+# place where they can, so a pipeline built with `transform_pipeline` makes a single
+# pass over the stream and allocates at most one new dict per record (in `select_fields`).
+# ---------------------------------------------------------------------------
+
+RecordStep = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+def transform_pipeline(*steps: RecordStep) -> Callable[[Iterable[Dict[str, Any]]], Iterator[Dict[str, Any]]]:
+    """Fuse per-record steps into one generator over a record stream."""
+    def run(records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        for record in records:
+            for step in steps:
+                record = step(record)
+                if record is None:
+                    break
+            else:
+                yield record
+    return run
+
+def where(predicate: Callable[[Dict[str, Any]], bool]) -> RecordStep:
+    """Drop records for which `predicate` is false."""
+    def step(record):
+        return record if predicate(record) else None
+    return step
+
+def set_field(field_name: str, field_value: Any) -> RecordStep:
+    """Streaming equivalent of `add_const_field_json` (edits the record in place)."""
+    def step(record):
+        record[field_name] = field_value
+        return record
+    return step
+
+def select_fields(fields_to_keep: List[str]) -> RecordStep:
+    """Streaming equivalent of `remove_fields`."""
+    keep = set(fields_to_keep)
+    def step(record):
+        return {k: v for k, v in record.items() if k in keep}
+    return step
+
+def rename_fields(map_names: Dict[str, str]) -> RecordStep:
+    """Streaming equivalent of `map_names_json` (edits the record in place)."""
+    def step(record):
+        for old_name, new_name in map_names.items():
+            if old_name in record:
+                record[new_name] = record.pop(old_name)
+        return record
+    return step
+
+def fields_to_str(fields: List[str]) -> RecordStep:
+    """Streaming equivalent of `convert_entries_to_str` (edits the record in place)."""
+    def step(record):
+        for field in fields:
+            if field in record and not isinstance(record[field], str):
+                record[field] = str(record[field])
+        return record
+    return step
+
+def projection_steps(
+    dataset: str,
+    fields_to_keep: List[str],
+    map_names: Dict[str, str],
+    str_fields: List[str],
+) -> List[RecordStep]:
+    """Steps that tag, project, rename and stringify a source's records for uk_data.json."""
+    return [
+        set_field("dataset", dataset),
+        select_fields(fields_to_keep),
+        rename_fields(map_names),
+        fields_to_str(str_fields),
+    ]